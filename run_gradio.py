@@ -1,5 +1,6 @@
 from stable_audio_tools import get_pretrained_model
 from stable_audio_tools.interface.gradio import create_ui
+from stable_audio_tools.inference.profiles import InferenceProfile
 import json 
 
 import torch
@@ -7,12 +8,19 @@ import torch
 def main(args):
     torch.manual_seed(42)
 
+    inference_profile = InferenceProfile(
+        precision=args.precision if args.precision is not None else ("fp16" if args.model_half else None),
+        cudnn_benchmark=args.cudnn_benchmark
+    )
+
     interface = create_ui(
         model_config_path = args.model_config, 
         ckpt_path=args.ckpt_path, 
         pretrained_name=args.pretrained_name, 
         pretransform_ckpt_path=args.pretransform_ckpt_path,
-        model_half=args.model_half
+        model_half=args.model_half,
+        inference_profile=inference_profile,
+        compile_model=args.compile
     )
     interface.queue()
     interface.launch(share=True, auth=(args.username, args.password) if args.username is not None else None)
@@ -27,5 +35,8 @@ if __name__ == "__main__":
     parser.add_argument('--username', type=str, help='Gradio username', required=False)
     parser.add_argument('--password', type=str, help='Gradio password', required=False)
     parser.add_argument('--model-half', action='store_true', help='Whether to use half precision', required=False)
+    parser.add_argument('--precision', type=str, choices=['fp32', 'tf32', 'fp16', 'bf16'], help='Inference precision, overrides --model-half', required=False)
+    parser.add_argument('--cudnn-benchmark', action='store_true', help='Whether to let cuDNN autotune convolution algorithms', required=False)
+    parser.add_argument('--compile', action='store_true', help='Whether to compile the diffusion transformer and warm it up before launching', required=False)
     args = parser.parse_args()
     main(args)
\ No newline at end of file
@@ -0,0 +1,319 @@
+import argparse
+import os
+import tempfile
+import time
+import torch
+
+from stable_audio_tools.models.autoencoders import AudioAutoencoder, OobleckDecoder, OobleckEncoder
+from stable_audio_tools.models.blocks import fused_snake_beta, snake_beta
+from stable_audio_tools.models.utils import save_inference_state_dict
+
+def build_random_autoencoder(args, device):
+    """
+    Builds an Oobleck autoencoder with random weights and no bottleneck
+    """
+    torch.manual_seed(0)
+
+    encoder = OobleckEncoder(in_channels=args.io_channels, channels=args.channels, latent_dim=args.latent_dim, c_mults=args.c_mults, strides=args.strides, use_snake=True)
+    decoder = OobleckDecoder(out_channels=args.io_channels, channels=args.channels, latent_dim=args.latent_dim, c_mults=args.c_mults, strides=args.strides, use_snake=True)
+
+    downsampling_ratio = 1
+    for stride in args.strides:
+        downsampling_ratio *= stride
+
+    model = AudioAutoencoder(encoder, decoder, latent_dim=args.latent_dim, downsampling_ratio=downsampling_ratio, sample_rate=44100, io_channels=args.io_channels)
+
+    return model.to(device).eval().requires_grad_(False)
+
+def timed(function, device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    output = function()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return output, time.perf_counter() - start
+
+def max_abs_diff(output, reference):
+    return (output.float() - reference.float()).abs().max().item()
+
+def benchmark_chunk_batch(args):
+    device = torch.device(args.device)
+    model = build_random_autoencoder(args, device)
+
+    latents = torch.randn([args.batch_size, args.latent_dim, args.latent_length], device=device)
+
+    def run(chunk_batch_size):
+        with torch.no_grad():
+            return model.decode_audio(latents, chunked=True, overlap=args.overlap, chunk_size=args.chunk_size, chunk_batch_size=chunk_batch_size)
+
+    # Warmup
+    run(1)
+
+    reference, reference_time = timed(lambda: run(1), device)
+
+    print(f"Chunk batch size 1: {reference_time:.3f}s")
+
+    for chunk_batch_size in args.chunk_batch_sizes:
+        chunk_batch_size = chunk_batch_size if chunk_batch_size == "auto" else int(chunk_batch_size)
+        output, elapsed = timed(lambda: run(chunk_batch_size), device)
+        print(f"Chunk batch size {chunk_batch_size}: {elapsed:.3f}s ({reference_time / elapsed:.2f}x), max abs diff: {max_abs_diff(output, reference):.3e}")
+
+def benchmark_overlap(args):
+    device = torch.device(args.device)
+    model = build_random_autoencoder(args, device)
+
+    print(f"Encoder context: {model.get_encoder_context()} latents, decoder context: {model.get_decoder_context()} latents")
+
+    latents = torch.randn([args.batch_size, args.latent_dim, args.latent_length], device=device)
+
+    with torch.no_grad():
+        reference, full_time = timed(lambda: model.decode_audio(latents), device)
+        audio = reference
+
+        print(f"Unchunked decode: {full_time:.3f}s")
+
+        for overlap in [None, args.overlap]:
+            output, elapsed = timed(lambda: model.decode_audio(latents, chunked=True, overlap=overlap, chunk_size=args.chunk_size), device)
+            print(f"Chunked decode, overlap {overlap if overlap is not None else 'auto'}: {elapsed:.3f}s, max abs diff vs unchunked: {max_abs_diff(output, reference):.3e}")
+
+        reference = model.encode_audio(audio)
+
+        for overlap in [None, args.overlap]:
+            output, elapsed = timed(lambda: model.encode_audio(audio, chunked=True, overlap=overlap, chunk_size=args.chunk_size), device)
+            print(f"Chunked encode, overlap {overlap if overlap is not None else 'auto'}: {elapsed:.3f}s, max abs diff vs unchunked: {max_abs_diff(output, reference):.3e}")
+
+def benchmark_streaming(args):
+    device = torch.device(args.device)
+    model = build_random_autoencoder(args, device)
+
+    latents = torch.randn([args.batch_size, args.latent_dim, args.latent_length], device=device)
+
+    streaming_decoder = model.get_streaming_decoder()
+
+    with torch.no_grad():
+        reference = model.decode_audio(latents)
+
+        outputs = []
+        step_times = []
+        lookahead = 0
+
+        for i in range(0, args.latent_length, args.frames_per_step):
+            output, elapsed = timed(lambda: streaming_decoder.decode(latents[:, :, i:i+args.frames_per_step]), device)
+            outputs.append(output)
+            step_times.append(elapsed)
+
+            # Latent frames received that haven't been turned into audio yet
+            received = min(i + args.frames_per_step, args.latent_length)
+            lookahead = max(lookahead, received - sum(output.shape[-1] for output in outputs) / model.downsampling_ratio)
+
+        outputs.append(streaming_decoder.flush())
+
+    output = torch.cat(outputs, dim=-1)
+
+    step_times = torch.tensor(step_times[1:]) / args.frames_per_step
+    frame_duration = model.downsampling_ratio / model.sample_rate
+
+    print(f"Per latent frame: mean {step_times.mean().item() * 1000:.2f}ms, p95 {step_times.quantile(0.95).item() * 1000:.2f}ms, frame duration {frame_duration * 1000:.2f}ms")
+    print(f"Real-time factor: {frame_duration / step_times.mean().item():.2f}x")
+    print(f"Lookahead: {lookahead:.2f} latent frames ({lookahead * frame_duration * 1000:.1f}ms)")
+    print(f"Max abs diff vs offline decode: {max_abs_diff(output, reference):.3e}")
+
+def benchmark_export(args):
+    device = torch.device(args.device)
+    model = build_random_autoencoder(args, device)
+
+    latents = torch.randn([args.batch_size, args.latent_dim, args.latent_length], device=device)
+
+    with torch.no_grad():
+        model.decode_audio(latents)
+        reference, reference_time = timed(lambda: model.decode_audio(latents), device)
+
+        print(f"Weight norm, fp32: {reference_time:.3f}s")
+
+        dtypes = {"fp32": None, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+        for precision in args.precisions:
+            dtype = dtypes[precision]
+            # Weight normed modules can't be deep copied after a forward pass, the same seed gives the same weights
+            exported = build_random_autoencoder(args, device).prepare_for_inference(dtype=dtype)
+
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, "model.safetensors")
+                save_inference_state_dict(exported, path, dtype=dtype)
+                size = os.path.getsize(path) / 2**20
+
+            inputs = latents.to(dtype) if dtype is not None else latents
+
+            exported.decode_audio(inputs)
+            output, elapsed = timed(lambda: exported.decode_audio(inputs), device)
+
+            print(f"Folded, {precision}: {elapsed:.3f}s ({reference_time / elapsed:.2f}x), file size {size:.1f}MB, max abs diff: {max_abs_diff(output, reference):.3e}")
+
+def saved_tensor_bytes(function):
+    """
+    Runs the function and returns its output and the number of bytes autograd saved for the backward pass
+    """
+    saved = []
+
+    def pack(tensor):
+        saved.append(tensor.numel() * tensor.element_size())
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        output = function()
+
+    return output, sum(saved)
+
+def benchmark_snake(args):
+    device = torch.device(args.device)
+
+    # The shapes SnakeBeta sees in an Oobleck decoder, from the latent rate blocks to the audio rate blocks
+    channels = [args.channels * c_mult for c_mult in args.c_mults]
+    lengths = [args.latent_length]
+    for stride in reversed(args.strides):
+        lengths.append(lengths[-1] * stride)
+
+    for num_channels, length in zip(reversed(channels), lengths[1:]):
+        x = torch.randn([args.batch_size, num_channels, length], device=device, requires_grad=True)
+        alpha = torch.randn([1, num_channels, 1], device=device).exp().requires_grad_()
+        beta = torch.randn([1, num_channels, 1], device=device).exp().requires_grad_()
+        grad_output = torch.randn_like(x)
+
+        print(f"Channels {num_channels}, length {length}:")
+
+        for name, activation in [("eager", snake_beta), ("fused", fused_snake_beta)]:
+            def forward():
+                with torch.no_grad():
+                    return activation(x, alpha, beta)
+
+            def forward_backward():
+                output, saved = saved_tensor_bytes(lambda: activation(x, alpha, beta))
+                grads = torch.autograd.grad(output, [x, alpha, beta], grad_output)
+                return output, grads, saved
+
+            # Warmup, also compiles the fused kernels
+            forward_backward()
+
+            _, forward_time = timed(forward, device)
+            (output, grads, saved), backward_time = timed(forward_backward, device)
+
+            if name == "eager":
+                reference_output, reference_grads = output, grads
+                print(f"  {name}: forward {forward_time * 1000:.2f}ms, forward+backward {backward_time * 1000:.2f}ms, saved for backward {saved / 2**20:.1f}MB")
+            else:
+                grad_diff = max(max_abs_diff(grad, reference_grad) / reference_grad.abs().max().item() for grad, reference_grad in zip(grads, reference_grads))
+                print(f"  {name}: forward {forward_time * 1000:.2f}ms, forward+backward {backward_time * 1000:.2f}ms, saved for backward {saved / 2**20:.1f}MB, "
+                      f"max abs diff {max_abs_diff(output, reference_output):.3e}, max relative grad diff {grad_diff:.3e}")
+
+    # Streaming decoding runs SnakeBeta on a few frames per step, with a new length on most steps.
+    # It uses the eager ops, the compiled kernels would recompile for each length and stall the stream
+    model = build_random_autoencoder(args, device)
+    streaming_decoder = model.get_streaming_decoder()
+    latents = torch.randn([args.batch_size, args.latent_dim, args.streaming_steps], device=device)
+
+    unique_graphs = torch._dynamo.utils.counters["stats"]["unique_graphs"]
+
+    with torch.no_grad():
+        step_times = [timed(lambda: streaming_decoder.decode(latents[:, :, i:i+1]), device)[1] for i in range(args.streaming_steps)]
+
+    step_times = torch.tensor(step_times)
+    compiled_graphs = torch._dynamo.utils.counters["stats"]["unique_graphs"] - unique_graphs
+
+    print(f"Streaming decode, {args.streaming_steps} steps of 1 latent frame: "
+          f"slowest step {step_times.max().item() * 1000:.2f}ms, p95 {step_times.quantile(0.95).item() * 1000:.2f}ms, compiled graphs {compiled_graphs}")
+
+def benchmark_encode_list(args):
+    device = torch.device(args.device)
+    model = build_random_autoencoder(args, device)
+
+    # A corpus of clips between a tenth of and the full latent length, at two sample rates
+    generator = torch.Generator().manual_seed(0)
+    max_samples = args.latent_length * model.downsampling_ratio
+    lengths = torch.randint(max_samples // 10, max_samples, [args.num_items], generator=generator).tolist()
+    sample_rates = [model.sample_rate if i % 2 == 0 else 48000 for i in range(args.num_items)]
+    audio_list = [torch.randn([args.io_channels, length], generator=generator) for length in lengths]
+
+    with torch.no_grad():
+        def padded():
+            # Every item padded to the longest one, in batches of the same size
+            latents = []
+            for start in range(0, args.num_items, args.batch_size):
+                batch = model.preprocess_audio_list_for_encoder(audio_list[start:start+args.batch_size], sample_rates[start:start+args.batch_size]).to(device)
+                latents.extend(model.encode_audio(batch))
+            return latents
+
+        def bucketed():
+            return model.encode_audio_list(audio_list, sample_rates, max_batch_size=args.batch_size)
+
+        bucketed()
+
+        _, padded_time = timed(padded, device)
+        latents, bucketed_time = timed(bucketed, device)
+
+    padded_frames = sum(max(lengths[start:start+args.batch_size]) * len(lengths[start:start+args.batch_size]) for start in range(0, args.num_items, args.batch_size))
+    print(f"Padded to longest: {padded_time:.3f}s, {padded_frames / sum(lengths):.2f}x the audio length encoded")
+    print(f"Bucketed: {bucketed_time:.3f}s ({padded_time / bucketed_time:.2f}x)")
+    print(f"Latent lengths match: {all(item.shape[-1] == -(-model.preprocess_audio_for_encoder(audio, sample_rate).shape[-1] // model.downsampling_ratio) for item, audio, sample_rate in zip(latents, audio_list, sample_rates))}")
+
+def benchmark_microbatch(args):
+    device = torch.device(args.device)
+    model = build_random_autoencoder(args, device)
+
+    latents = torch.randn([args.batch_size, args.latent_dim, args.latent_length], device=device)
+
+    def run(microbatch_size):
+        with torch.no_grad():
+            if device.type == "cuda":
+                torch.cuda.reset_peak_memory_stats(device)
+            output, elapsed = timed(lambda: model.decode(latents, microbatch_size=microbatch_size), device)
+            peak_memory = torch.cuda.max_memory_allocated(device) / 2**20 if device.type == "cuda" else float("nan")
+            return output, elapsed, peak_memory
+
+    # Warmup
+    run(None)
+
+    reference, reference_time, reference_memory = run(None)
+
+    print(f"Whole batch of {args.batch_size}: {reference_time:.3f}s, peak memory {reference_memory:.0f}MB")
+
+    for microbatch_size in args.microbatch_sizes:
+        microbatch_size = microbatch_size if microbatch_size == "auto" else int(microbatch_size)
+        output, elapsed, peak_memory = run(microbatch_size)
+        print(f"Microbatch size {microbatch_size}: {elapsed:.3f}s ({reference_time / elapsed:.2f}x), peak memory {peak_memory:.0f}MB, max abs diff: {max_abs_diff(output, reference):.3e}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inference benchmarks for the Oobleck autoencoder")
+    parser.add_argument("benchmark", choices=["chunk_batch", "overlap", "streaming", "export", "snake", "encode_list", "microbatch"])
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--io-channels", type=int, default=2)
+    parser.add_argument("--channels", type=int, default=32)
+    parser.add_argument("--latent-dim", type=int, default=64)
+    parser.add_argument("--c-mults", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--strides", type=int, nargs="+", default=[2, 4, 4, 8, 8])
+    parser.add_argument("--latent-length", type=int, default=1024)
+    parser.add_argument("--chunk-size", type=int, default=128)
+    parser.add_argument("--overlap", type=int, default=32)
+    parser.add_argument("--frames-per-step", type=int, default=1)
+    parser.add_argument("--streaming-steps", type=int, default=64)
+    parser.add_argument("--num-items", type=int, default=32)
+    parser.add_argument("--microbatch-sizes", type=str, nargs="+", default=["1", "2", "auto"])
+    parser.add_argument("--chunk-batch-sizes", type=str, nargs="+", default=["2", "4", "8", "auto"])
+    parser.add_argument("--precisions", type=str, nargs="+", default=["fp32", "bf16"], choices=["fp32", "fp16", "bf16"])
+    args = parser.parse_args()
+
+    if args.benchmark == "chunk_batch":
+        benchmark_chunk_batch(args)
+    elif args.benchmark == "overlap":
+        benchmark_overlap(args)
+    elif args.benchmark == "streaming":
+        benchmark_streaming(args)
+    elif args.benchmark == "export":
+        benchmark_export(args)
+    elif args.benchmark == "snake":
+        benchmark_snake(args)
+    elif args.benchmark == "encode_list":
+        benchmark_encode_list(args)
+    elif args.benchmark == "microbatch":
+        benchmark_microbatch(args)
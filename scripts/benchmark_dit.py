@@ -0,0 +1,473 @@
+import argparse
+import copy
+import json
+import time
+import torch
+
+from torch import nn
+
+from stable_audio_tools.inference.profiles import InferenceProfile, apply_inference_profile
+from stable_audio_tools.inference.sampling import sample_k
+from stable_audio_tools.models.diffusion import DiTWrapper
+from stable_audio_tools.models.transformer import (
+    Attention, FeatureCache, RotaryEmbedding, TransformerBlock, apply_rotary_pos_emb, apply_rotary_tables, fused_apply_rotary_tables, saved_activation_bytes,
+    fused_gate_residual, fused_layer_norm_modulate, gate_residual, layer_norm_modulate
+)
+
+def build_random_dit(args, device, **transformer_kwargs):
+    """
+    Builds a small continuous-transformer DiT with random (non-zero) weights, so that every layer contributes to the output
+    """
+    model = DiTWrapper(
+        io_channels=args.io_channels,
+        embed_dim=args.embed_dim,
+        depth=args.depth,
+        num_heads=args.num_heads,
+        cond_token_dim=args.cond_token_dim,
+        transformer_type="continuous_transformer",
+        **transformer_kwargs
+    )
+
+    # The DiT zero-initializes its output projections, re-initialize so the benchmark measures real work
+    torch.manual_seed(0)
+    with torch.no_grad():
+        for param in model.parameters():
+            if param.ndim >= 2:
+                nn.init.normal_(param, std=0.02)
+
+    return model.to(device).eval().requires_grad_(False)
+
+def timed(function, device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    output = function()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return output, time.perf_counter() - start
+
+def relative_error(output, reference):
+    return ((output.float() - reference.float()).norm() / reference.float().norm()).item()
+
+def benchmark_feature_cache(args):
+    device = torch.device(args.device)
+    model = build_random_dit(args, device)
+
+    noise = torch.randn([args.batch_size, args.io_channels, args.latent_length], device=device)
+    cross_attn_cond = torch.randn([args.batch_size, args.cond_length, args.cond_token_dim], device=device)
+
+    def run(feature_cache=None):
+        # Reseed so both runs draw the same sampler noise
+        torch.manual_seed(args.seed)
+        return sample_k(
+            model,
+            noise,
+            steps=args.steps,
+            sampler_type=args.sampler_type,
+            device=device,
+            progress=False,
+            feature_cache=feature_cache,
+            cross_attn_cond=cross_attn_cond,
+            cfg_scale=args.cfg_scale,
+        )
+
+    # Warmup
+    run()
+
+    reference, full_time = timed(run, device)
+
+    feature_cache = FeatureCache(args.cache_start_layer, args.cache_end_layer, interval=args.cache_interval)
+    cached, cached_time = timed(lambda: run(feature_cache), device)
+
+    print(f"Full computation: {full_time:.3f}s")
+    print(f"Feature cache (layers {args.cache_start_layer}-{args.cache_end_layer}, interval {args.cache_interval}): {cached_time:.3f}s")
+    print(f"Full/cached evaluations: {feature_cache.num_full}/{feature_cache.num_cached}")
+    print(f"Speedup: {full_time / cached_time:.2f}x")
+    print(f"Relative drift: {relative_error(cached, reference):.3e}")
+
+def benchmark_profiles(args):
+    device = torch.device(args.device)
+    base_model = build_random_dit(args, device)
+
+    noise = torch.randn([args.batch_size, args.io_channels, args.latent_length], device=device)
+    cross_attn_cond = torch.randn([args.batch_size, args.cond_length, args.cond_token_dim], device=device)
+
+    results = {}
+
+    for precision in args.precisions:
+        profile = InferenceProfile(precision=precision, cudnn_benchmark=args.cudnn_benchmark, progress=False)
+        model = apply_inference_profile(copy.deepcopy(base_model), profile)
+        model_dtype = next(model.parameters()).dtype
+
+        def run():
+            torch.manual_seed(args.seed)
+            return sample_k(
+                model,
+                noise.to(model_dtype),
+                steps=args.steps,
+                sampler_type=args.sampler_type,
+                device=device,
+                progress=profile.progress,
+                autocast_dtype=profile.autocast_dtype,
+                cross_attn_cond=cross_attn_cond.to(model_dtype),
+                cfg_scale=args.cfg_scale,
+            ).float()
+
+        # Warmup, also lets cuDNN autotune when enabled
+        run()
+
+        output, elapsed = timed(run, device)
+        results[precision] = (output, elapsed)
+
+    reference, reference_time = results[args.precisions[0]]
+
+    for precision, (output, elapsed) in results.items():
+        error = relative_error(output, reference)
+        status = "OK" if error <= args.tolerance else "MISMATCH"
+        print(f"{precision}: {elapsed:.3f}s ({reference_time / elapsed:.2f}x), relative error vs {args.precisions[0]}: {error:.3e} [{status}]")
+
+def benchmark_compile(args):
+    device = torch.device(args.device)
+    model = build_random_dit(args, device)
+
+    noise = torch.randn([args.batch_size, args.io_channels, args.latent_length], device=device)
+    cross_attn_cond = torch.randn([args.batch_size, args.cond_length, args.cond_token_dim], device=device)
+
+    def run(bound):
+        torch.manual_seed(args.seed)
+        # Binding prepares the conditioning once, as generate_diffusion_cond does
+        model_fn = model.bind_conditioning(cross_attn_cond=cross_attn_cond, cfg_scale=args.cfg_scale) if bound else model
+        model_args = {} if bound else {"cross_attn_cond": cross_attn_cond, "cfg_scale": args.cfg_scale}
+
+        return sample_k(
+            model_fn,
+            noise,
+            steps=args.steps,
+            sampler_type=args.sampler_type,
+            device=device,
+            progress=False,
+            **model_args
+        )
+
+    # Warmup
+    run(bound=False)
+
+    reference, eager_time = timed(lambda: run(bound=False), device)
+    bound, bound_time = timed(lambda: run(bound=True), device)
+
+    model.model.compile_inference(mode=args.compile_mode)
+
+    _, warmup_time = timed(lambda: run(bound=True), device)
+    compiled, compiled_time = timed(lambda: run(bound=True), device)
+
+    print(f"Eager: {eager_time:.3f}s")
+    print(f"Eager, bound conditioning: {bound_time:.3f}s ({eager_time / bound_time:.2f}x), relative error: {relative_error(bound, reference):.3e}")
+    print(f"Compiled, first run (includes compilation): {warmup_time:.3f}s")
+    print(f"Compiled, bound conditioning: {compiled_time:.3f}s ({eager_time / compiled_time:.2f}x), relative error: {relative_error(compiled, reference):.3e}")
+
+def benchmark_checkpointing(args):
+    device = torch.device(args.device)
+
+    if args.model_config is not None:
+        with open(args.model_config) as f:
+            dit_config = json.load(f)["model"]["diffusion"]["config"]
+    else:
+        dit_config = {
+            "io_channels": args.io_channels,
+            "embed_dim": args.embed_dim,
+            "depth": args.depth,
+            "num_heads": args.num_heads,
+            "cond_token_dim": args.cond_token_dim,
+            "transformer_type": "continuous_transformer",
+        }
+
+    torch.manual_seed(0)
+    model = DiTWrapper(**dit_config).to(device).train()
+    transformer = model.model.transformer
+
+    io_channels = dit_config.get("io_channels", 32)
+    global_cond_dim = dit_config.get("global_cond_dim", 0)
+
+    x = torch.randn([args.batch_size, io_channels, args.latent_length], device=device)
+    t = torch.rand([args.batch_size], device=device)
+    target = torch.randn_like(x)
+    cross_attn_cond = torch.randn([args.batch_size, args.cond_length, dit_config.get("cond_token_dim", 0)], device=device)
+    global_cond = torch.randn([args.batch_size, global_cond_dim], device=device) if global_cond_dim > 0 else None
+
+    def step():
+        with torch.autocast(device.type, dtype=torch.bfloat16, enabled=args.autocast):
+            output, stored_bytes = saved_activation_bytes(model, x, t, cross_attn_cond=cross_attn_cond, global_cond=global_cond)
+            loss = torch.nn.functional.mse_loss(output.float(), target)
+        loss.backward()
+        return stored_bytes
+
+    results = {}
+
+    for policy in args.policies:
+        transformer.set_checkpointing(policy, checkpoint_every=args.checkpoint_every, checkpoint_memory_budget=args.checkpoint_memory_budget)
+
+        # Warmup, also lets the "auto" policy measure the layers
+        model.zero_grad(set_to_none=True)
+        step()
+        model.zero_grad(set_to_none=True)
+
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats(device)
+            allocated = torch.cuda.memory_allocated(device)
+
+        stored_bytes, elapsed = timed(step, device)
+        peak_memory = torch.cuda.max_memory_allocated(device) - allocated if device.type == "cuda" else None
+
+        # Per-parameter gradient norms, keeping full gradient copies of large models is too expensive
+        gradients = torch.stack([param.grad.float().norm() for param in model.parameters() if param.grad is not None])
+        model.zero_grad(set_to_none=True)
+
+        results[policy] = (elapsed, stored_bytes, peak_memory, gradients)
+
+    reference_time, _, _, reference_gradients = results[args.policies[0]]
+
+    for policy, (elapsed, stored_bytes, peak_memory, gradients) in results.items():
+        peak = f", peak memory {peak_memory / 1024 ** 3:.2f}GB" if peak_memory is not None else ""
+        print(f"{policy}: step {elapsed:.3f}s ({reference_time / elapsed:.2f}x), stored activations {stored_bytes / 1024 ** 3:.2f}GB{peak}, "
+              f"gradient norm relative error vs {args.policies[0]}: {relative_error(gradients, reference_gradients):.3e}")
+
+def benchmark_rotary(args):
+    device = torch.device(args.device)
+    dtype = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}[args.rotary_dtype]
+
+    dim_heads = args.embed_dim // args.num_heads
+    rotary_pos_emb = RotaryEmbedding(max(dim_heads // 2, 32)).to(device)
+
+    q = torch.randn([args.batch_size, args.num_heads, args.latent_length, dim_heads], device=device, dtype=dtype)
+    k = torch.randn_like(q)
+
+    def run_uncached():
+        # What every forward did before: build the frequencies, then cast and rotate q and k in every layer
+        freqs, _ = rotary_pos_emb.forward_from_seq_len(args.latent_length)
+        for _ in range(args.depth):
+            q_rotated = apply_rotary_pos_emb(q.to(torch.float32), freqs).to(dtype)
+            k_rotated = apply_rotary_pos_emb(k.to(torch.float32), freqs).to(dtype)
+        return q_rotated, k_rotated
+
+    # Attention only uses the fused kernel on CUDA
+    apply_rotary_tables_fn = fused_apply_rotary_tables if device.type == "cuda" else apply_rotary_tables
+
+    def run_cached():
+        tables = rotary_pos_emb.get_cos_sin(args.latent_length)
+        for _ in range(args.depth):
+            q_rotated = apply_rotary_tables_fn(q, *tables)
+            k_rotated = apply_rotary_tables_fn(k, *tables)
+        return q_rotated, k_rotated
+
+    with torch.no_grad():
+        # Warmup, also compiles the fused kernel and fills the cache
+        run_uncached()
+        run_cached()
+
+        (reference_q, reference_k), uncached_time = timed(lambda: [run_uncached() for _ in range(args.steps)][-1], device)
+        (q_rotated, k_rotated), cached_time = timed(lambda: [run_cached() for _ in range(args.steps)][-1], device)
+
+    print(f"Rotary embeddings for {args.steps} steps x {args.depth} layers, {args.latent_length} positions, {args.rotary_dtype}:")
+    print(f"Uncached: {uncached_time:.3f}s")
+    print(f"Cached tables{', fused' if device.type == 'cuda' else ''}: {cached_time:.3f}s ({uncached_time / cached_time:.2f}x)")
+    print(f"Max abs diff: q {(q_rotated.float() - reference_q.float()).abs().max().item():.3e}, k {(k_rotated.float() - reference_k.float()).abs().max().item():.3e}")
+
+def benchmark_adaln(args):
+    device = torch.device(args.device)
+
+    torch.manual_seed(0)
+    block = TransformerBlock(args.embed_dim, dim_heads=args.embed_dim // args.num_heads, global_cond_dim=args.embed_dim, zero_init_branch_outputs=False).to(device)
+
+    # The adaLN projection is zero-initialized, re-initialize so scale, shift and gate are non-trivial
+    nn.init.normal_(block.to_scale_shift_gate[1].weight, std=0.02)
+
+    x = torch.randn([args.batch_size, args.latent_length, args.embed_dim], device=device, requires_grad=True)
+    global_cond = torch.randn([args.batch_size, args.embed_dim], device=device)
+
+    def unfused_block():
+        # TransformerBlock.forward with adaLN, one eager op at a time
+        scale_self, shift_self, gate_self, scale_ff, shift_ff, gate_ff = block.to_scale_shift_gate(global_cond).unsqueeze(1).chunk(6, dim = -1)
+
+        residual = x
+        h = block.pre_norm(x)
+        h = h * (1 + scale_self) + shift_self
+        h = block.self_attn(h)
+        h = h * torch.sigmoid(1 - gate_self)
+        h = h + residual
+
+        residual = h
+        h = block.ff_norm(h)
+        h = h * (1 + scale_ff) + shift_ff
+        h = block.ff(h)
+        h = h * torch.sigmoid(1 - gate_ff)
+        return h + residual
+
+    scale, shift, gate = block.to_scale_shift_gate(global_cond).unsqueeze(1).chunk(6, dim = -1)[:3]
+    scale, shift, gate = scale.detach(), shift.detach(), gate.detach()
+    branch = torch.randn_like(x)
+    gamma, beta = block.pre_norm.gamma, block.pre_norm.beta
+
+    benchmarks = {
+        "modulate norm": (
+            lambda: layer_norm_modulate(x, gamma, beta, scale, shift),
+            lambda: fused_layer_norm_modulate(x, gamma, beta, scale, shift),
+        ),
+        "gate residual": (
+            lambda: gate_residual(branch, gate, x),
+            lambda: fused_gate_residual(branch, gate, x),
+        ),
+        "block": (
+            unfused_block,
+            lambda: block(x, global_cond=global_cond),
+        ),
+    }
+
+    print(f"adaLN block, {args.batch_size}x{args.latent_length}x{args.embed_dim} on {device.type}" + ("" if device.type == "cuda" else " (blocks use the eager fallback off CUDA)"))
+
+    for name, (reference_fn, fused_fn) in benchmarks.items():
+        results = []
+
+        for function in [reference_fn, fused_fn]:
+            def forward_backward():
+                output = function()
+                output.float().square().mean().backward()
+                return output
+
+            # Warmup, also compiles the fused kernels with and without autograd
+            forward_backward()
+
+            with torch.no_grad():
+                function()
+                _, forward_time = timed(lambda: [function() for _ in range(args.steps)], device)
+
+            output, train_time = timed(lambda: [forward_backward() for _ in range(args.steps)][-1], device)
+            results.append((output.detach(), forward_time, train_time))
+
+        (reference, reference_forward_time, reference_train_time), (output, forward_time, train_time) = results
+
+        print(f"{name}: forward {reference_forward_time / args.steps * 1000:.2f}ms -> {forward_time / args.steps * 1000:.2f}ms ({reference_forward_time / forward_time:.2f}x), "
+              f"forward+backward {reference_train_time / args.steps * 1000:.2f}ms -> {train_time / args.steps * 1000:.2f}ms ({reference_train_time / train_time:.2f}x), "
+              f"max abs diff {(output.float() - reference.float()).abs().max().item():.3e}")
+
+def benchmark_gqa(args):
+    device = torch.device(args.device)
+    dim_heads = args.embed_dim // args.num_heads
+
+    x = torch.randn([args.batch_size, args.latent_length, args.embed_dim], device=device)
+
+    print(f"Self-attention, {args.batch_size}x{args.latent_length}x{args.embed_dim}, {args.num_heads} heads on {device.type}")
+
+    for kv_heads in args.kv_heads:
+        torch.manual_seed(0)
+        attention = Attention(args.embed_dim, dim_heads=dim_heads, kv_heads=kv_heads, zero_init_output=False).to(device).eval()
+
+        with torch.no_grad():
+            # Reference: the same projections, with k and v repeated to every query head
+            q, k, v = attention.to_qkv(x).split([args.embed_dim, kv_heads * dim_heads, kv_heads * dim_heads], dim=-1)
+            q, k, v = (t.reshape(args.batch_size, args.latent_length, -1, dim_heads).transpose(1, 2) for t in (q, k, v))
+            k, v = (t.repeat_interleave(args.num_heads // kv_heads, dim=1) for t in (k, v))
+            reference = attention.to_out(torch.nn.functional.scaled_dot_product_attention(q, k, v).transpose(1, 2).reshape(x.shape))
+
+            # Warmup
+            attention(x)
+
+            output, elapsed = timed(lambda: [attention(x) for _ in range(args.steps)][-1], device)
+
+        kv_bytes = 2 * kv_heads * dim_heads * x.element_size()
+
+        print(f"{kv_heads} kv heads: {elapsed / args.steps * 1000:.2f}ms per forward, {kv_bytes} bytes of keys and values per token and layer, "
+              f"max abs diff vs repeated kv: {(output - reference).abs().max().item():.3e}")
+
+def benchmark_window(args):
+    device = torch.device(args.device)
+
+    cross_attn_cond = torch.randn([args.batch_size, args.cond_length, args.cond_token_dim], device=device)
+    t = torch.rand([args.batch_size], device=device)
+
+    global_model = build_random_dit(args, device)
+    window_model = build_random_dit(args, device, window_size=args.window_size)
+    window_model.load_state_dict(global_model.state_dict())
+
+    models = {"global": global_model, f"window {args.window_size}": window_model}
+
+    print(f"DiT forward, {args.depth} layers, {args.embed_dim} dim, batch {args.batch_size} on {device.type}")
+
+    for latent_length in args.latent_lengths:
+        x = torch.randn([args.batch_size, args.io_channels, latent_length], device=device)
+        outputs = {}
+
+        for name, model in models.items():
+            if device.type == "cuda":
+                torch.cuda.empty_cache()
+                torch.cuda.reset_peak_memory_stats(device)
+
+            try:
+                with torch.no_grad():
+                    # Warmup
+                    model(x, t, cross_attn_cond=cross_attn_cond)
+
+                    outputs[name], elapsed = timed(lambda: [model(x, t, cross_attn_cond=cross_attn_cond) for _ in range(args.steps)][-1], device)
+            except torch.cuda.OutOfMemoryError:
+                print(f"{latent_length} frames, {name}: out of memory")
+                continue
+
+            memory = f", peak memory {torch.cuda.max_memory_allocated(device) / 1024 ** 3:.2f}GB" if device.type == "cuda" else ""
+
+            print(f"{latent_length} frames, {name}: {elapsed / args.steps * 1000:.1f}ms per forward, "
+                  f"{elapsed / args.steps / latent_length * 1e6:.1f}us per frame{memory}")
+
+        if len(outputs) == 2:
+            reference, output = outputs.values()
+            print(f"{latent_length} frames: relative difference of the windowed output: {relative_error(output, reference):.3e}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inference benchmarks for the diffusion transformer")
+    parser.add_argument("benchmark", choices=["feature_cache", "profiles", "compile", "checkpointing", "rotary", "adaln", "gqa", "window"])
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument("--sampler-type", type=str, default="dpmpp-2m-sde")
+    parser.add_argument("--cfg-scale", type=float, default=6.0)
+    parser.add_argument("--io-channels", type=int, default=64)
+    parser.add_argument("--embed-dim", type=int, default=256)
+    parser.add_argument("--depth", type=int, default=8)
+    parser.add_argument("--num-heads", type=int, default=4)
+    parser.add_argument("--cond-token-dim", type=int, default=128)
+    parser.add_argument("--cond-length", type=int, default=128)
+    parser.add_argument("--latent-length", type=int, default=256)
+    parser.add_argument("--cache-start-layer", type=int, default=2)
+    parser.add_argument("--cache-end-layer", type=int, default=6)
+    parser.add_argument("--cache-interval", type=int, default=2)
+    parser.add_argument("--precisions", type=str, nargs="+", default=["fp32", "tf32", "bf16"])
+    parser.add_argument("--cudnn-benchmark", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=5e-2)
+    parser.add_argument("--compile-mode", type=str, default=None)
+    parser.add_argument("--model-config", type=str, default=None, help="Model config to take the DiT config from, e.g. stable_audio_tools/configs/model_configs/txt2audio/stable_audio_2_0.json")
+    parser.add_argument("--policies", type=str, nargs="+", default=["none", "all", "every_n", "attention", "auto"])
+    parser.add_argument("--checkpoint-every", type=int, default=2)
+    parser.add_argument("--checkpoint-memory-budget", type=float, default=None)
+    parser.add_argument("--autocast", action="store_true", help="Run the training steps in bf16 autocast")
+    parser.add_argument("--rotary-dtype", type=str, default="bf16", choices=["fp32", "fp16", "bf16"])
+    parser.add_argument("--kv-heads", type=int, nargs="+", default=[4, 2, 1])
+    parser.add_argument("--window-size", type=int, default=256)
+    parser.add_argument("--latent-lengths", type=int, nargs="+", default=[1024, 2048, 4096, 8192], help="8192 latent frames are about 6 minutes of audio at 21.5Hz")
+    args = parser.parse_args()
+
+    if args.benchmark == "feature_cache":
+        benchmark_feature_cache(args)
+    elif args.benchmark == "profiles":
+        benchmark_profiles(args)
+    elif args.benchmark == "compile":
+        benchmark_compile(args)
+    elif args.benchmark == "checkpointing":
+        benchmark_checkpointing(args)
+    elif args.benchmark == "rotary":
+        benchmark_rotary(args)
+    elif args.benchmark == "adaln":
+        benchmark_adaln(args)
+    elif args.benchmark == "gqa":
+        benchmark_gqa(args)
+    elif args.benchmark == "window":
+        benchmark_window(args)
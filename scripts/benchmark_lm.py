@@ -0,0 +1,339 @@
+import argparse
+import copy
+import time
+import torch
+
+from torch import nn
+
+from stable_audio_tools.models.autoencoders import AudioAutoencoder
+from stable_audio_tools.models.bottleneck import DiscreteBottleneck
+from stable_audio_tools.models.codebook_patterns import DelayedPatternProvider, MusicLMPattern, ParallelPatternProvider, UnrolledPatternProvider
+from stable_audio_tools.models.lm import AudioLanguageModel, AudioLanguageModelWrapper
+from stable_audio_tools.models.lm_backbone import ContinuousTransformerAudioLMBackbone
+from stable_audio_tools.models.pretransforms import AutoencoderPretransform
+from stable_audio_tools.models.utils import multinomial, sample_logits, sample_top_k, sample_top_p
+
+def build_random_lm(args, device, **backbone_kwargs):
+    """
+    Builds a continuous-transformer audio LM with random (non-zero) weights and cross-attention conditioning.
+    The pretransform only provides the codebook layout, generation doesn't decode audio.
+    """
+    autoencoder = AudioAutoencoder(
+        nn.Conv1d(2, args.num_quantizers, 1),
+        nn.Conv1d(args.num_quantizers, 2, 1),
+        latent_dim=args.num_quantizers,
+        downsampling_ratio=512,
+        sample_rate=44100,
+        bottleneck=DiscreteBottleneck(args.num_quantizers, args.codebook_size, "codes")
+    )
+
+    backbone = ContinuousTransformerAudioLMBackbone(
+        embed_dim=args.embed_dim,
+        depth=args.depth,
+        dim_heads=args.embed_dim // args.num_heads,
+        cross_attn_cond_dim=args.cond_token_dim,
+        project_cross_attn_cond=True,
+        **backbone_kwargs
+    )
+
+    lm = AudioLanguageModel(DelayedPatternProvider(n_q=args.num_quantizers), backbone, args.num_quantizers, args.codebook_size)
+
+    model = AudioLanguageModelWrapper(
+        pretransform=AutoencoderPretransform(autoencoder),
+        lm=lm,
+        sample_rate=44100,
+        min_input_length=512,
+        cross_attn_cond_ids=["prompt"]
+    )
+
+    # The LM zero-initializes its output projections, re-initialize so the benchmark measures real work
+    torch.manual_seed(0)
+    with torch.no_grad():
+        for param in model.lm.parameters():
+            if param.ndim >= 2:
+                nn.init.normal_(param, std=0.02)
+
+    return model.to(device).eval().requires_grad_(False)
+
+def timed(function, device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    output = function()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return output, time.perf_counter() - start
+
+def random_conditioning(args, device):
+    return {
+        "prompt": (
+            torch.randn([args.batch_size, args.cond_length, args.cond_token_dim], device=device),
+            torch.ones([args.batch_size, args.cond_length], device=device, dtype=torch.bool)
+        )
+    }
+
+def benchmark_kv_cache(args):
+    device = torch.device(args.device)
+    model = build_random_lm(args, device)
+
+    conditioning_tensors = random_conditioning(args, device)
+
+    def run(use_cache, max_gen_len):
+        # Greedy decoding, so the runs with and without the cache can be compared token by token
+        return model.generate(
+            max_gen_len=max_gen_len,
+            conditioning_tensors=conditioning_tensors,
+            use_cache=use_cache,
+            cfg_scale=args.cfg_scale,
+            temp=0
+        )
+
+    # Warmup
+    run(True, 8)
+    run(False, 8)
+
+    print(f"Audio LM generation, {args.depth} layers, {args.embed_dim} dim, {args.num_quantizers} codebooks, batch {args.batch_size}, cfg scale {args.cfg_scale} on {device.type}")
+
+    for max_gen_len in args.gen_lengths:
+        uncached, uncached_time = timed(lambda: run(False, max_gen_len), device)
+        cached, cached_time = timed(lambda: run(True, max_gen_len), device)
+
+        print(f"{max_gen_len} steps: "
+              f"without cache {args.batch_size * max_gen_len / uncached_time:.1f} tokens/s, "
+              f"with cache {args.batch_size * max_gen_len / cached_time:.1f} tokens/s ({uncached_time / cached_time:.2f}x), "
+              f"identical tokens: {(cached == uncached).float().mean().item() * 100:.2f}%")
+
+def benchmark_decode_step(args):
+    device = torch.device(args.device)
+    model = build_random_lm(args, device)
+
+    conditioning_tensors = random_conditioning(args, device)
+
+    def run(max_gen_len):
+        return model.generate(max_gen_len=max_gen_len, conditioning_tensors=conditioning_tensors, cfg_scale=args.cfg_scale, temp=0)
+
+    # Warmup
+    run(8)
+
+    print(f"Audio LM decode step, {args.depth} layers, {args.embed_dim} dim, {args.num_quantizers} codebooks, batch {args.batch_size}, cfg scale {args.cfg_scale} on {device.type}")
+
+    results = {}
+
+    for max_gen_len in args.gen_lengths:
+        results[max_gen_len] = timed(lambda: run(max_gen_len), device)
+
+    model.compile_inference(mode=args.compile_mode)
+
+    for max_gen_len, (reference, eager_time) in results.items():
+        # The cache size depends on the generation length, every length compiles the step and records its CUDA graph on first use
+        _, compile_time = timed(lambda: run(max_gen_len), device)
+
+        output, compiled_time = timed(lambda: run(max_gen_len), device)
+
+        print(f"{max_gen_len} steps: "
+              f"eager {args.batch_size * max_gen_len / eager_time:.1f} tokens/s, "
+              f"compiled {args.batch_size * max_gen_len / compiled_time:.1f} tokens/s ({eager_time / compiled_time:.2f}x), "
+              f"identical tokens: {(output == reference).float().mean().item() * 100:.2f}%, compile and warmup {compile_time:.1f}s")
+
+def reference_pattern_indexes(pattern, timesteps, keep_only_valid_steps):
+    """
+    The sequence scatter indexes built coordinate by coordinate, as the pattern did before vectorization
+    """
+    ref_layout = pattern.valid_layout if keep_only_valid_steps else pattern.layout
+    indexes = torch.full((pattern.n_q, len(ref_layout)), pattern.n_q * timesteps, dtype=torch.long)
+    for s, sequence_coords in enumerate(ref_layout):
+        for coords in sequence_coords:
+            if coords.t < timesteps:
+                indexes[coords.q, s] = coords.t + coords.q * timesteps
+    return indexes
+
+def reference_reverted_indexes(pattern, sequence_steps, keep_only_valid_steps, is_model_output):
+    """
+    The reverted scatter indexes built coordinate by coordinate, as the pattern did before vectorization
+    """
+    ref_layout = pattern.valid_layout if keep_only_valid_steps else pattern.layout
+    if is_model_output and pattern.starts_with_special_token():
+        ref_layout = ref_layout[1:]
+    indexes = torch.full((pattern.n_q, pattern.timesteps), pattern.n_q * sequence_steps, dtype=torch.long)
+    for s, sequence_codes in enumerate(ref_layout[:sequence_steps]):
+        for code in sequence_codes:
+            if code.t < pattern.timesteps:
+                indexes[code.q, code.t] = s + code.q * sequence_steps
+    return indexes
+
+def benchmark_patterns(args):
+    device = torch.device(args.device)
+
+    providers = {
+        "delay": DelayedPatternProvider(n_q=args.num_quantizers),
+        "parallel": ParallelPatternProvider(n_q=args.num_quantizers),
+        "unroll": UnrolledPatternProvider(n_q=args.num_quantizers),
+        "musiclm": MusicLMPattern(n_q=args.num_quantizers),
+    }
+
+    print(f"Codebook pattern indexes, {args.num_quantizers} codebooks, batch {args.batch_size} on {device.type}")
+
+    for name, provider in providers.items():
+        for timesteps in args.gen_lengths:
+            codes = torch.randint(0, args.codebook_size, (args.batch_size, args.num_quantizers, timesteps), device=device)
+
+            def train_step():
+                # The pattern work of AudioLanguageModel.compute_logits, with logits of a single class
+                pattern = provider.get_pattern(timesteps)
+                sequence, _, _ = pattern.build_pattern_sequence(codes, args.codebook_size, keep_only_valid_steps=True)
+                logits = sequence[:, None].float()
+                pattern.revert_pattern_logits(logits, float("nan"), keep_only_valid_steps=True)
+                return pattern, sequence
+
+            (pattern, sequence), first_time = timed(train_step, device)
+            _, cached_time = timed(lambda: [train_step() for _ in range(args.steps)], device)
+
+            # Compare the vectorized indexes with the coordinate by coordinate construction
+            reference = reference_pattern_indexes(pattern, timesteps, True)
+            _, indexes, _ = pattern.build_pattern_sequence(codes, args.codebook_size, keep_only_valid_steps=True)
+            reverted_reference = reference_reverted_indexes(pattern, sequence.shape[-1], True, True)
+            _, reverted_indexes, _ = pattern.revert_pattern_logits(sequence[:, None].float(), float("nan"), keep_only_valid_steps=True)
+
+            mismatches = (indexes.cpu() != reference).sum().item() + (reverted_indexes.cpu() != reverted_reference).sum().item()
+
+            print(f"{name}, {timesteps} timesteps: first call {first_time * 1000:.1f}ms, cached {cached_time / args.steps * 1000:.2f}ms, "
+                  f"index mismatches vs reference: {mismatches}")
+
+def reference_sample(logits, temperature, top_k, top_p):
+    """
+    Samples with the single setting samplers, one call per group of batch items with the same temperature, top-k and top-p
+    """
+    next_token = torch.empty(logits.shape[:-1] + (1,), dtype=torch.long, device=logits.device)
+    settings = torch.stack([temperature, top_k.float(), top_p], dim=-1)
+
+    for setting in settings.unique(dim=0):
+        rows = (settings == setting).all(dim=-1)
+        temp, k, p = setting[0].item(), int(setting[1].item()), setting[2].item()
+        if temp > 0:
+            probs = torch.softmax(logits[rows] / temp, dim=-1)
+            if p > 0.0:
+                next_token[rows] = sample_top_p(probs, p=p)
+            elif k > 0:
+                next_token[rows] = sample_top_k(probs, k=k)
+            else:
+                next_token[rows] = multinomial(probs, num_samples=1)
+        else:
+            next_token[rows] = torch.argmax(logits[rows], dim=-1, keepdim=True)
+
+    return next_token
+
+def benchmark_sampler(args):
+    device = torch.device(args.device)
+
+    # Requests with a mix of greedy, top-k and top-p settings, as a batched server would see
+    temperature = torch.tensor([0.0, 1.0, 1.0, 0.7], device=device).repeat(args.batch_size)
+    top_k = torch.tensor([0, 250, 0, 50], device=device).repeat(args.batch_size)
+    top_p = torch.tensor([0.0, 0.0, 0.9, 0.0], device=device).repeat(args.batch_size)
+    batch_size = temperature.shape[0]
+
+    print(f"Token sampling, {batch_size} requests with mixed settings, {args.num_quantizers} codebooks of {args.codebook_size} on {device.type}")
+
+    logits = torch.randn([batch_size, args.num_quantizers, args.codebook_size], device=device) * 3
+
+    # Compare the token distributions of both samplers over many draws of the same logits
+    draws = logits[:1, :1].expand(args.steps * 1000, 1, args.codebook_size)
+    for name, temp, k, p in [("top-k", 1.0, 250, 0.0), ("top-p", 1.0, 0.0, 0.9), ("full", 0.7, 0, 0.0)]:
+        settings = [torch.full([draws.shape[0]], value, device=device) for value in (temp, k, p)]
+        settings[1] = settings[1].long()
+        reference = torch.bincount(reference_sample(draws, *settings).flatten(), minlength=args.codebook_size).float()
+        fused = torch.bincount(sample_logits(draws, *settings).flatten(), minlength=args.codebook_size).float()
+        total_variation = 0.5 * (reference / reference.sum() - fused / fused.sum()).abs().sum().item()
+        print(f"{name}: total variation distance between samplers {total_variation:.4f} over {draws.shape[0]} draws")
+
+    # Warmup
+    reference_sample(logits, temperature, top_k, top_p)
+    sample_logits(logits, temperature, top_k, top_p)
+
+    _, reference_time = timed(lambda: [reference_sample(logits, temperature, top_k, top_p) for _ in range(args.steps)], device)
+    _, fused_time = timed(lambda: [sample_logits(logits, temperature, top_k, top_p) for _ in range(args.steps)], device)
+
+    print(f"grouped single setting samplers {reference_time / args.steps * 1000:.2f}ms, "
+          f"fused sampler {fused_time / args.steps * 1000:.2f}ms ({reference_time / fused_time:.2f}x)")
+
+def benchmark_speculative(args):
+    device = torch.device(args.device)
+    model = build_random_lm(args, device)
+
+    # Random layers change the argmax of the LM completely. Scale down the residual outputs of the layers skipped by the draft,
+    # so the draft agrees with the LM on most tokens as a trained draft would
+    with torch.no_grad():
+        for layer in model.lm.backbone.model.layers[args.draft_depth:]:
+            ff_out = [module for module in layer.ff.modules() if isinstance(module, nn.Linear)][-1]
+            for output_layer in [layer.self_attn.to_out, layer.cross_attn.to_out, ff_out]:
+                output_layer.weight.mul_(args.skip_layer_scale)
+
+    # A layer-skip draft, the first layers of the LM with its embeddings and heads
+    draft_lm = copy.deepcopy(model.lm)
+    draft_lm.backbone.model.layers = draft_lm.backbone.model.layers[:args.draft_depth]
+
+    conditioning_tensors = random_conditioning(args, device)
+
+    def run(max_gen_len, speculative, **sampling_kwargs):
+        rounds = []
+        output = model.generate(
+            max_gen_len=max_gen_len,
+            conditioning_tensors=conditioning_tensors,
+            cfg_scale=args.cfg_scale,
+            draft_lm=draft_lm if speculative else None,
+            num_draft_steps=args.num_draft_steps,
+            callback=lambda step, num_steps: rounds.append(step),
+            **sampling_kwargs
+        )
+        return output, len(rounds)
+
+    # Warmup
+    run(8, False, temp=0)
+    run(8, True, temp=0)
+
+    print(f"Audio LM speculative decoding, {args.depth} layers, draft {args.draft_depth} layers, {args.num_draft_steps} draft steps, "
+          f"{args.num_quantizers} codebooks, batch {args.batch_size}, cfg scale {args.cfg_scale} on {device.type}")
+
+    for max_gen_len in args.gen_lengths:
+        for name, sampling_kwargs in [("greedy", {"temp": 0}), ("top-k 250", {"temp": 1.0, "top_k": 250})]:
+            (reference, num_steps), reference_time = timed(lambda: run(max_gen_len, False, **sampling_kwargs), device)
+            (output, num_rounds), speculative_time = timed(lambda: run(max_gen_len, True, **sampling_kwargs), device)
+
+            # Sampled tokens differ between runs, only greedy decoding can be compared token by token
+            identical = f", identical tokens: {(output == reference).float().mean().item() * 100:.2f}%" if name == "greedy" else ""
+
+            print(f"{max_gen_len} steps, {name}: "
+                  f"cached {args.batch_size * max_gen_len / reference_time:.1f} tokens/s, "
+                  f"speculative {args.batch_size * max_gen_len / speculative_time:.1f} tokens/s ({reference_time / speculative_time:.2f}x), "
+                  f"{num_steps / num_rounds:.2f} steps per LM pass{identical}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inference benchmarks for the audio language model")
+    parser.add_argument("benchmark", choices=["kv_cache", "decode_step", "patterns", "sampler", "speculative"])
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--embed-dim", type=int, default=512)
+    parser.add_argument("--depth", type=int, default=8)
+    parser.add_argument("--num-heads", type=int, default=8)
+    parser.add_argument("--num-quantizers", type=int, default=4)
+    parser.add_argument("--codebook-size", type=int, default=1024)
+    parser.add_argument("--cond-token-dim", type=int, default=128)
+    parser.add_argument("--cond-length", type=int, default=64)
+    parser.add_argument("--cfg-scale", type=float, default=3.0)
+    parser.add_argument("--gen-lengths", type=int, nargs="+", default=[128, 256, 512])
+    parser.add_argument("--compile-mode", type=str, default="reduce-overhead")
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--draft-depth", type=int, default=2)
+    parser.add_argument("--num-draft-steps", type=int, default=4)
+    parser.add_argument("--skip-layer-scale", type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.benchmark == "kv_cache":
+        benchmark_kv_cache(args)
+    elif args.benchmark == "decode_step":
+        benchmark_decode_step(args)
+    elif args.benchmark == "patterns":
+        benchmark_patterns(args)
+    elif args.benchmark == "sampler":
+        benchmark_sampler(args)
+    elif args.benchmark == "speculative":
+        benchmark_speculative(args)
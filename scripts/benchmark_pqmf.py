@@ -0,0 +1,71 @@
+import argparse
+import time
+import torch
+
+from stable_audio_tools.models.pqmf import PQMF
+
+def max_abs_diff(output, reference):
+    return (output.float() - reference.float()).abs().max().item()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares streaming PQMF analysis and synthesis to the offline transform, for parity and latency per block")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--channels", type=int, default=2)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--sample-rate", type=int, default=44100)
+    parser.add_argument("--attenuation", type=int, default=100)
+    parser.add_argument("--num-bands", type=int, default=16)
+    parser.add_argument("--block-sizes", type=int, nargs="+", default=[64, 256, 1000, 4096])
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+
+    start = time.perf_counter()
+    PQMF(args.attenuation, args.num_bands)
+    design_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pqmf = PQMF(args.attenuation, args.num_bands).to(device)
+    cached_design_time = time.perf_counter() - start
+
+    print(f"Filter design: {design_time * 1000:.1f}ms, cached: {cached_design_time * 1000:.1f}ms")
+
+    x = torch.randn([1, args.channels, int(args.seconds * args.sample_rate)], device=device)
+
+    with torch.no_grad():
+        bands = pqmf.forward(x)
+        reconstruction = pqmf.inverse(bands)
+
+        analysis = pqmf.get_streaming_analysis()
+        synthesis = pqmf.get_streaming_synthesis()
+
+        for block_size in args.block_sizes:
+            band_outputs, signal_outputs, block_times = [], [], []
+
+            for i in range(0, x.shape[-1], block_size):
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+
+                block_bands = analysis.step(x[..., i:i + block_size])
+                signal_outputs.append(synthesis.step(block_bands))
+
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+                block_times.append(time.perf_counter() - start)
+
+                band_outputs.append(block_bands)
+
+            block_bands = analysis.flush()
+            band_outputs.append(block_bands)
+            signal_outputs.append(synthesis.step(block_bands))
+            signal_outputs.append(synthesis.flush())
+
+            streamed_bands = torch.cat(band_outputs, dim=-1)
+            streamed_signal = torch.cat(signal_outputs, dim=-1)
+
+            block_ms = sum(block_times) / len(block_times) * 1000
+            real_time_ms = block_size / args.sample_rate * 1000
+
+            print(f"Block size {block_size}: {block_ms:.3f}ms per block ({real_time_ms / block_ms:.1f}x real time), "
+                  f"max abs diff: analysis {max_abs_diff(streamed_bands, bands):.3e}, synthesis {max_abs_diff(streamed_signal, reconstruction):.3e}")
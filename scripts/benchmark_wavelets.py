@@ -0,0 +1,61 @@
+import argparse
+import time
+import torch
+
+from stable_audio_tools.models.wavelets import WaveletDecode1d, WaveletEncode1d
+
+def timed(function, device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    output = function()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return output, time.perf_counter() - start
+
+def max_rel_diff(output, reference):
+    return ((output.float() - reference.float()).abs().max() / reference.float().abs().max()).item()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the fused wavelet transform to the level by level transform, for parity and speed")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--channels", type=int, default=2)
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--sample-rate", type=int, default=44100)
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 2, 3, 4, 5, 6, 7, 8])
+    parser.add_argument("--wavelets", type=str, nargs="+", default=["bior4.4"])
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+
+    for wavelet in args.wavelets:
+        for levels in args.levels:
+            stride = 2 ** levels
+            length = int(args.seconds * args.sample_rate) // stride * stride
+
+            x = torch.randn([args.batch_size, args.channels, length], device=device)
+
+            encoders = [WaveletEncode1d(args.channels, levels, wavelet, fused=fused).to(device) for fused in [False, True]]
+            decoders = [WaveletDecode1d(args.channels, levels, wavelet, fused=fused).to(device) for fused in [False, True]]
+
+            with torch.no_grad():
+                results = []
+                for encoder, decoder in zip(encoders, decoders):
+                    # Warmup
+                    decoder(encoder(x))
+
+                    encoded, encode_time = timed(lambda: encoder(x), device)
+                    decoded, decode_time = timed(lambda: decoder(encoded), device)
+                    results.append((encoded, decoded, encode_time, decode_time))
+
+                # Decode the same bands with both decoders, so the parity check only measures the decoder
+                reference_decoded = decoders[0](results[1][0])
+
+            (reference_encoded, _, reference_encode_time, reference_decode_time), (encoded, decoded, encode_time, decode_time) = results
+
+            print(f"{wavelet}, {levels} levels: "
+                  f"encode {reference_encode_time * 1000:.1f}ms -> {encode_time * 1000:.1f}ms ({reference_encode_time / encode_time:.2f}x), "
+                  f"decode {reference_decode_time * 1000:.1f}ms -> {decode_time * 1000:.1f}ms ({reference_decode_time / decode_time:.2f}x), "
+                  f"max relative diff: encode {max_rel_diff(encoded, reference_encoded):.3e}, decode {max_rel_diff(decoded, reference_decoded):.3e}, "
+                  f"reconstruction {max_rel_diff(decoded, x):.3e}")
@@ -0,0 +1,38 @@
+import argparse
+import json
+import torch
+
+from stable_audio_tools.models import create_model_from_config
+from stable_audio_tools.models.utils import load_ckpt_state_dict, save_inference_state_dict
+
+PRECISIONS = {"fp32": None, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exports an autoencoder checkpoint for inference, with weight norm folded and training-only modules removed")
+    parser.add_argument("--model-config", type=str, required=True, help="Path to the autoencoder model config")
+    parser.add_argument("--ckpt-path", type=str, required=True, help="Path to an unwrapped autoencoder checkpoint, or a training checkpoint")
+    parser.add_argument("--output", type=str, required=True, help="Path of the exported .safetensors file")
+    parser.add_argument("--precision", type=str, default="fp16", choices=list(PRECISIONS.keys()))
+    parser.add_argument("--decoder-only", action="store_true", help="Leave out the encoder, for pretransforms that only decode generated latents")
+    args = parser.parse_args()
+
+    with open(args.model_config) as f:
+        model_config = json.load(f)
+
+    assert model_config.get("model_type", None) == "autoencoder", "Only autoencoder models can be exported"
+
+    model = create_model_from_config(model_config)
+
+    state_dict = load_ckpt_state_dict(args.ckpt_path)
+
+    # Training checkpoints also hold the discriminator, loss modules and the EMA copy, only keep the autoencoder weights
+    if any(key.startswith("autoencoder.") for key in state_dict):
+        state_dict = {key[len("autoencoder."):]: value for key, value in state_dict.items() if key.startswith("autoencoder.")}
+
+    model.load_state_dict(state_dict)
+
+    model.prepare_for_inference()
+
+    save_inference_state_dict(model, args.output, dtype=PRECISIONS[args.precision], exclude_prefixes=["encoder."] if args.decoder_only else [])
+
+    print(f"Saved {args.output}")
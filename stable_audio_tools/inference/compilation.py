@@ -0,0 +1,88 @@
+import torch
+import torch._dynamo
+import torch._inductor.config
+import typing as tp
+
+from .generation import generate_diffusion_cond
+
+def compile_diffusion_cond(model, persistent_cache: bool = True, **compile_kwargs):
+    """
+    Enables the compiled inference graph for a conditioned diffusion transformer.
+    Conditioning is prepared once per generation (see DiTWrapper.bind_conditioning), the per-step denoiser is compiled with static shapes.
+
+    Args:
+        model: A ConditionedDiffusionModelWrapper with a DiT backbone.
+        persistent_cache: Whether to keep the compiled kernels in the on-disk Inductor cache, so restarting the process skips most of the compile time.
+        **compile_kwargs: Additional keyword arguments for torch.compile, e.g. mode="max-autotune".
+    """
+    assert hasattr(model.model, "bind_conditioning"), "Compiled inference is only supported for DiT models"
+
+    if persistent_cache and hasattr(torch._inductor.config, "fx_graph_cache"):
+        torch._inductor.config.fx_graph_cache = True
+
+    model.model.model.compile_inference(**compile_kwargs)
+
+    return model
+
+def compile_lm(model, persistent_cache: bool = True, mode: str = "reduce-overhead", **compile_kwargs):
+    """
+    Compiles the per-token decode step of an audio language model, see AudioLanguageModelWrapper.compile_inference.
+    The first step of every generation fills the generation cache and runs eagerly, the following steps run the compiled step.
+
+    Args:
+        model: An AudioLanguageModelWrapper with a backbone that supports the generation cache.
+        persistent_cache: Whether to keep the compiled kernels in the on-disk Inductor cache, so restarting the process skips most of the compile time.
+        mode: The torch.compile mode. "reduce-overhead" replays the step as a CUDA graph on CUDA devices.
+        **compile_kwargs: Additional keyword arguments for torch.compile.
+    """
+    assert model.lm.backbone.use_generation_cache, "Compiled decoding needs a backbone with the generation cache"
+
+    if persistent_cache and hasattr(torch._inductor.config, "fx_graph_cache"):
+        torch._inductor.config.fx_graph_cache = True
+
+    model.compile_inference(mode=mode, **compile_kwargs)
+
+    return model
+
+def warmup_diffusion_cond(
+        model,
+        conditioning: dict,
+        sample_sizes: tp.List[int],
+        batch_sizes: tp.List[int] = [1],
+        cfg_scale: float = 6.0,
+        steps: int = 2,
+        device: str = "cuda",
+        **sampler_kwargs
+    ):
+    """
+    Runs a short generation for every (batch size, sample size) bucket, so the compiled graphs exist before the first real request.
+    Generation requests at other shapes still work, but compile on first use.
+
+    Args:
+        model: The compiled model, see compile_diffusion_cond.
+        conditioning: The conditioning of a single example, e.g. {"prompt": "", "seconds_start": 0, "seconds_total": 30}.
+        sample_sizes: The audio lengths (in samples) to compile for.
+        batch_sizes: The batch sizes to compile for.
+        cfg_scale: Classifier-free guidance doubles the batch of the denoiser, so warm up with the scale used at inference.
+        steps: The number of sampling steps of each warmup generation.
+        **sampler_kwargs: Additional keyword arguments for generate_diffusion_cond.
+    """
+
+    # Every bucket is a separate specialization of the same compiled function, make sure none of them get evicted
+    num_buckets = len(sample_sizes) * len(batch_sizes)
+    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 2 * num_buckets)
+
+    for batch_size in batch_sizes:
+        for sample_size in sample_sizes:
+            generate_diffusion_cond(
+                model,
+                steps=steps,
+                cfg_scale=cfg_scale,
+                conditioning=[conditioning] * batch_size,
+                batch_size=batch_size,
+                sample_size=sample_size,
+                seed=0,
+                device=device,
+                return_latents=True,
+                **sampler_kwargs
+            )
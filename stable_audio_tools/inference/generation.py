@@ -4,6 +4,7 @@ import typing as tp
 import math 
 from torchaudio import transforms as T
 
+from .profiles import get_inference_profile
 from .utils import prepare_audio
 from .sampling import sample, sample_k, sample_rf
 from ..data.utils import PadCrop
@@ -21,6 +22,9 @@ def generate_diffusion_uncond(
         **sampler_kwargs
         ) -> torch.Tensor:
     
+    # Precision and performance settings are applied once at model load, see inference/profiles.py
+    inference_profile = get_inference_profile(model)
+
     # The length of the output in audio samples 
     audio_sample_size = sample_size
 
@@ -31,7 +35,8 @@ def generate_diffusion_uncond(
     # Seed
     # The user can explicitly set the seed to deterministically generate the same output. Otherwise, use a random seed.
     seed = seed if seed != -1 else np.random.randint(0, 2**32 - 1, dtype=np.uint32)
-    print(seed)
+    if inference_profile.verbose:
+        print(seed)
     torch.manual_seed(seed)
     # Define the initial noise immediately after setting the seed
     noise = torch.randn([batch_size, model.io_channels, sample_size], device=device)
@@ -74,9 +79,9 @@ def generate_diffusion_uncond(
 
     if diff_objective == "v":    
         # k-diffusion denoising process go!
-        sampled = sample_k(model.model, noise, init_audio, mask, steps, **sampler_kwargs, device=device)
+        sampled = sample_k(model.model, noise, init_audio, mask, steps, **sampler_kwargs, progress=inference_profile.progress, autocast_dtype=inference_profile.autocast_dtype, device=device)
     elif diff_objective == "rectified_flow":
-        sampled = sample_rf(model.model, noise, init_data=init_audio, steps=steps, **sampler_kwargs, device=device)
+        sampled = sample_rf(model.model, noise, init_data=init_audio, steps=steps, **sampler_kwargs, progress=inference_profile.progress, autocast_dtype=inference_profile.autocast_dtype, device=device)
 
     # Denoising process done. 
     # If this is latent diffusion, decode latents back into audio
@@ -126,6 +131,9 @@ def generate_diffusion_cond(
         **sampler_kwargs: Additional keyword arguments to pass to the sampler.    
     """
 
+    # Precision and performance settings are applied once at model load, see inference/profiles.py
+    inference_profile = get_inference_profile(model)
+
     # The length of the output in audio samples 
     audio_sample_size = sample_size
 
@@ -136,16 +144,12 @@ def generate_diffusion_cond(
     # Seed
     # The user can explicitly set the seed to deterministically generate the same output. Otherwise, use a random seed.
     seed = seed if seed != -1 else np.random.randint(0, 2**32 - 1, dtype=np.uint32)
-    print(seed)
+    if inference_profile.verbose:
+        print(seed)
     torch.manual_seed(seed)
     # Define the initial noise immediately after setting the seed
     noise = torch.randn([batch_size, model.io_channels, sample_size], device=device)
 
-    torch.backends.cuda.matmul.allow_tf32 = False
-    torch.backends.cudnn.allow_tf32 = False
-    torch.backends.cuda.matmul.allow_fp16_reduced_precision_reduction = False
-    torch.backends.cudnn.benchmark = False
-
     # Conditioning
     assert conditioning is not None or conditioning_tensors is not None, "Must provide either conditioning or conditioning_tensors"
     if conditioning_tensors is None:
@@ -220,9 +224,19 @@ def generate_diffusion_cond(
 
     diff_objective = model.diffusion_objective
 
+    if hasattr(model.model, "bind_conditioning"):
+        # Prepare the conditioning once, the sampler then only passes (x, t) to the denoiser at every step
+        # Use the same autocast as the sampler loop, so the projections match the per-step computation
+        with torch.cuda.amp.autocast(enabled=inference_profile.autocast_dtype is not None, dtype=inference_profile.autocast_dtype):
+            model_fn = model.model.bind_conditioning(**conditioning_inputs, **negative_conditioning_tensors, cfg_scale=cfg_scale, batch_cfg=True, rescale_cfg=True)
+        model_args = {}
+    else:
+        model_fn = model.model
+        model_args = dict(**conditioning_inputs, **negative_conditioning_tensors, cfg_scale=cfg_scale, batch_cfg=True, rescale_cfg=True)
+
     if diff_objective == "v":    
         # k-diffusion denoising process go!
-        sampled = sample_k(model.model, noise, init_audio, mask, steps, **sampler_kwargs, **conditioning_inputs, **negative_conditioning_tensors, cfg_scale=cfg_scale, batch_cfg=True, rescale_cfg=True, device=device)
+        sampled = sample_k(model_fn, noise, init_audio, mask, steps, **sampler_kwargs, **model_args, progress=inference_profile.progress, autocast_dtype=inference_profile.autocast_dtype, device=device)
     elif diff_objective == "rectified_flow":
 
         if "sigma_min" in sampler_kwargs:
@@ -231,19 +245,20 @@ def generate_diffusion_cond(
         if "sampler_type" in sampler_kwargs:
             del sampler_kwargs["sampler_type"]
 
-        sampled = sample_rf(model.model, noise, init_data=init_audio, steps=steps, **sampler_kwargs, **conditioning_inputs, **negative_conditioning_tensors, cfg_scale=cfg_scale, batch_cfg=True, rescale_cfg=True, device=device)
+        sampled = sample_rf(model_fn, noise, init_data=init_audio, steps=steps, **sampler_kwargs, **model_args, progress=inference_profile.progress, autocast_dtype=inference_profile.autocast_dtype, device=device)
 
     # v-diffusion: 
     #sampled = sample(model.model, noise, steps, 0, **conditioning_tensors, embedding_scale=cfg_scale)
     del noise
     del conditioning_tensors
     del conditioning_inputs
-    torch.cuda.empty_cache()
+    del model_fn, model_args
+    if inference_profile.empty_cache:
+        torch.cuda.empty_cache()
     # Denoising process done. 
     # If this is latent diffusion, decode latents back into audio
     if model.pretransform is not None and not return_latents:
-        #cast sampled latents to pretransform dtype
-        sampled = sampled.to(next(model.pretransform.parameters()).dtype)
+        # The autoencoder pretransform casts the latents to its own precision
         sampled = model.pretransform.decode(sampled)
 
     # Return audio
@@ -0,0 +1,83 @@
+import torch
+import typing as tp
+
+from dataclasses import dataclass
+
+from ..models.utils import remove_weight_norm_from_model
+
+@dataclass
+class InferenceProfile:
+    """
+    Precision and performance settings for inference.
+    The profile is applied once when the model is loaded (see apply_inference_profile), instead of mutating global backend flags on every generation call.
+    """
+    # "fp32" runs matmuls and convolutions in full precision, "tf32" allows TF32 tensor cores on Ampere and newer GPUs, neither autocasts the samplers.
+    # "fp16" and "bf16" also cast the model weights and set the autocast dtype of the samplers.
+    # None keeps the behaviour from before profiles: full precision weights and matmuls, with the samplers under fp16 autocast
+    precision: tp.Optional[tp.Literal["fp32", "tf32", "fp16", "bf16"]] = None
+    # Let cuDNN autotune the convolution algorithms, which pays off when input shapes repeat between calls
+    cudnn_benchmark: bool = False
+    # Fold the weight norm of the pretransform into plain weights, so it isn't recomputed on every decode
+    fold_weight_norm: bool = True
+    # Flush the CUDA caching allocator after every generation
+    empty_cache: bool = False
+    # Precision of the autoencoder pretransform ("fp32", "fp16" or "bf16"), kept when the rest of the model is cast. None follows the model precision
+    pretransform_precision: tp.Optional[tp.Literal["fp32", "fp16", "bf16"]] = None
+    # Show a progress bar in the sampler loops
+    progress: bool = True
+    # Print the seed of every generation
+    verbose: bool = False
+
+    def __post_init__(self):
+        assert self.precision in [None, "fp32", "tf32", "fp16", "bf16"], f"Unknown inference precision {self.precision}"
+
+    @property
+    def model_dtype(self) -> tp.Optional[torch.dtype]:
+        if self.precision == "fp16":
+            return torch.float16
+        elif self.precision == "bf16":
+            return torch.bfloat16
+
+        return None
+
+    @property
+    def autocast_dtype(self) -> tp.Optional[torch.dtype]:
+        # None disables autocast, so "fp32" and "tf32" run the samplers in the precision of the weights
+        if self.precision is None:
+            return torch.float16
+
+        return self.model_dtype
+
+def apply_inference_profile(model: torch.nn.Module, profile: InferenceProfile):
+    """
+    Sets the backend flags for the given profile, folds the weight norm of the pretransform, casts the model weights if needed, and attaches the profile to the model
+    so the generation functions can pick it up.
+    """
+    allow_tf32 = profile.precision not in [None, "fp32"]
+
+    torch.backends.cuda.matmul.allow_tf32 = allow_tf32
+    torch.backends.cudnn.allow_tf32 = allow_tf32
+    torch.backends.cuda.matmul.allow_fp16_reduced_precision_reduction = profile.precision == "fp16"
+    torch.backends.cudnn.benchmark = profile.cudnn_benchmark
+
+    pretransform = getattr(model, "pretransform", None)
+
+    # Folded in full precision, before the weights are cast
+    if profile.fold_weight_norm and pretransform is not None:
+        remove_weight_norm_from_model(pretransform)
+
+    if profile.pretransform_precision is not None and hasattr(pretransform, "set_precision"):
+        pretransform.set_precision(profile.pretransform_precision)
+
+    if profile.model_dtype is not None:
+        model.to(profile.model_dtype)
+
+    model.inference_profile = profile
+
+    return model
+
+def get_inference_profile(model: torch.nn.Module) -> InferenceProfile:
+    """
+    Returns the profile applied to the model, or the default profile if none was applied
+    """
+    return getattr(model, "inference_profile", None) or InferenceProfile()
@@ -22,7 +22,7 @@ def t_to_alpha_sigma(t):
 
 
 @torch.no_grad()
-def sample_discrete_euler(model, x, steps, sigma_max=1, **extra_args):
+def sample_discrete_euler(model, x, steps, sigma_max=1, progress=True, **extra_args):
     """Draws samples from a model given starting noise. Euler method"""
 
     # Make tensor of ones to broadcast the single t values
@@ -33,7 +33,7 @@ def sample_discrete_euler(model, x, steps, sigma_max=1, **extra_args):
 
     #alphas, sigmas = 1-t, t
 
-    for t_curr, t_prev in tqdm(zip(t[:-1], t[1:])):
+    for t_curr, t_prev in tqdm(zip(t[:-1], t[1:]), total=steps, disable=not progress):
             # Broadcast the current timestep to the correct shape
             t_curr_tensor = t_curr * torch.ones(
                 (x.shape[0],), dtype=x.dtype, device=x.device
@@ -120,11 +120,19 @@ def sample_k(
         rho=1.0, device="cuda", 
         callback=None, 
         cond_fn=None,
+        feature_cache=None,
+        progress=True,
+        autocast_dtype=torch.float16,
         **extra_args
     ):
 
     denoiser = K.external.VDenoiser(model_fn)
 
+    if feature_cache is not None:
+        # Start every generation from an empty cache, the schedule is indexed by model evaluation
+        feature_cache.reset()
+        extra_args["feature_cache"] = feature_cache
+
     if cond_fn is not None:
         denoiser = make_cond_model_fn(denoiser, cond_fn)
 
@@ -174,23 +182,23 @@ def sample_k(
         x = noise
 
 
-    with torch.cuda.amp.autocast():
+    with torch.cuda.amp.autocast(enabled=autocast_dtype is not None, dtype=autocast_dtype):
         if sampler_type == "k-heun":
-            return K.sampling.sample_heun(denoiser, x, sigmas, disable=False, callback=wrapped_callback, extra_args=extra_args)
+            return K.sampling.sample_heun(denoiser, x, sigmas, disable=not progress, callback=wrapped_callback, extra_args=extra_args)
         elif sampler_type == "k-lms":
-            return K.sampling.sample_lms(denoiser, x, sigmas, disable=False, callback=wrapped_callback, extra_args=extra_args)
+            return K.sampling.sample_lms(denoiser, x, sigmas, disable=not progress, callback=wrapped_callback, extra_args=extra_args)
         elif sampler_type == "k-dpmpp-2s-ancestral":
-            return K.sampling.sample_dpmpp_2s_ancestral(denoiser, x, sigmas, disable=False, callback=wrapped_callback, extra_args=extra_args)
+            return K.sampling.sample_dpmpp_2s_ancestral(denoiser, x, sigmas, disable=not progress, callback=wrapped_callback, extra_args=extra_args)
         elif sampler_type == "k-dpm-2":
-            return K.sampling.sample_dpm_2(denoiser, x, sigmas, disable=False, callback=wrapped_callback, extra_args=extra_args)
+            return K.sampling.sample_dpm_2(denoiser, x, sigmas, disable=not progress, callback=wrapped_callback, extra_args=extra_args)
         elif sampler_type == "k-dpm-fast":
-            return K.sampling.sample_dpm_fast(denoiser, x, sigma_min, sigma_max, steps, disable=False, callback=wrapped_callback, extra_args=extra_args)
+            return K.sampling.sample_dpm_fast(denoiser, x, sigma_min, sigma_max, steps, disable=not progress, callback=wrapped_callback, extra_args=extra_args)
         elif sampler_type == "k-dpm-adaptive":
-            return K.sampling.sample_dpm_adaptive(denoiser, x, sigma_min, sigma_max, rtol=0.01, atol=0.01, disable=False, callback=wrapped_callback, extra_args=extra_args)
+            return K.sampling.sample_dpm_adaptive(denoiser, x, sigma_min, sigma_max, rtol=0.01, atol=0.01, disable=not progress, callback=wrapped_callback, extra_args=extra_args)
         elif sampler_type == "dpmpp-2m-sde":
-            return K.sampling.sample_dpmpp_2m_sde(denoiser, x, sigmas, disable=False, callback=wrapped_callback, extra_args=extra_args)
+            return K.sampling.sample_dpmpp_2m_sde(denoiser, x, sigmas, disable=not progress, callback=wrapped_callback, extra_args=extra_args)
         elif sampler_type == "dpmpp-3m-sde":
-            return K.sampling.sample_dpmpp_3m_sde(denoiser, x, sigmas, disable=False, callback=wrapped_callback, extra_args=extra_args)
+            return K.sampling.sample_dpmpp_3m_sde(denoiser, x, sigmas, disable=not progress, callback=wrapped_callback, extra_args=extra_args)
 
 # Uses discrete Euler sampling for rectified flow models
 # init_data is init_audio as latents (if this is latent diffusion)
@@ -206,12 +214,20 @@ def sample_rf(
         device="cuda", 
         callback=None, 
         cond_fn=None,
+        feature_cache=None,
+        progress=True,
+        autocast_dtype=torch.float16,
         **extra_args
     ):
 
     if sigma_max > 1:
         sigma_max = 1
 
+    if feature_cache is not None:
+        # Start every generation from an empty cache, the schedule is indexed by model evaluation
+        feature_cache.reset()
+        extra_args["feature_cache"] = feature_cache
+
     if cond_fn is not None:
         denoiser = make_cond_model_fn(denoiser, cond_fn)
 
@@ -226,7 +242,7 @@ def sample_rf(
         # set the initial latent to noise
         x = noise
 
-    with torch.cuda.amp.autocast():
+    with torch.cuda.amp.autocast(enabled=autocast_dtype is not None, dtype=autocast_dtype):
         # TODO: Add callback support
         #return sample_discrete_euler(model_fn, x, steps, sigma_max, callback=wrapped_callback, **extra_args)
-        return sample_discrete_euler(model_fn, x, steps, sigma_max, **extra_args)
\ No newline at end of file
+        return sample_discrete_euler(model_fn, x, steps, sigma_max, progress=progress, **extra_args)
\ No newline at end of file
@@ -1,7 +1,15 @@
 from ..data.utils import PadCrop
 
+from functools import lru_cache
 from torchaudio import transforms as T
 
+@lru_cache(maxsize=None)
+def get_resample_transform(in_sr, target_sr, device):
+    """
+    Returns a resampling transform whose filter kernel is only computed once per sample rate pair and device
+    """
+    return T.Resample(in_sr, target_sr).to(device)
+
 def set_audio_channels(audio, target_channels):
     if target_channels == 1:
         # Convert to mono
@@ -19,8 +27,7 @@ def prepare_audio(audio, in_sr, target_sr, target_length, target_channels, devic
     audio = audio.to(device)
 
     if in_sr != target_sr:
-        resample_tf = T.Resample(in_sr, target_sr).to(device)
-        audio = resample_tf(audio)
+        audio = get_resample_transform(in_sr, target_sr, device)(audio)
 
     audio = PadCrop(target_length, randomize=False)(audio)
 
@@ -11,7 +11,9 @@ from safetensors.torch import load_file
 from torch.nn import functional as F
 from torchaudio import transforms as T
 
+from ..inference.compilation import compile_diffusion_cond, warmup_diffusion_cond
 from ..inference.generation import generate_diffusion_cond, generate_diffusion_uncond
+from ..inference.profiles import InferenceProfile, apply_inference_profile
 from ..models.factory import create_model_from_config
 from ..models.pretrained import get_pretrained_model
 from ..models.utils import load_ckpt_state_dict
@@ -22,7 +24,7 @@ model = None
 sample_rate = 32000
 sample_size = 1920000
 
-def load_model(model_config=None, model_ckpt_path=None, pretrained_name=None, pretransform_ckpt_path=None, device="cuda", model_half=False):
+def load_model(model_config=None, model_ckpt_path=None, pretrained_name=None, pretransform_ckpt_path=None, device="cuda", model_half=False, inference_profile=None, compile_model=False):
     global model, sample_rate, sample_size
     
     if pretrained_name is not None:
@@ -48,8 +50,17 @@ def load_model(model_config=None, model_ckpt_path=None, pretrained_name=None, pr
 
     model.to(device).eval().requires_grad_(False)
 
-    if model_half:
-        model.to(torch.float16)
+    if inference_profile is None:
+        inference_profile = InferenceProfile(precision="fp16" if model_half else None)
+
+    # Backend flags and weight casting are applied once here rather than on every generation
+    apply_inference_profile(model, inference_profile)
+
+    if compile_model and model_config["model_type"] == "diffusion_cond":
+        print("Compiling model")
+        compile_diffusion_cond(model)
+        # Compile for the default length so the first request doesn't pay the compile time
+        warmup_diffusion_cond(model, {"prompt": "", "seconds_start": 0, "seconds_total": sample_size / sample_rate}, [sample_size], device=device)
         
     print(f"Done loading model")
 
@@ -538,9 +549,9 @@ def autoencoder_process(audio, latent_noise, n_quantizers):
 
     audio = model.preprocess_audio_for_encoder(audio, in_sr)
     # Note: If you need to do chunked encoding, to reduce VRAM, 
-    # then add these arguments to encode_audio and decode_audio: chunked=True, overlap=32, chunk_size=128
+    # then add these arguments to encode_audio and decode_audio: chunked=True, chunk_size=128
     # To turn it off, do chunked=False
-    # Optimal overlap and chunk_size values will depend on the model. 
+    # The overlap is derived from the model's receptive field, the optimal chunk_size value will depend on the model. 
     # See encode_audio & decode_audio in autoencoders.py for more info
     # Get dtype of model
     dtype = next(model.parameters()).dtype
@@ -654,7 +665,7 @@ def create_lm_ui(model_config):
 
     return ui
 
-def create_ui(model_config_path=None, ckpt_path=None, pretrained_name=None, pretransform_ckpt_path=None, model_half=False):
+def create_ui(model_config_path=None, ckpt_path=None, pretrained_name=None, pretransform_ckpt_path=None, model_half=False, inference_profile=None, compile_model=False):
 
     assert (pretrained_name is not None) ^ (model_config_path is not None and ckpt_path is not None), "Must specify either pretrained name or provide a model config and checkpoint, but not both"
 
@@ -666,7 +677,7 @@ def create_ui(model_config_path=None, ckpt_path=None, pretrained_name=None, pret
         model_config = None
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    _, model_config = load_model(model_config, ckpt_path, pretrained_name=pretrained_name, pretransform_ckpt_path=pretransform_ckpt_path, model_half=model_half, device=device)
+    _, model_config = load_model(model_config, ckpt_path, pretrained_name=pretrained_name, pretransform_ckpt_path=pretransform_ckpt_path, model_half=model_half, inference_profile=inference_profile, compile_model=compile_model, device=device)
     
     model_type = model_config["model_type"]
 
@@ -4,23 +4,144 @@ import numpy as np
 
 from torch import nn
 from torch.nn import functional as F
-from torchaudio import transforms as T
 from alias_free_torch import Activation1d
 from dac.nn.layers import WNConv1d, WNConvTranspose1d
-from typing import Literal, Dict, Any
+from typing import Literal, Dict, Any, Union
 
 from ..inference.sampling import sample
-from ..inference.utils import prepare_audio
+from ..inference.utils import get_resample_transform, set_audio_channels
 from .blocks import SnakeBeta
 from .bottleneck import Bottleneck, DiscreteBottleneck
 from .diffusion import ConditionedDiffusionModel, DAU1DCondWrapper, UNet1DCondWrapper, DiTWrapper
 from .factory import create_pretransform_from_config, create_bottleneck_from_config
 from .pretransforms import Pretransform
+from .utils import remove_weight_norm_from_model
 
 def checkpoint(function, *args, **kwargs):
     kwargs.setdefault("use_reentrant", False)
     return torch.utils.checkpoint.checkpoint(function, *args, **kwargs)
 
+def estimate_chunk_batch_size(function, chunk, memory_fraction=0.8):
+    """
+    Estimates how many chunks fit through function at once by measuring the peak memory of a single chunk against the free device memory.
+    Also returns the output for the measured chunk, so the measurement isn't wasted. Devices without memory statistics get a batch size of 1.
+    """
+    device = chunk.device
+
+    if device.type != "cuda":
+        return 1, function(chunk)
+
+    torch.cuda.synchronize(device)
+    allocated = torch.cuda.memory_allocated(device)
+    torch.cuda.reset_peak_memory_stats(device)
+
+    output = function(chunk)
+
+    chunk_memory = torch.cuda.max_memory_allocated(device) - allocated
+
+    # Memory cached by the allocator but not in use is available as well
+    free_memory = torch.cuda.mem_get_info(device)[0] + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+
+    return max(1, int(free_memory * memory_fraction // max(chunk_memory, 1))), output
+
+def iterate_chunk_batches(function, chunks, chunk_batch_size: Union[int, Literal["auto"]] = 1):
+    """
+    Runs function over chunks of shape (num_chunks, batch, channels, length), chunk_batch_size chunks at a time.
+    Yields the output of every chunk in order. With "auto", the chunk batch size is chosen from the available device memory.
+    """
+    num_chunks, batch_size = chunks.shape[:2]
+
+    start = 0
+
+    if chunk_batch_size == "auto":
+        chunk_batch_size, output = estimate_chunk_batch_size(function, chunks[0])
+        yield output
+        start = 1
+
+    for i in range(start, num_chunks, chunk_batch_size):
+        chunk_batch = chunks[i:i+chunk_batch_size]
+        outputs = function(chunk_batch.reshape(-1, *chunk_batch.shape[2:]))
+        yield from outputs.reshape(chunk_batch.shape[0], batch_size, *outputs.shape[1:])
+
+def iterate_microbatches(function, x, microbatch_size: Union[int, Literal["auto"]]):
+    """
+    Runs function over microbatches of x along the batch dimension and yields the output of every microbatch.
+    With "auto", the microbatch size is chosen from the available device memory after running the first example.
+    """
+    start = 0
+
+    if microbatch_size == "auto":
+        microbatch_size, output = estimate_chunk_batch_size(function, x[:1])
+        yield output
+        start = 1
+
+    for i in range(start, x.shape[0], microbatch_size):
+        yield function(x[i:i+microbatch_size])
+
+def merge_microbatch_info(infos, sizes):
+    """
+    Merges the bottleneck info dicts of consecutive microbatches of the given sizes.
+    Per-example tensors are concatenated along the batch dimension, other tensors and numbers (e.g. losses averaged over the batch) are averaged, weighted by the microbatch sizes.
+    """
+    if len(infos) == 1:
+        return infos[0]
+
+    batch_size = sum(sizes)
+
+    info = {}
+
+    for key in infos[0]:
+        values = [microbatch_info[key] for microbatch_info in infos]
+
+        if torch.is_tensor(values[0]) and values[0].dim() > 0 and all(value.shape[0] == size for value, size in zip(values, sizes)):
+            info[key] = torch.cat(values, dim=0)
+        elif torch.is_tensor(values[0]) or isinstance(values[0], (int, float)):
+            info[key] = sum(value * size for value, size in zip(values, sizes)) / batch_size
+        else:
+            info[key] = values
+
+    return info
+
+def get_latent_context(module: nn.Module) -> int:
+    """
+    Returns the number of latents on each side of an output frame that a stack of 1d convolutions looks at, from the kernel sizes, dilations and strides of its layers.
+    Works on encoders (strided convolutions) and decoders (transposed convolutions or nearest upsampling), assuming the layers are registered in execution order.
+    Pointwise layers don't add context, the anti-aliasing filters of Activation1d and nested pretransforms are not accounted for.
+    """
+    # Encoders start at the audio resolution and downsample with strided convolutions, decoders start at the latent resolution
+    frames_per_latent = math.prod(layer.stride[0] for layer in module.modules() if isinstance(layer, nn.Conv1d))
+
+    context = 0
+
+    for layer in module.modules():
+        if isinstance(layer, nn.Conv1d):
+            context += (layer.kernel_size[0] - 1) * layer.dilation[0] / 2 / frames_per_latent
+            frames_per_latent /= layer.stride[0]
+        elif isinstance(layer, nn.ConvTranspose1d):
+            # Every output frame depends on ceil(kernel_size / stride) input frames
+            context += math.ceil(layer.kernel_size[0] / layer.stride[0]) / 2 / frames_per_latent
+            frames_per_latent *= layer.stride[0]
+        elif isinstance(layer, nn.Upsample):
+            frames_per_latent *= layer.scale_factor
+
+    return math.ceil(context)
+
+def get_crossfade_window(length, fade_in, fade_out, device):
+    """
+    A window of ones with raised-cosine fades at either end. The fade-out of one chunk and the fade-in of the next sum to one where they overlap.
+    """
+    window = torch.ones(length, device=device)
+
+    if fade_in > 0:
+        fade_in = min(fade_in, length)
+        window[:fade_in] = torch.sin(0.5 * math.pi * (torch.arange(fade_in, device=device) + 0.5) / fade_in) ** 2
+
+    if fade_out > 0:
+        fade_out = min(fade_out, length)
+        window[-fade_out:] *= torch.cos(0.5 * math.pi * (torch.arange(fade_out, device=device) + 0.5) / fade_out) ** 2
+
+    return window
+
 def get_activation(activation: Literal["elu", "snake", "none"], antialias=False, channels=None) -> nn.Module:
     if activation == "elu":
         act = nn.ELU()
@@ -272,42 +393,42 @@ class AudioAutoencoder(nn.Module):
  
         self.is_discrete = self.bottleneck is not None and self.bottleneck.is_discrete
 
-    def encode(self, audio, return_info=False, skip_pretransform=False, iterate_batch=False, **kwargs):
+    def encode(self, audio, return_info=False, skip_pretransform=False, iterate_batch=False, microbatch_size=None, **kwargs):
+        '''
+        Encodes audio through the pretransform, encoder and bottleneck.
+        microbatch_size examples go through at a time, which trades throughput for memory. None encodes the whole batch at once,
+        and "auto" chooses the size from the free device memory after encoding the first example. iterate_batch=True is the same as microbatch_size=1.
+        The bottleneck info of the microbatches is merged, see merge_microbatch_info.
+        '''
+        if iterate_batch and microbatch_size is None:
+            microbatch_size = 1
+
+        if microbatch_size is None or (microbatch_size != "auto" and microbatch_size >= audio.shape[0]):
+            return self.encode_batch(audio, return_info=return_info, skip_pretransform=skip_pretransform, **kwargs)
+
+        outputs = list(iterate_microbatches(lambda x: self.encode_batch(x, return_info=True, skip_pretransform=skip_pretransform, **kwargs), audio, microbatch_size))
+
+        latents = torch.cat([latents for latents, _ in outputs], dim=0)
+
+        if return_info:
+            return latents, merge_microbatch_info([info for _, info in outputs], [latents.shape[0] for latents, _ in outputs])
+
+        return latents
+
+    def encode_batch(self, audio, return_info=False, skip_pretransform=False, **kwargs):
 
         info = {}
 
         if self.pretransform is not None and not skip_pretransform:
-            if self.pretransform.enable_grad:
-                if iterate_batch:
-                    audios = []
-                    for i in range(audio.shape[0]):
-                        audios.append(self.pretransform.encode(audio[i:i+1]))
-                    audio = torch.cat(audios, dim=0)
-                else:
-                    audio = self.pretransform.encode(audio)
-            else:
-                with torch.no_grad():
-                    if iterate_batch:
-                        audios = []
-                        for i in range(audio.shape[0]):
-                            audios.append(self.pretransform.encode(audio[i:i+1]))
-                        audio = torch.cat(audios, dim=0)
-                    else:
-                        audio = self.pretransform.encode(audio)
+            with torch.set_grad_enabled(self.pretransform.enable_grad and torch.is_grad_enabled()):
+                audio = self.pretransform.encode(audio)
 
         if self.encoder is not None:
-            if iterate_batch:
-                latents = []
-                for i in range(audio.shape[0]):
-                    latents.append(self.encoder(audio[i:i+1]))
-                latents = torch.cat(latents, dim=0)
-            else:
-                latents = self.encoder(audio)
+            latents = self.encoder(audio)
         else:
             latents = audio
 
         if self.bottleneck is not None:
-            # TODO: Add iterate batch logic, needs to merge the info dicts
             latents, bottleneck_info = self.bottleneck.encode(latents, return_info=True, **kwargs)
 
             info.update(bottleneck_info)
@@ -317,43 +438,29 @@ class AudioAutoencoder(nn.Module):
 
         return latents
 
-    def decode(self, latents, iterate_batch=False, **kwargs):
+    def decode(self, latents, iterate_batch=False, microbatch_size=None, **kwargs):
+        '''
+        Decodes latents through the bottleneck, decoder and pretransform.
+        microbatch_size examples go through at a time, with the same options as encode.
+        '''
+        if iterate_batch and microbatch_size is None:
+            microbatch_size = 1
+
+        if microbatch_size is None or (microbatch_size != "auto" and microbatch_size >= latents.shape[0]):
+            return self.decode_batch(latents, **kwargs)
+
+        return torch.cat(list(iterate_microbatches(lambda x: self.decode_batch(x, **kwargs), latents, microbatch_size)), dim=0)
+
+    def decode_batch(self, latents, **kwargs):
 
         if self.bottleneck is not None:
-            if iterate_batch:
-                decoded = []
-                for i in range(latents.shape[0]):
-                    decoded.append(self.bottleneck.decode(latents[i:i+1]))
-                decoded = torch.cat(decoded, dim=0)
-            else:
-                latents = self.bottleneck.decode(latents)
+            latents = self.bottleneck.decode(latents)
 
-        if iterate_batch:
-            decoded = []
-            for i in range(latents.shape[0]):
-                decoded.append(self.decoder(latents[i:i+1]))
-            decoded = torch.cat(decoded, dim=0)
-        else:
-            decoded = self.decoder(latents, **kwargs)
+        decoded = self.decoder(latents, **kwargs)
 
         if self.pretransform is not None:
-            if self.pretransform.enable_grad:
-                if iterate_batch:
-                    decodeds = []
-                    for i in range(decoded.shape[0]):
-                        decodeds.append(self.pretransform.decode(decoded[i:i+1]))
-                    decoded = torch.cat(decodeds, dim=0)
-                else:
-                    decoded = self.pretransform.decode(decoded)
-            else:
-                with torch.no_grad():
-                    if iterate_batch:
-                        decodeds = []
-                        for i in range(latents.shape[0]):
-                            decodeds.append(self.pretransform.decode(decoded[i:i+1]))
-                        decoded = torch.cat(decodeds, dim=0)
-                    else:
-                        decoded = self.pretransform.decode(decoded)
+            with torch.set_grad_enabled(self.pretransform.enable_grad and torch.is_grad_enabled()):
+                decoded = self.pretransform.decode(decoded)
 
         if self.soft_clip:
             decoded = torch.tanh(decoded)
@@ -412,8 +519,7 @@ class AudioAutoencoder(nn.Module):
             assert len(audio.shape)==2, "Audio should be shape (Channels x Length) with no batch dimension" 
             # Resample audio
             if in_sr != self.sample_rate:
-                resample_tf = T.Resample(in_sr, self.sample_rate).to(audio.device)
-                audio = resample_tf(audio)
+                audio = get_resample_transform(in_sr, self.sample_rate, audio.device)(audio)
             new_audio.append(audio)
             if audio.shape[-1] > max_length:
                 max_length = audio.shape[-1]
@@ -421,145 +527,211 @@ class AudioAutoencoder(nn.Module):
         padded_audio_length = max_length + (self.min_length - (max_length % self.min_length)) % self.min_length
         for i in range(batch_size):
             # Pad it & if necessary, mixdown/duplicate stereo/mono channels to support model
-            new_audio[i] = prepare_audio(new_audio[i], in_sr=in_sr, target_sr=in_sr, target_length=padded_audio_length, 
-                target_channels=self.in_channels, device=new_audio[i].device).squeeze(0)
+            new_audio[i] = F.pad(new_audio[i], (0, padded_audio_length - new_audio[i].shape[-1]))
+            new_audio[i] = set_audio_channels(new_audio[i].unsqueeze(0), self.in_channels).squeeze(0)
         # convert to tensor 
         return torch.stack(new_audio) 
 
-    def encode_audio(self, audio, chunked=False, overlap=32, chunk_size=128, **kwargs):
+    def encode_audio_list(self, audio_list, in_sr_list, max_batch_size=8, max_padding=0.1, **kwargs):
+        '''
+        Encodes a [list] of audio (Channels x Length) of different lengths, channels and sample rates, for offline encoding of whole datasets.
+        Returns a list of latents (Latent dim x Latents) in the same order, each trimmed to the length of its own audio.
+        Audio is resampled to the model's sample rate, sorted by length, and grouped into buckets of up to max_batch_size items that are encoded together,
+        so every item is only padded to the longest item of its bucket. An item only joins a bucket if that pads it by less than max_padding of the bucket length.
+        kwargs are passed to encode_audio, e.g. chunked=True and chunk_batch_size for long audio.
+        '''
+        if isinstance(in_sr_list, int):
+            in_sr_list = [in_sr_list]*len(audio_list)
+        assert len(in_sr_list) == len(audio_list), "list of sample rates must be the same length of audio_list"
+
+        param = next(self.parameters())
+
+        audios = []
+        for audio, in_sr in zip(audio_list, in_sr_list):
+            if audio.dim() == 3 and audio.shape[0] == 1:
+                audio = audio.squeeze(0)
+            elif audio.dim() == 1:
+                audio = audio.unsqueeze(0)
+            assert audio.dim() == 2, "Audio should be shape (Channels x Length) with no batch dimension"
+
+            audio = audio.to(param.device)
+            if in_sr != self.sample_rate:
+                audio = get_resample_transform(in_sr, self.sample_rate, param.device)(audio)
+
+            audios.append(set_audio_channels(audio.unsqueeze(0), self.in_channels).squeeze(0))
+
+        # Longest first, so every bucket is padded to its first item
+        order = sorted(range(len(audios)), key=lambda i: audios[i].shape[-1], reverse=True)
+
+        latents = [None] * len(audios)
+
+        bucket_start = 0
+        while bucket_start < len(order):
+            bucket_length = audios[order[bucket_start]].shape[-1]
+
+            bucket_end = bucket_start + 1
+            while bucket_end < len(order) and bucket_end - bucket_start < max_batch_size and audios[order[bucket_end]].shape[-1] >= (1 - max_padding) * bucket_length:
+                bucket_end += 1
+
+            bucket = order[bucket_start:bucket_end]
+
+            padded_length = bucket_length + (self.min_length - (bucket_length % self.min_length)) % self.min_length
+            batch = torch.stack([F.pad(audios[i], (0, padded_length - audios[i].shape[-1])) for i in bucket]).to(param.dtype)
+
+            encoded = self.encode_audio(batch, **kwargs)
+
+            for i, item_latents in zip(bucket, encoded):
+                latents[i] = item_latents[:, :math.ceil(audios[i].shape[-1] / self.downsampling_ratio)]
+
+            bucket_start = bucket_end
+
+        return latents
+
+    def prepare_for_inference(self, dtype=None):
+        '''
+        Folds weight norm into plain convolution weights and freezes the model, optionally casting it to a lower precision dtype.
+        The folded model computes the same outputs without renormalizing every weight on each forward pass, but can't be trained with weight norm anymore.
+        '''
+        remove_weight_norm_from_model(self)
+
+        self.eval().requires_grad_(False)
+
+        if dtype is not None:
+            self.to(dtype)
+
+        return self
+
+    def get_streaming_decoder(self):
+        '''
+        Returns a StreamingDecoder that decodes latents frame by frame as they arrive, see streaming.py
+        '''
+        from .streaming import StreamingDecoder
+
+        return StreamingDecoder(self)
+
+    def get_encoder_context(self):
+        '''
+        The number of latents on each side of an encoded chunk that are affected by the chunk boundary, derived from the encoder convolutions
+        '''
+        return get_latent_context(self.encoder) if self.encoder is not None else 0
+
+    def get_decoder_context(self):
+        '''
+        The number of latents on each side of a decoded chunk that are affected by the chunk boundary, derived from the decoder convolutions
+        '''
+        return get_latent_context(self.decoder)
+
+    def process_chunked(self, function, x, in_scale, out_scale, chunk_size, overlap, context, chunk_batch_size=1):
+        '''
+        Runs function over overlapping chunks of x and stitches the outputs with windowed overlap-add.
+        chunk_size, overlap and context are measured in latents, in_scale and out_scale are the number of input and output frames per latent.
+        The context latents at the inner edges of every chunk are discarded, and the rest of the overlap is crossfaded.
+        If the overlap is shorter than twice the context, the whole overlap is crossfaded instead, which hides but doesn't remove the chunk boundaries.
+        '''
+        batch_size = x.shape[0]
+        total_size = x.shape[2] // in_scale # in latents
+
+        if total_size <= chunk_size:
+            return function(x)
+
+        hop_size = chunk_size - overlap
+        assert hop_size > 0, "overlap must be smaller than chunk_size"
+
+        starts = list(range(0, total_size - chunk_size + 1, hop_size))
+        if starts[-1] + chunk_size != total_size:
+            # The final chunk may have a longer overlap in order to keep chunk_size consistent for all chunks
+            starts.append(total_size - chunk_size)
+
+        chunks = torch.stack([x[:,:,start*in_scale:(start+chunk_size)*in_scale] for start in starts])
+        num_chunks = chunks.shape[0]
+
+        if overlap >= 2 * context:
+            trim = context * out_scale
+            crossfade = (overlap - 2 * context) * out_scale
+        else:
+            trim = 0
+            crossfade = overlap * out_scale
+
+        y_final = None
+        weights = torch.zeros(total_size * out_scale, device=x.device)
+
+        for i, y_chunk in enumerate(iterate_chunk_batches(function, chunks, chunk_batch_size)):
+            if y_final is None:
+                y_final = torch.zeros((batch_size, y_chunk.shape[1], total_size * out_scale), device=x.device)
+
+            # No trimming or fading at the start of the first chunk and the end of the last chunk
+            chunk_start = trim if i > 0 else 0
+            chunk_end = y_chunk.shape[2] - (trim if i < num_chunks-1 else 0)
+
+            window = get_crossfade_window(
+                chunk_end - chunk_start, 
+                fade_in=crossfade if i > 0 else 0, 
+                fade_out=crossfade if i < num_chunks-1 else 0,
+                device=x.device
+            )
+
+            t_start = starts[i] * out_scale + chunk_start
+            t_end = t_start + window.shape[0]
+
+            y_final[:,:,t_start:t_end] += y_chunk[:,:,chunk_start:chunk_end] * window
+            weights[t_start:t_end] += window
+
+        return y_final / weights
+
+    def encode_audio(self, audio, chunked=False, overlap=None, chunk_size=128, chunk_batch_size=1, **kwargs):
         '''
         Encode audios into latents. Audios should already be preprocesed by preprocess_audio_for_encoder.
         If chunked is True, split the audio into chunks of a given maximum size chunk_size, with given overlap.
-        Overlap and chunk_size params are both measured in number of latents (not audio samples) 
-        # and therefore you likely could use the same values with decode_audio. 
-        A overlap of zero will cause discontinuity artefacts. Overlap should be => receptive field size. 
-        Every autoencoder will have a different receptive field size, and thus ideal overlap.
-        You can determine it empirically by diffing unchunked vs chunked output and looking at maximum diff.
+        Overlap and chunk_size params are both measured in number of latents (not audio samples). 
+        By default the overlap is twice the encoder context (see get_encoder_context), the smallest overlap for which chunked encoding matches unchunked encoding.
+        Overlapping chunks are stitched with windowed overlap-add, see process_chunked.
         The final chunk may have a longer overlap in order to keep chunk_size consistent for all chunks.
         Smaller chunk_size uses less memory, but more compute.
         The chunk_size vs memory tradeoff isn't linear, and possibly depends on the GPU and CUDA version
         For example, on a A6000 chunk_size 128 is overall faster than 256 and 512 even though it has more chunks
+        chunk_batch_size chunks are encoded at once, which keeps large GPUs busy on long audio.
+        With chunk_batch_size="auto", it is chosen from the free device memory after encoding the first chunk.
         '''
         if not chunked:
             # default behavior. Encode the entire audio in parallel
             return self.encode(audio, **kwargs)
         else:
             # CHUNKED ENCODING
-            # samples_per_latent is just the downsampling ratio (which is also the upsampling ratio)
-            samples_per_latent = self.downsampling_ratio
-            total_size = audio.shape[2] # in samples
-            batch_size = audio.shape[0]
-            chunk_size *= samples_per_latent # converting metric in latents to samples
-            overlap *= samples_per_latent # converting metric in latents to samples
-            hop_size = chunk_size - overlap
-            chunks = []
-            for i in range(0, total_size - chunk_size + 1, hop_size):
-                chunk = audio[:,:,i:i+chunk_size]
-                chunks.append(chunk)
-            if i+chunk_size != total_size:
-                # Final chunk
-                chunk = audio[:,:,-chunk_size:]
-                chunks.append(chunk)
-            chunks = torch.stack(chunks)
-            num_chunks = chunks.shape[0]
-            # Note: y_size might be a different value from the latent length used in diffusion training
+            # Note: the latent length might be a different value from the latent length used in diffusion training
             # because we can encode audio of varying lengths
-            # However, the audio should've been padded to a multiple of samples_per_latent by now.
-            y_size = total_size // samples_per_latent
-            # Create an empty latent, we will populate it with chunks as we encode them
-            y_final = torch.zeros((batch_size,self.latent_dim,y_size)).to(audio.device)
-            for i in range(num_chunks):
-                x_chunk = chunks[i,:]
-                # encode the chunk
-                y_chunk = self.encode(x_chunk)
-                # figure out where to put the audio along the time domain
-                if i == num_chunks-1:
-                    # final chunk always goes at the end
-                    t_end = y_size
-                    t_start = t_end - y_chunk.shape[2]
-                else:
-                    t_start = i * hop_size // samples_per_latent
-                    t_end = t_start + chunk_size // samples_per_latent
-                #  remove the edges of the overlaps
-                ol = overlap//samples_per_latent//2
-                chunk_start = 0
-                chunk_end = y_chunk.shape[2]
-                if i > 0:
-                    # no overlap for the start of the first chunk
-                    t_start += ol
-                    chunk_start += ol
-                if i < num_chunks-1:
-                    # no overlap for the end of the last chunk
-                    t_end -= ol
-                    chunk_end -= ol
-                # paste the chunked audio into our y_final output audio
-                y_final[:,:,t_start:t_end] = y_chunk[:,:,chunk_start:chunk_end]
-            return y_final
+            # However, the audio should've been padded to a multiple of the downsampling ratio by now.
+            context = self.get_encoder_context()
+
+            if overlap is None:
+                overlap = 2 * context
+
+            return self.process_chunked(self.encode, audio, self.downsampling_ratio, 1, chunk_size, overlap, context, chunk_batch_size)
     
-    def decode_audio(self, latents, chunked=False, overlap=32, chunk_size=128, **kwargs):
+    def decode_audio(self, latents, chunked=False, overlap=None, chunk_size=128, chunk_batch_size=1, **kwargs):
         '''
         Decode latents to audio. 
         If chunked is True, split the latents into chunks of a given maximum size chunk_size, with given overlap, both of which are measured in number of latents. 
-        A overlap of zero will cause discontinuity artefacts. Overlap should be => receptive field size. 
-        Every autoencoder will have a different receptive field size, and thus ideal overlap.
-        You can determine it empirically by diffing unchunked vs chunked audio and looking at maximum diff.
+        By default the overlap is twice the decoder context (see get_decoder_context), the smallest overlap for which chunked decoding matches unchunked decoding.
+        Overlapping chunks are stitched with windowed overlap-add, see process_chunked.
         The final chunk may have a longer overlap in order to keep chunk_size consistent for all chunks.
         Smaller chunk_size uses less memory, but more compute.
         The chunk_size vs memory tradeoff isn't linear, and possibly depends on the GPU and CUDA version
         For example, on a A6000 chunk_size 128 is overall faster than 256 and 512 even though it has more chunks
+        chunk_batch_size chunks are decoded at once, which keeps large GPUs busy on long audio.
+        With chunk_batch_size="auto", it is chosen from the free device memory after decoding the first chunk.
         '''
         if not chunked:
             # default behavior. Decode the entire latent in parallel
             return self.decode(latents, **kwargs)
         else:
             # chunked decoding
-            hop_size = chunk_size - overlap
-            total_size = latents.shape[2]
-            batch_size = latents.shape[0]
-            chunks = []
-            for i in range(0, total_size - chunk_size + 1, hop_size):
-                chunk = latents[:,:,i:i+chunk_size]
-                chunks.append(chunk)
-            if i+chunk_size != total_size:
-                # Final chunk
-                chunk = latents[:,:,-chunk_size:]
-                chunks.append(chunk)
-            chunks = torch.stack(chunks)
-            num_chunks = chunks.shape[0]
-            # samples_per_latent is just the downsampling ratio
-            samples_per_latent = self.downsampling_ratio
-            # Create an empty waveform, we will populate it with chunks as decode them
-            y_size = total_size * samples_per_latent
-            y_final = torch.zeros((batch_size,self.out_channels,y_size)).to(latents.device)
-            for i in range(num_chunks):
-                x_chunk = chunks[i,:]
-                # decode the chunk
-                y_chunk = self.decode(x_chunk)
-                # figure out where to put the audio along the time domain
-                if i == num_chunks-1:
-                    # final chunk always goes at the end
-                    t_end = y_size
-                    t_start = t_end - y_chunk.shape[2]
-                else:
-                    t_start = i * hop_size * samples_per_latent
-                    t_end = t_start + chunk_size * samples_per_latent
-                #  remove the edges of the overlaps
-                ol = (overlap//2) * samples_per_latent
-                chunk_start = 0
-                chunk_end = y_chunk.shape[2]
-                if i > 0:
-                    # no overlap for the start of the first chunk
-                    t_start += ol
-                    chunk_start += ol
-                if i < num_chunks-1:
-                    # no overlap for the end of the last chunk
-                    t_end -= ol
-                    chunk_end -= ol
-                # paste the chunked audio into our y_final output audio
-                y_final[:,:,t_start:t_end] = y_chunk[:,:,chunk_start:chunk_end]
-            return y_final
+            context = self.get_decoder_context()
+
+            if overlap is None:
+                overlap = 2 * context
+
+            return self.process_chunked(self.decode, latents, 1, self.downsampling_ratio, chunk_size, overlap, context, chunk_batch_size)
 
-    
 class DiffusionAutoencoder(AudioAutoencoder):
     def __init__(
         self,
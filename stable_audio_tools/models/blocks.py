@@ -301,10 +301,48 @@ class RMSNorm(nn.Module):
 def snake_beta(x, alpha, beta):
     return x + (1.0 / (beta + 0.000000001)) * pow(torch.sin(x * alpha), 2)
 
-# try:
-#     snake_beta = torch.compile(snake_beta)
-# except RuntimeError:
-#     pass
+@compile
+def snake_beta_forward(x, alpha, beta):
+    return x + (1.0 / (beta + 0.000000001)) * pow(torch.sin(x * alpha), 2)
+
+@compile
+def snake_beta_backward(grad_output, x, alpha, beta, needs_alpha_grad: bool, needs_beta_grad: bool):
+    # d/dx (sin(x * alpha)^2) = alpha * sin(2 * x * alpha)
+    inv_beta = 1.0 / (beta + 0.000000001)
+    sin_2x_alpha = torch.sin(2 * x * alpha)
+
+    grad_x = grad_output * (1 + alpha * inv_beta * sin_2x_alpha)
+
+    grad_alpha = grad_beta = None
+
+    # alpha and beta are broadcast over the batch and time dimensions
+    if needs_alpha_grad:
+        grad_alpha = (grad_output * x * inv_beta * sin_2x_alpha).sum(dim=(0, 2), keepdim=True)
+
+    if needs_beta_grad:
+        grad_beta = -(grad_output * pow(torch.sin(x * alpha), 2) * inv_beta * inv_beta).sum(dim=(0, 2), keepdim=True)
+
+    return grad_x, grad_alpha, grad_beta
+
+class SnakeBetaFunction(torch.autograd.Function):
+    """
+    Fused snake_beta. Only the input is saved for the backward pass, which recomputes the activation instead of keeping its intermediate tensors.
+    """
+    @staticmethod
+    def forward(ctx, x, alpha, beta):
+        ctx.save_for_backward(x, alpha, beta)
+        return snake_beta_forward(x, alpha, beta)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, alpha, beta = ctx.saved_tensors
+
+        grad_x, grad_alpha, grad_beta = snake_beta_backward(grad_output, x, alpha, beta, ctx.needs_input_grad[1], ctx.needs_input_grad[2])
+
+        return grad_x if ctx.needs_input_grad[0] else None, grad_alpha, grad_beta
+
+def fused_snake_beta(x, alpha, beta):
+    return SnakeBetaFunction.apply(x, alpha, beta)
 
 # Adapted from https://github.com/NVIDIA/BigVGAN/blob/main/activations.py under MIT license
 # License available in LICENSES/LICENSE_NVIDIA.txt
@@ -328,12 +366,13 @@ class SnakeBeta(nn.Module):
 
         self.no_div_by_zero = 0.000000001
 
-    def forward(self, x):
+    def forward(self, x, fused=True):
+        # The fused kernels are compiled per input shape, fused=False runs the eager ops for inputs that change shape on every call
         alpha = self.alpha.unsqueeze(0).unsqueeze(-1) # line up with x to [B, C, T]
         beta = self.beta.unsqueeze(0).unsqueeze(-1)
         if self.alpha_logscale:
             alpha = torch.exp(alpha)
             beta = torch.exp(beta)
-        x = snake_beta(x, alpha, beta)
+        x = fused_snake_beta(x, alpha, beta) if fused else snake_beta(x, alpha, beta)
 
         return x
\ No newline at end of file
@@ -4,6 +4,7 @@
 from collections import namedtuple
 from dataclasses import dataclass
 from functools import lru_cache
+from itertools import chain
 import logging
 import typing as tp
 
@@ -46,11 +47,29 @@ class Pattern:
 
     def __post_init__(self):
         assert len(self.layout) > 0
+        self._coords = None
         self._validate_layout()
-        self._build_reverted_sequence_scatter_indexes = lru_cache(100)(self._build_reverted_sequence_scatter_indexes)
-        self._build_pattern_sequence_scatter_indexes = lru_cache(100)(self._build_pattern_sequence_scatter_indexes)
+        # Scatter indexes per (kind, timesteps or sequence steps, n_q, keep_only_valid_steps, is_model_output, device),
+        # so training steps and generations don't rebuild them for a shape they have already seen
+        self._scatter_indexes_cache: dict = {}
         logger.info("New pattern, time steps: %d, sequence steps: %d", self.timesteps, len(self.layout))
 
+    def _get_coords(self):
+        """Returns the sequence steps, timesteps and codebooks of all the coordinates in the layout as flat tensors.
+        """
+        if self._coords is None:
+            # LayoutCoord is a (t, q) tuple, so the flattened layout converts to a [N, 2] tensor in one call
+            coords = torch.tensor(list(chain.from_iterable(self.layout)), dtype=torch.long).view(-1, 2)
+            steps = torch.repeat_interleave(torch.arange(len(self.layout)), torch.tensor([len(seq_coords) for seq_coords in self.layout]))
+            self._coords = (steps, coords[:, 0], coords[:, 1])
+        return self._coords
+
+    def _get_scatter_indexes(self, build_fn, *args, device: tp.Union[torch.device, str] = 'cpu'):
+        key = (build_fn.__name__, *args, torch.device(device))
+        if key not in self._scatter_indexes_cache:
+            self._scatter_indexes_cache[key] = build_fn(*args, device=device)
+        return self._scatter_indexes_cache[key]
+
     def _validate_layout(self):
         """Runs checks on the layout to ensure a valid pattern is defined.
         A pattern is considered invalid if:
@@ -58,19 +77,25 @@ class Pattern:
             - The timesteps for a given codebook are not in ascending order as we advance in the sequence
               (this would mean that we have future timesteps before past timesteps).
         """
-        q_timesteps = {q: 0 for q in range(self.n_q)}
-        for s, seq_coords in enumerate(self.layout):
-            if len(seq_coords) > 0:
-                qs = set()
-                for coord in seq_coords:
-                    qs.add(coord.q)
-                    last_q_timestep = q_timesteps[coord.q]
-                    assert coord.t >= last_q_timestep, \
-                        f"Past timesteps are found in the sequence for codebook = {coord.q} at step {s}"
-                    q_timesteps[coord.q] = coord.t
-                # each sequence step contains at max 1 coordinate per codebook
-                assert len(qs) == len(seq_coords), \
-                    f"Multiple entries for a same codebook are found at step {s}"
+        s, t, q = self._get_coords()
+        assert len(q) == 0 or (q.min() >= 0 and q.max() < self.n_q), "invalid codebook index in the pattern layout"
+        # order the coordinates by codebook, then sequence step, and compare every timestep with the previous one of its codebook
+        order = torch.argsort(q * len(self.layout) + s, stable=True)
+        s_by_q, t_by_q, q_by_q = s[order], t[order], q[order]
+        is_first_of_q = torch.ones_like(q_by_q, dtype=torch.bool)
+        is_first_of_q[1:] = q_by_q[1:] != q_by_q[:-1]
+        last_q_timestep = torch.where(is_first_of_q, torch.zeros_like(t_by_q), t_by_q.roll(1))
+        past = t_by_q < last_q_timestep
+        # each sequence step contains at max 1 coordinate per codebook
+        step_codebooks = torch.sort(s * self.n_q + q).values
+        duplicate_steps = step_codebooks[1:][step_codebooks[1:] == step_codebooks[:-1]] // self.n_q
+        # report the first invalid step, as a step by step check would
+        first_past = int(s_by_q[past].min()) if past.any() else None
+        first_duplicate = int(duplicate_steps.min()) if len(duplicate_steps) > 0 else None
+        if first_past is not None and (first_duplicate is None or first_past <= first_duplicate):
+            codebook = int(q_by_q[past & (s_by_q == first_past)][0])
+            raise AssertionError(f"Past timesteps are found in the sequence for codebook = {codebook} at step {first_past}")
+        assert first_duplicate is None, f"Multiple entries for a same codebook are found at step {first_duplicate}"
 
     @property
     def num_sequence_steps(self):
@@ -78,10 +103,9 @@ class Pattern:
 
     @property
     def max_delay(self):
-        max_t_in_seq_coords = 0
-        for seq_coords in self.layout[1:]:
-            for coords in seq_coords:
-                max_t_in_seq_coords = max(max_t_in_seq_coords, coords.t + 1)
+        s, t, _ = self._get_coords()
+        t = t[s >= 1]
+        max_t_in_seq_coords = max(int(t.max()) + 1, 0) if len(t) > 0 else 0
         return max_t_in_seq_coords - self.timesteps
 
     @property
@@ -130,23 +154,19 @@ class Pattern:
         assert timesteps <= self.timesteps, "invalid number of timesteps used to build the sequence from the pattern"
         # use the proper layout based on whether we limit ourselves to valid steps only or not,
         # note that using the valid_layout will result in a truncated sequence up to the valid steps
-        ref_layout = self.valid_layout if keep_only_valid_steps else self.layout
-        # single item indexing being super slow with pytorch vs. numpy, so we use numpy here
-        indexes = torch.zeros(n_q, len(ref_layout), dtype=torch.long).numpy()
-        mask = torch.zeros(n_q, len(ref_layout), dtype=torch.bool).numpy()
+        num_steps = len(self.valid_layout) if keep_only_valid_steps else len(self.layout)
         # fill indexes with last sequence step value that will correspond to our special token
         # the last value is n_q * timesteps as we have flattened z and append special token as the last token
         # which will correspond to the index: n_q * timesteps
-        indexes[:] = n_q * timesteps
-        # iterate over the pattern and fill scattered indexes and mask
-        for s, sequence_coords in enumerate(ref_layout):
-            for coords in sequence_coords:
-                if coords.t < timesteps:
-                    indexes[coords.q, s] = coords.t + coords.q * timesteps
-                    mask[coords.q, s] = 1
-        indexes = torch.from_numpy(indexes).to(device)
-        mask = torch.from_numpy(mask).to(device)
-        return indexes, mask
+        indexes = torch.full((n_q, num_steps), n_q * timesteps, dtype=torch.long)
+        mask = torch.zeros(n_q, num_steps, dtype=torch.bool)
+        # scatter all the coordinates of the pattern at once, a codebook appears at most once per sequence step
+        s, t, q = self._get_coords()
+        valid = (s < num_steps) & (t < timesteps)
+        s, t, q = s[valid], t[valid], q[valid]
+        indexes[q, s] = t + q * timesteps
+        mask[q, s] = True
+        return indexes.to(device), mask.to(device)
 
     def build_pattern_sequence(self, z: torch.Tensor, special_token: int, keep_only_valid_steps: bool = False):
         """Build sequence corresponding to the pattern from the input tensor z.
@@ -165,8 +185,8 @@ class Pattern:
             mask (torch.Tensor): Mask corresponding to indexes that matches valid indexes of shape [K, S].
         """
         B, K, T = z.shape
-        indexes, mask = self._build_pattern_sequence_scatter_indexes(
-            T, K, keep_only_valid_steps=keep_only_valid_steps, device=str(z.device)
+        indexes, mask = self._get_scatter_indexes(
+            self._build_pattern_sequence_scatter_indexes, T, K, keep_only_valid_steps, device=z.device
         )
         z = z.view(B, -1)
         # we append the special token as the last index of our flattened z tensor
@@ -193,31 +213,30 @@ class Pattern:
             indexes (torch.Tensor): Indexes for reconstructing the output, of shape [K, T].
             mask (torch.Tensor): Mask corresponding to indexes that matches valid indexes of shape [K, T].
         """
-        ref_layout = self.valid_layout if keep_only_valid_steps else self.layout
+        num_steps = len(self.valid_layout) if keep_only_valid_steps else len(self.layout)
         # TODO(jade): Do we want to further truncate to only valid timesteps here as well?
         timesteps = self.timesteps
         assert n_q == self.n_q, f"invalid number of codebooks for the sequence and the pattern: {n_q} != {self.n_q}"
-        assert sequence_steps <= len(ref_layout), \
-            f"sequence to revert is longer than the defined pattern: {sequence_steps} > {len(ref_layout)}"
+        assert sequence_steps <= num_steps, \
+            f"sequence to revert is longer than the defined pattern: {sequence_steps} > {num_steps}"
+
+        s, t, q = self._get_coords()
+        valid = s < num_steps
 
         # ensure we take the appropriate indexes to keep the model output from the first special token as well
         if is_model_output and self.starts_with_special_token():
-            ref_layout = ref_layout[1:]
+            s = s - 1
+
+        valid = valid & (s >= 0) & (s < sequence_steps) & (t < timesteps)
+        s, t, q = s[valid], t[valid], q[valid]
 
-        # single item indexing being super slow with pytorch vs. numpy, so we use numpy here
-        indexes = torch.zeros(n_q, timesteps, dtype=torch.long).numpy()
-        mask = torch.zeros(n_q, timesteps, dtype=torch.bool).numpy()
         # fill indexes with last sequence step value that will correspond to our special token
-        indexes[:] = n_q * sequence_steps
-        for s, sequence_codes in enumerate(ref_layout):
-            if s < sequence_steps:
-                for code in sequence_codes:
-                    if code.t < timesteps:
-                        indexes[code.q, code.t] = s + code.q * sequence_steps
-                        mask[code.q, code.t] = 1
-        indexes = torch.from_numpy(indexes).to(device)
-        mask = torch.from_numpy(mask).to(device)
-        return indexes, mask
+        indexes = torch.full((n_q * timesteps,), n_q * sequence_steps, dtype=torch.long)
+        mask = torch.zeros(n_q * timesteps, dtype=torch.bool)
+        # a coordinate can appear at several sequence steps, the last one is kept (the index grows with the step)
+        indexes.scatter_reduce_(0, q * timesteps + t, s + q * sequence_steps, reduce="amax", include_self=False)
+        mask[q * timesteps + t] = True
+        return indexes.view(n_q, timesteps).to(device), mask.view(n_q, timesteps).to(device)
 
     def revert_pattern_sequence(self, s: torch.Tensor, special_token: int, keep_only_valid_steps: bool = False):
         """Revert a sequence built from the pattern back to the original multi-codebook sequence without interleaving.
@@ -234,8 +253,8 @@ class Pattern:
             mask (torch.Tensor): Mask corresponding to indexes that matches valid indexes of shape [K, T].
         """
         B, K, S = s.shape
-        indexes, mask = self._build_reverted_sequence_scatter_indexes(
-            S, K, keep_only_valid_steps, is_model_output=False, device=str(s.device)
+        indexes, mask = self._get_scatter_indexes(
+            self._build_reverted_sequence_scatter_indexes, S, K, keep_only_valid_steps, False, device=s.device
         )
         s = s.view(B, -1)
         # we append the special token as the last index of our flattened z tensor
@@ -255,8 +274,8 @@ class Pattern:
         while we skip the last logits as there is no matching target
         """
         B, card, K, S = logits.shape
-        indexes, mask = self._build_reverted_sequence_scatter_indexes(
-            S, K, keep_only_valid_steps, is_model_output=True, device=logits.device
+        indexes, mask = self._get_scatter_indexes(
+            self._build_reverted_sequence_scatter_indexes, S, K, keep_only_valid_steps, True, device=logits.device
         )
         logits = logits.reshape(B, card, -1)
         # we append the special token as the last index of our flattened z tensor
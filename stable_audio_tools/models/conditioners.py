@@ -264,15 +264,21 @@ class T5Conditioner(Conditioner):
             t5_model_name: str = "t5-base",
             max_length: str = 128,
             enable_grad: bool = False,
-            project_out: bool = False
+            project_out: bool = False,
+            padding: tp.Literal["max_length", "longest"] = "max_length",
+            pad_to_multiple_of: int = 8
     ):
         assert t5_model_name in self.T5_MODELS, f"Unknown T5 model name: {t5_model_name}"
+        assert padding in ["max_length", "longest"], f"Unknown padding mode: {padding}"
         super().__init__(self.T5_MODEL_DIMS[t5_model_name], output_dim, project_out=project_out)
         
         from transformers import T5EncoderModel, AutoTokenizer
 
         self.max_length = max_length
         self.enable_grad = enable_grad
+        # "longest" pads to the longest prompt in the batch, rounded up to a multiple of pad_to_multiple_of to limit the number of distinct shapes
+        self.padding = padding
+        self.pad_to_multiple_of = pad_to_multiple_of
 
         # Suppress logging from transformers
         previous_level = logging.root.manager.disable
@@ -302,7 +308,8 @@ class T5Conditioner(Conditioner):
             texts,
             truncation=True,
             max_length=self.max_length,
-            padding="max_length",
+            padding=self.padding,
+            pad_to_multiple_of=self.pad_to_multiple_of if self.padding == "longest" else None,
             return_tensors="pt",
         )
 
@@ -545,6 +545,46 @@ class DiTWrapper(ConditionedDiffusionModel):
             global_embed=global_cond,
             **kwargs)
 
+    @torch.no_grad()
+    def bind_conditioning(self,
+                cross_attn_cond=None,
+                cross_attn_mask=None,
+                negative_cross_attn_cond=None,
+                negative_cross_attn_mask=None,
+                input_concat_cond=None,
+                negative_input_concat_cond=None,
+                global_cond=None,
+                negative_global_cond=None,
+                prepend_cond=None,
+                prepend_cond_mask=None,
+                cfg_scale=1.0,
+                batch_cfg: bool = True,
+                rescale_cfg: bool = False,
+                scale_phi: float = 0.0,
+                mask=None):
+        """
+        Prepares the conditioning once per generation and returns a denoiser taking (x, t) for the sampling loop,
+        so the conditioning projections and CFG batching don't run again at every step
+        The conditioning is built without gradients, as in the samplers
+        """
+
+        assert batch_cfg, "batch_cfg must be True for DiTWrapper"
+
+        conditioning = self.model.prepare_conditioning(
+            cross_attn_cond=cross_attn_cond,
+            cross_attn_cond_mask=cross_attn_mask,
+            negative_cross_attn_cond=negative_cross_attn_cond,
+            negative_cross_attn_mask=negative_cross_attn_mask,
+            input_concat_cond=input_concat_cond,
+            global_embed=global_cond,
+            prepend_cond=prepend_cond,
+            prepend_cond_mask=prepend_cond_mask,
+            cfg_scale=cfg_scale,
+            mask=mask
+        )
+
+        return partial(self.model.forward_prepared, conditioning=conditioning, cfg_scale=cfg_scale, scale_phi=scale_phi)
+
 class DiTUncondWrapper(DiffusionModel):
     def __init__(
         self,
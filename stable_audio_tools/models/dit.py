@@ -10,6 +10,22 @@ from x_transformers import ContinuousTransformerWrapper, Encoder
 from .blocks import FourierFeatures
 from .transformer import ContinuousTransformer
 
+def pad_cond_tokens(cond, mask, length):
+    """
+    Right-pads conditioning tokens of shape (b, n, c) and their (b, n) mask to the given length, the padding is masked out
+    """
+    pad_length = length - cond.shape[1]
+
+    if pad_length == 0:
+        return cond, mask
+
+    cond = F.pad(cond, (0, 0, 0, pad_length))
+
+    if mask is not None:
+        mask = torch.cat([mask, mask.new_zeros(mask.shape[0], pad_length)], dim=1)
+
+    return cond, mask
+
 class DiffusionTransformer(nn.Module):
     def __init__(self, 
         io_channels=32, 
@@ -25,12 +41,16 @@ class DiffusionTransformer(nn.Module):
         num_heads=8,
         transformer_type: tp.Literal["x-transformers", "continuous_transformer"] = "x-transformers",
         global_cond_type: tp.Literal["prepend", "adaLN"] = "prepend",
+        use_cross_attn_mask: bool = False,
         **kwargs):
 
         super().__init__()
         
         self.cond_token_dim = cond_token_dim
 
+        # Models trained without the cross-attention mask attend to the padding tokens, so the mask is opt-in
+        self.use_cross_attn_mask = use_cross_attn_mask
+
         # Timestep embeddings
         timestep_features_dim = 256
 
@@ -132,6 +152,9 @@ class DiffusionTransformer(nn.Module):
         self.postprocess_conv = nn.Conv1d(io_channels, io_channels, 1, bias=False)
         nn.init.zeros_(self.postprocess_conv.weight)
 
+        # Set by compile_inference
+        self._compiled_forward = None
+
     def _forward(
         self, 
         x, 
@@ -139,27 +162,24 @@ class DiffusionTransformer(nn.Module):
         mask=None,
         cross_attn_cond=None,
         cross_attn_cond_mask=None,
+        cross_attn_context_kv=None,
         input_concat_cond=None,
         global_embed=None,
         prepend_cond=None,
         prepend_cond_mask=None,
         return_info=False,
+        feature_cache=None,
         **kwargs):
+        """
+        Runs the denoiser on conditioning that has already been projected by prepare_conditioning
+        """
 
-        if cross_attn_cond is not None:
-            cross_attn_cond = self.to_cond_embed(cross_attn_cond)
-
-        if global_embed is not None:
-            # Project the global conditioning to the embedding dimension
-            global_embed = self.to_global_embed(global_embed)
+        assert feature_cache is None or self.transformer_type == "continuous_transformer", "Feature caching is only supported for the continuous_transformer type"
 
         prepend_inputs = None 
         prepend_mask = None
         prepend_length = 0
         if prepend_cond is not None:
-            # Project the prepend conditioning to the embedding dimension
-            prepend_cond = self.to_prepend_embed(prepend_cond)
-            
             prepend_inputs = prepend_cond
             if prepend_cond_mask is not None:
                 prepend_mask = prepend_cond_mask
@@ -209,7 +229,7 @@ class DiffusionTransformer(nn.Module):
         if self.transformer_type == "x-transformers":
             output = self.transformer(x, prepend_embeds=prepend_inputs, context=cross_attn_cond, context_mask=cross_attn_cond_mask, mask=mask, prepend_mask=prepend_mask, **extra_args, **kwargs)
         elif self.transformer_type == "continuous_transformer":
-            output = self.transformer(x, prepend_embeds=prepend_inputs, context=cross_attn_cond, context_mask=cross_attn_cond_mask, mask=mask, prepend_mask=prepend_mask, return_info=return_info, **extra_args, **kwargs)
+            output = self.transformer(x, prepend_embeds=prepend_inputs, context=cross_attn_cond, context_mask=cross_attn_cond_mask, mask=mask, prepend_mask=prepend_mask, return_info=return_info, feature_cache=feature_cache, context_kv=cross_attn_context_kv, **extra_args, **kwargs)
 
             if return_info:
                 output, info = output
@@ -228,69 +248,44 @@ class DiffusionTransformer(nn.Module):
 
         return output
 
-    def forward(
-        self, 
-        x, 
-        t, 
+    def prepare_conditioning(
+        self,
         cross_attn_cond=None,
         cross_attn_cond_mask=None,
         negative_cross_attn_cond=None,
         negative_cross_attn_mask=None,
         input_concat_cond=None,
         global_embed=None,
-        negative_global_embed=None,
         prepend_cond=None,
         prepend_cond_mask=None,
         cfg_scale=1.0,
-        cfg_dropout_prob=0.0,
-        causal=False,
-        scale_phi=0.0,
-        mask=None,
-        return_info=False,
-        **kwargs):
-
-        assert causal == False, "Causal mode is not supported for DiffusionTransformer"
+        mask=None):
+        """
+        Builds the conditioning that stays the same across sampling steps: batches the conditioned and unconditioned inputs for CFG,
+        projects the conditioning to the embedding dimension and, for the continuous transformer, to the cross-attention keys and values of every layer.
+        The result is passed to forward_prepared at every step.
+        """
 
         if cross_attn_cond_mask is not None:
-            cross_attn_cond_mask = cross_attn_cond_mask.bool()
+            cross_attn_cond_mask = cross_attn_cond_mask.bool() if self.use_cross_attn_mask else None
 
-            cross_attn_cond_mask = None # Temporarily disabling conditioning masks due to kernel issue for flash attention
+        if negative_cross_attn_mask is not None:
+            negative_cross_attn_mask = negative_cross_attn_mask.bool()
 
         if prepend_cond_mask is not None:
             prepend_cond_mask = prepend_cond_mask.bool()
 
-        # CFG dropout
-        if cfg_dropout_prob > 0.0:
-            if cross_attn_cond is not None:
-                null_embed = torch.zeros_like(cross_attn_cond, device=cross_attn_cond.device)
-                dropout_mask = torch.bernoulli(torch.full((cross_attn_cond.shape[0], 1, 1), cfg_dropout_prob, device=cross_attn_cond.device)).to(torch.bool)
-                cross_attn_cond = torch.where(dropout_mask, null_embed, cross_attn_cond)
-
-            if prepend_cond is not None:
-                null_embed = torch.zeros_like(prepend_cond, device=prepend_cond.device)
-                dropout_mask = torch.bernoulli(torch.full((prepend_cond.shape[0], 1, 1), cfg_dropout_prob, device=prepend_cond.device)).to(torch.bool)
-                prepend_cond = torch.where(dropout_mask, null_embed, prepend_cond)
+        use_cfg = cfg_scale != 1.0 and (cross_attn_cond is not None or prepend_cond is not None)
 
-
-        if cfg_scale != 1.0 and (cross_attn_cond is not None or prepend_cond is not None):
+        if use_cfg:
             # Classifier-free guidance
-            # Concatenate conditioned and unconditioned inputs on the batch dimension            
-            batch_inputs = torch.cat([x, x], dim=0)
-            batch_timestep = torch.cat([t, t], dim=0)
-
+            # Concatenate conditioned and unconditioned inputs on the batch dimension
             if global_embed is not None:
-                batch_global_cond = torch.cat([global_embed, global_embed], dim=0)
-            else:
-                batch_global_cond = None
+                global_embed = torch.cat([global_embed, global_embed], dim=0)
 
             if input_concat_cond is not None:
-                batch_input_concat_cond = torch.cat([input_concat_cond, input_concat_cond], dim=0)
-            else:
-                batch_input_concat_cond = None
+                input_concat_cond = torch.cat([input_concat_cond, input_concat_cond], dim=0)
 
-            batch_cond = None
-            batch_cond_masks = None
-            
             # Handle CFG for cross-attention conditioning
             if cross_attn_cond is not None:
 
@@ -299,55 +294,116 @@ class DiffusionTransformer(nn.Module):
                 # For negative cross-attention conditioning, replace the null embed with the negative cross-attention conditioning
                 if negative_cross_attn_cond is not None:
 
+                    if negative_cross_attn_mask is None and cross_attn_cond_mask is not None:
+                        # Without its own mask, every token of the negative prompt is attended to
+                        negative_cross_attn_mask = torch.ones(negative_cross_attn_cond.shape[:2], dtype=torch.bool, device=negative_cross_attn_cond.device)
+
+                    # Prompts padded to the longest in their batch can differ in length, pad both to the same length
+                    cond_length = max(cross_attn_cond.shape[1], negative_cross_attn_cond.shape[1])
+                    cross_attn_cond, cross_attn_cond_mask = pad_cond_tokens(cross_attn_cond, cross_attn_cond_mask, cond_length)
+                    negative_cross_attn_cond, negative_cross_attn_mask = pad_cond_tokens(negative_cross_attn_cond, negative_cross_attn_mask, cond_length)
+                    null_embed = torch.zeros_like(cross_attn_cond, device=cross_attn_cond.device)
+
+                    negative_cond_mask = negative_cross_attn_mask
+
                     # If there's a negative cross-attention mask, set the masked tokens to the null embed
                     if negative_cross_attn_mask is not None:
-                        negative_cross_attn_mask = negative_cross_attn_mask.to(torch.bool).unsqueeze(2)
-
-                        negative_cross_attn_cond = torch.where(negative_cross_attn_mask, negative_cross_attn_cond, null_embed)
-                    
-                    batch_cond = torch.cat([cross_attn_cond, negative_cross_attn_cond], dim=0)
+                        negative_cross_attn_cond = torch.where(negative_cross_attn_mask.unsqueeze(2), negative_cross_attn_cond, null_embed)
+                        
+                    cross_attn_cond = torch.cat([cross_attn_cond, negative_cross_attn_cond], dim=0)
 
                 else:
-                    batch_cond = torch.cat([cross_attn_cond, null_embed], dim=0)
+                    # The null embed keeps the mask of the prompt
+                    negative_cond_mask = cross_attn_cond_mask
+
+                    cross_attn_cond = torch.cat([cross_attn_cond, null_embed], dim=0)
 
                 if cross_attn_cond_mask is not None:
-                    batch_cond_masks = torch.cat([cross_attn_cond_mask, cross_attn_cond_mask], dim=0)
-               
-            batch_prepend_cond = None
-            batch_prepend_cond_mask = None
+                    cross_attn_cond_mask = torch.cat([cross_attn_cond_mask, negative_cond_mask], dim=0)
 
             if prepend_cond is not None:
 
                 null_embed = torch.zeros_like(prepend_cond, device=prepend_cond.device)
 
-                batch_prepend_cond = torch.cat([prepend_cond, null_embed], dim=0)
+                prepend_cond = torch.cat([prepend_cond, null_embed], dim=0)
                            
                 if prepend_cond_mask is not None:
-                    batch_prepend_cond_mask = torch.cat([prepend_cond_mask, prepend_cond_mask], dim=0)
-         
+                    prepend_cond_mask = torch.cat([prepend_cond_mask, prepend_cond_mask], dim=0)
 
             if mask is not None:
-                batch_masks = torch.cat([mask, mask], dim=0)
-            else:
-                batch_masks = None
-            
-            batch_output = self._forward(
-                batch_inputs, 
-                batch_timestep, 
-                cross_attn_cond=batch_cond, 
-                cross_attn_cond_mask=batch_cond_masks, 
-                mask = batch_masks, 
-                input_concat_cond=batch_input_concat_cond, 
-                global_embed = batch_global_cond,
-                prepend_cond = batch_prepend_cond,
-                prepend_cond_mask = batch_prepend_cond_mask,
-                return_info = return_info,
-                **kwargs)
+                mask = torch.cat([mask, mask], dim=0)
 
-            if return_info:
-                batch_output, info = batch_output
+        cross_attn_context_kv = None
+
+        if cross_attn_cond is not None:
+            cross_attn_cond = self.to_cond_embed(cross_attn_cond)
+
+            if self.transformer_type == "continuous_transformer":
+                # The per-layer cross-attention keys and values only depend on the conditioning, compute them once for all steps
+                cross_attn_context_kv = self.transformer.project_context(cross_attn_cond)
+
+        if global_embed is not None:
+            # Project the global conditioning to the embedding dimension
+            global_embed = self.to_global_embed(global_embed)
 
-            cond_output, uncond_output = torch.chunk(batch_output, 2, dim=0)
+        if prepend_cond is not None:
+            # Project the prepend conditioning to the embedding dimension
+            prepend_cond = self.to_prepend_embed(prepend_cond)
+
+        return {
+            "use_cfg": use_cfg,
+            "cross_attn_cond": cross_attn_cond,
+            "cross_attn_cond_mask": cross_attn_cond_mask,
+            "cross_attn_context_kv": cross_attn_context_kv,
+            "input_concat_cond": input_concat_cond,
+            "global_embed": global_embed,
+            "prepend_cond": prepend_cond,
+            "prepend_cond_mask": prepend_cond_mask,
+            "mask": mask,
+        }
+
+    def forward_prepared(
+        self,
+        x,
+        t,
+        conditioning,
+        cfg_scale=1.0,
+        scale_phi=0.0,
+        return_info=False,
+        **kwargs):
+        """
+        Runs one denoising step on conditioning built by prepare_conditioning
+        """
+
+        # Use the compiled graph at inference time if it has been enabled, see compile_inference
+        forward_fn = self._compiled_forward if self._compiled_forward is not None and not self.training else self._forward
+
+        use_cfg = conditioning["use_cfg"]
+
+        if use_cfg:
+            x = torch.cat([x, x], dim=0)
+            t = torch.cat([t, t], dim=0)
+
+        output = forward_fn(
+            x,
+            t,
+            cross_attn_cond=conditioning["cross_attn_cond"],
+            cross_attn_cond_mask=conditioning["cross_attn_cond_mask"],
+            cross_attn_context_kv=conditioning["cross_attn_context_kv"],
+            input_concat_cond=conditioning["input_concat_cond"],
+            global_embed=conditioning["global_embed"],
+            prepend_cond=conditioning["prepend_cond"],
+            prepend_cond_mask=conditioning["prepend_cond_mask"],
+            mask=conditioning["mask"],
+            return_info=return_info,
+            **kwargs
+        )
+
+        if return_info:
+            output, info = output
+
+        if use_cfg:
+            cond_output, uncond_output = torch.chunk(output, 2, dim=0)
             cfg_output = uncond_output + (cond_output - uncond_output) * cfg_scale
 
             # CFG Rescale
@@ -357,23 +413,65 @@ class DiffusionTransformer(nn.Module):
                 output = scale_phi * (cfg_output * (cond_out_std/out_cfg_std)) + (1-scale_phi) * cfg_output
             else:
                 output = cfg_output
-            
-            if return_info:
-                return output, info
 
-            return output
-            
-        else:
-            return self._forward(
-                x,
-                t,
-                cross_attn_cond=cross_attn_cond, 
-                cross_attn_cond_mask=cross_attn_cond_mask, 
-                input_concat_cond=input_concat_cond, 
-                global_embed=global_embed, 
-                prepend_cond=prepend_cond, 
-                prepend_cond_mask=prepend_cond_mask,
-                mask=mask,
-                return_info=return_info,
-                **kwargs
-            )
\ No newline at end of file
+        if return_info:
+            return output, info
+
+        return output
+
+    def compile_inference(self, **compile_kwargs):
+        """
+        Compiles the denoiser used by forward_prepared with static shapes.
+        Every (batch size, latent length) bucket gets its own specialized graph, the conditioning projections stay outside of it.
+        """
+        self._compiled_forward = torch.compile(self._forward, dynamic=False, **compile_kwargs)
+
+    def forward(
+        self, 
+        x, 
+        t, 
+        cross_attn_cond=None,
+        cross_attn_cond_mask=None,
+        negative_cross_attn_cond=None,
+        negative_cross_attn_mask=None,
+        input_concat_cond=None,
+        global_embed=None,
+        negative_global_embed=None,
+        prepend_cond=None,
+        prepend_cond_mask=None,
+        cfg_scale=1.0,
+        cfg_dropout_prob=0.0,
+        causal=False,
+        scale_phi=0.0,
+        mask=None,
+        return_info=False,
+        **kwargs):
+
+        assert causal == False, "Causal mode is not supported for DiffusionTransformer"
+
+        # CFG dropout
+        if cfg_dropout_prob > 0.0:
+            if cross_attn_cond is not None:
+                null_embed = torch.zeros_like(cross_attn_cond, device=cross_attn_cond.device)
+                dropout_mask = torch.bernoulli(torch.full((cross_attn_cond.shape[0], 1, 1), cfg_dropout_prob, device=cross_attn_cond.device)).to(torch.bool)
+                cross_attn_cond = torch.where(dropout_mask, null_embed, cross_attn_cond)
+
+            if prepend_cond is not None:
+                null_embed = torch.zeros_like(prepend_cond, device=prepend_cond.device)
+                dropout_mask = torch.bernoulli(torch.full((prepend_cond.shape[0], 1, 1), cfg_dropout_prob, device=prepend_cond.device)).to(torch.bool)
+                prepend_cond = torch.where(dropout_mask, null_embed, prepend_cond)
+
+        conditioning = self.prepare_conditioning(
+            cross_attn_cond=cross_attn_cond,
+            cross_attn_cond_mask=cross_attn_cond_mask,
+            negative_cross_attn_cond=negative_cross_attn_cond,
+            negative_cross_attn_mask=negative_cross_attn_mask,
+            input_concat_cond=input_concat_cond,
+            global_embed=global_embed,
+            prepend_cond=prepend_cond,
+            prepend_cond_mask=prepend_cond_mask,
+            cfg_scale=cfg_scale,
+            mask=mask
+        )
+
+        return self.forward_prepared(x, t, conditioning, cfg_scale=cfg_scale, scale_phi=scale_phi, return_info=return_info, **kwargs)
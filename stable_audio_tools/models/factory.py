@@ -45,10 +45,14 @@ def create_pretransform_from_config(pretransform_config, sample_rate):
 
         scale = pretransform_config.get("scale", 1.0)
         model_half = pretransform_config.get("model_half", False)
+        precision = pretransform_config.get("precision", None)
         iterate_batch = pretransform_config.get("iterate_batch", False)
+        encode_microbatch = pretransform_config.get("encode_microbatch", None)
+        decode_microbatch = pretransform_config.get("decode_microbatch", None)
         chunked = pretransform_config.get("chunked", False)
+        chunk_batch_size = pretransform_config.get("chunk_batch_size", 1)
 
-        pretransform = AutoencoderPretransform(autoencoder, scale=scale, model_half=model_half, iterate_batch=iterate_batch, chunked=chunked)
+        pretransform = AutoencoderPretransform(autoencoder, scale=scale, model_half=model_half, precision=precision, iterate_batch=iterate_batch, encode_microbatch=encode_microbatch, decode_microbatch=decode_microbatch, chunked=chunked, chunk_batch_size=chunk_batch_size)
     elif pretransform_type == 'wavelet':
         from .pretransforms import WaveletPretransform
 
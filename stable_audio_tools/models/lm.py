@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 import torch
-from tqdm.auto import trange
+from tqdm.auto import tqdm, trange
 import typing as tp
 from einops import rearrange
 from torch import nn
@@ -9,7 +9,7 @@ from .conditioners import MultiConditioner, create_multi_conditioner_from_condit
 from .factory import create_pretransform_from_config
 from .lm_backbone import AudioLMBackbone, XTransformersAudioLMBackbone, ContinuousTransformerAudioLMBackbone
 from .pretransforms import Pretransform, AutoencoderPretransform, PretrainedDACPretransform, AudiocraftCompressionPretransform
-from .utils import multinomial, sample_top_k, sample_top_p
+from .utils import multinomial, sample_logits, sampling_probs
 
 from .codebook_patterns import (
     CodebooksPatternProvider,
@@ -96,6 +96,20 @@ class AudioLanguageModel(nn.Module):
         logits = torch.stack([self.quantizer_heads[i](output) for i in range(num_quantizers)], dim=1) # [batch, num_quantizers, seq_len, codebook_size]
 
         return logits
+
+    def decode_step(
+            self,
+            sequence, # [batch, num_quantizers, seq_len]
+            cache_offset
+        ):
+        """
+        Computes the logits of new pattern steps with the generation cache of the backbone, see AudioLMBackbone.decode_step
+        """
+        backbone_input = sum([self.embeds[i](sequence[:, i]) for i in range(self.num_quantizers)]) # [batch, seq_len, embed_dim]
+
+        output = self.backbone.decode_step(backbone_input, cache_offset) # [batch, seq_len, embed_dim]
+
+        return torch.stack([self.quantizer_heads[i](output) for i in range(self.num_quantizers)], dim=1) # [batch, num_quantizers, seq_len, codebook_size]
     
     def compute_logits(
             self, 
@@ -179,6 +193,9 @@ class AudioLanguageModelWrapper(nn.Module):
         self.cross_attn_cond_ids = cross_attn_cond_ids
         self.prepend_cond_ids = prepend_cond_ids
         self.global_cond_ids = global_cond_ids
+
+        # Set by compile_inference
+        self._compiled_decode_step = None
     
     def get_conditioning_inputs(self, cond: tp.Dict[str, tp.Any], negative=False):
         cross_attention_input = None
@@ -277,6 +294,36 @@ class AudioLanguageModelWrapper(nn.Module):
         Handles CFG inference
         """
 
+        logits = self._next_token_logits(
+            sequence,
+            conditioning_tensors=conditioning_tensors,
+            cross_attn_use_cfg=cross_attn_use_cfg,
+            prepend_use_cfg=prepend_use_cfg,
+            global_use_cfg=global_use_cfg,
+            cfg_scale=cfg_scale,
+            **kwargs
+        )
+
+        return self._sample_from_logits(logits, top_k=top_k, top_p=top_p, temp=temp)
+
+    def _next_token_logits(
+            self,
+            sequence, #[batch, num_quantizers, seq_len]
+            conditioning_tensors=None,
+            cross_attn_use_cfg=True,
+            prepend_use_cfg=True,
+            global_use_cfg=True,
+            cfg_scale=1.0,
+            lm=None,
+            **kwargs
+        ):
+        """
+        Computes the (CFG-combined) logits of the next token with lm, the wrapped LM by default
+        """
+
+        if lm is None:
+            lm = self.lm
+
         if conditioning_tensors is None:
             conditioning_tensors = {}
 
@@ -310,7 +357,7 @@ class AudioLanguageModelWrapper(nn.Module):
 
                 global_cond = torch.cat([global_cond, null_embed], dim=0)
 
-        logits = self.lm(sequence, cross_attn_cond=cross_attn_cond, prepend_cond=prepend_cond, prepend_cond_mask=prepend_cond_mask, global_cond=global_cond, **kwargs)
+        logits = lm(sequence, cross_attn_cond=cross_attn_cond, prepend_cond=prepend_cond, prepend_cond_mask=prepend_cond_mask, global_cond=global_cond, **kwargs)
 
         if cfg_scale != 1.0:
             cond_logits, uncond_logits = logits.chunk(2, dim=0)
@@ -320,24 +367,170 @@ class AudioLanguageModelWrapper(nn.Module):
         logits = rearrange(logits, "b n s c -> b n c s") # [batch, num_quantizers, codebook_size, seq_len]
         
         # Grab the logits for the last step
-        logits = logits[:, :, :, -1] # [batch, num_quantizers, codebook_size]
+        return logits[:, :, :, -1] # [batch, num_quantizers, codebook_size]
+
+    def _sample_from_logits(
+            self,
+            logits, # [batch, num_quantizers, codebook_size]
+            top_k=250,
+            top_p=0.0,
+            temp=1.0
+        ):
+        # Apply top-k or top-p sampling, temp, top_k and top_p can be numbers or tensors with a value per batch item
+        return sample_logits(logits, temperature=temp, top_k=top_k, top_p=top_p) # [batch, num_quantizers, 1]
+
+    def _decode_step(
+            self,
+            sequence, # [batch, num_quantizers, 1]
+            cache_offset,
+            cfg_scale=1.0
+        ):
+        """
+        Computes the logits of the next token from the latest pattern step, once the first step filled the generation cache.
+        The conditioning (doubled for CFG) is already in the cache, so the step has static shapes and can be compiled or captured in a CUDA graph.
+        """
+        return self._decode_logits(self.lm, sequence, cache_offset, cfg_scale=cfg_scale)[:, :, -1] # [batch, num_quantizers, codebook_size]
+
+    def _decode_logits(
+            self,
+            lm,
+            sequence, # [batch, num_quantizers, seq_len]
+            cache_offset,
+            cfg_scale=1.0
+        ):
+        """
+        Computes the (CFG-combined) logits following every step of sequence with the generation cache of lm
+        """
+        if cfg_scale != 1.0:
+            sequence = torch.cat([sequence, sequence], dim=0)
 
-        # Apply top-k or top-p sampling
+        logits = lm.decode_step(sequence, cache_offset) # [batch, num_quantizers, seq_len, codebook_size]
+
+        if cfg_scale != 1.0:
+            cond_logits, uncond_logits = logits.chunk(2, dim=0)
 
-        if temp > 0:
-            probs = torch.softmax(logits / temp, dim=-1)
+            logits = uncond_logits + (cond_logits - uncond_logits) * cfg_scale
 
-            if top_p > 0.0:
-                next_token = sample_top_p(probs, p=top_p)
-            elif top_k > 0:
-                next_token = sample_top_k(probs, k=top_k)
-            else:
-                next_token = multinomial(probs, num_samples=1)
+        return logits
 
-        else:
-            next_token = torch.argmax(logits, dim=-1, keepdim=True) # [batch, num_quantizers, 1]
+    def compile_inference(self, **compile_kwargs):
+        """
+        Compiles the decode step used by generate with the generation cache, with static shapes.
+        With mode="reduce-overhead", the step is replayed as a CUDA graph. Every batch size and CFG scale gets its own graph.
+        """
+        self._compiled_decode_step = torch.compile(self._decode_step, dynamic=False, **compile_kwargs)
+
+    def _generate_speculative(
+            self,
+            gen_sequence, # [batch, num_quantizers, gen_sequence_len]
+            start_offset_sequence,
+            draft_lm,
+            num_draft_steps,
+            conditioning_tensors=None,
+            cfg_scale=1.0,
+            callback=None,
+            top_k=250,
+            top_p=0.0,
+            temp=1.0,
+            **kwargs
+        ):
+        """
+        Fills the unknown steps of gen_sequence with speculative decoding. draft_lm proposes num_draft_steps pattern steps one by one,
+        and the wrapped LM computes the logits of all of them in a single pass over its generation cache.
+
+        The codebooks of a pattern step are sampled independently given the previous steps, so every drafted token is accepted
+        with probability min(1, p / q) of the LM (p) and draft (q) distributions, and a rejected token is resampled from max(0, p - q).
+        Generation continues from the first step with a rejected token in any batch item, and the cached steps after it are discarded.
+        The generated tokens follow the distribution of the LM with the same sampling settings.
+        """
+        assert draft_lm.num_quantizers == self.lm.num_quantizers and draft_lm.codebook_size == self.lm.codebook_size, "Draft LM must have the same codebooks as the LM"
+        assert draft_lm.backbone.use_generation_cache, "Draft LM backbone must use the generation cache"
+        assert draft_lm.backbone is not self.lm.backbone, "Draft LM must have its own backbone, the generation caches can't be shared"
+        assert num_draft_steps >= 1, "num_draft_steps must be at least 1"
+
+        device = gen_sequence.device
+        batch_size, _, gen_sequence_len = gen_sequence.shape
+        unknown_token = -1
+
+        sampling_kwargs = {"temperature": temp, "top_k": top_k, "top_p": top_p}
+
+        # Init data and steps outside the pattern are already set
+        fixed = gen_sequence != unknown_token
+
+        def set_step(offset, next_token):
+            gen_sequence[..., offset] = torch.where(fixed[..., offset], gen_sequence[..., offset], next_token)
+
+        def decode(lm, offset):
+            # Computes the logits following the steps from the cache offset of lm up to offset, and caches the steps
+            cached_len = lm.backbone.cache_offset - lm.backbone.cache_prepend_length
+            cache_offset = torch.tensor(lm.backbone.cache_offset, device=device)
+            logits = self._decode_logits(lm, gen_sequence[..., cached_len:offset], cache_offset, cfg_scale=cfg_scale)
+            lm.backbone.update_generation_cache(offset)
+            return logits # [batch, num_quantizers, offset - cached_len, codebook_size]
+
+        # The first step fills the caches of both LMs with the conditioning and the prompt, then the LM samples the first step
+        draft_lm.backbone.reset_generation_cache(gen_sequence_len, batch_size if cfg_scale == 1.0 else batch_size * 2)
+
+        prompt = gen_sequence[..., :start_offset_sequence]
+        self._next_token_logits(prompt, conditioning_tensors=conditioning_tensors, cfg_scale=cfg_scale, lm=draft_lm, use_cache=True, **kwargs)
+        logits = self._next_token_logits(prompt, conditioning_tensors=conditioning_tensors, cfg_scale=cfg_scale, use_cache=True, **kwargs)
+
+        set_step(start_offset_sequence, sample_logits(logits, **sampling_kwargs)[..., 0])
+
+        if callback is not None:
+            callback(1, gen_sequence_len - start_offset_sequence)
+
+        offset = start_offset_sequence + 1
+        progress = tqdm(total=gen_sequence_len - start_offset_sequence, initial=1)
 
-        return next_token
+        while offset < gen_sequence_len:
+            num_steps = min(num_draft_steps, gen_sequence_len - offset)
+
+            # Draft the next steps one by one
+            draft_probs = []
+            for step in range(offset, offset + num_steps):
+                probs = sampling_probs(decode(draft_lm, step)[:, :, -1], **sampling_kwargs) # [batch, num_quantizers, codebook_size]
+                set_step(step, multinomial(probs, num_samples=1)[..., 0])
+                draft_probs.append(probs)
+
+            draft_probs = torch.stack(draft_probs, dim=2) # [batch, num_quantizers, num_steps, codebook_size]
+
+            # The LM computes the distributions of the drafted steps and the step after them at once
+            probs = sampling_probs(decode(self.lm, offset + num_steps)[:, :, -(num_steps + 1):], **sampling_kwargs) # [batch, num_quantizers, num_steps + 1, codebook_size]
+
+            draft_tokens = gen_sequence[..., offset:offset + num_steps, None].clamp(max=self.lm.codebook_size - 1)
+            draft_token_probs = draft_probs.gather(-1, draft_tokens)[..., 0]
+            token_probs = probs[:, :, :num_steps].gather(-1, draft_tokens)[..., 0]
+
+            accepted = (torch.rand_like(token_probs) * draft_token_probs < token_probs) | fixed[..., offset:offset + num_steps] # [batch, num_quantizers, num_steps]
+
+            # Steps accepted in every codebook of every batch item, up to the first rejection
+            num_accepted = int(accepted.all(dim=1).all(dim=0).cumprod(dim=0).sum())
+
+            next_offset = offset + num_accepted
+            if num_accepted < num_steps:
+                # Resample the rejected tokens of the first rejected step from the residual distribution
+                residual_probs = (probs[:, :, num_accepted] - draft_probs[:, :, num_accepted]).clamp(min=0)
+                residual_probs = torch.where(residual_probs.sum(dim=-1, keepdim=True) > 0, residual_probs, probs[:, :, num_accepted])
+                next_token = torch.where(accepted[..., num_accepted], gen_sequence[..., next_offset], multinomial(residual_probs, num_samples=1)[..., 0])
+                set_step(next_offset, next_token)
+            elif next_offset < gen_sequence_len:
+                # Every drafted step was accepted, sample the step after them from the LM
+                set_step(next_offset, multinomial(probs[:, :, num_steps], num_samples=1)[..., 0])
+
+            next_offset = min(next_offset + 1, gen_sequence_len)
+
+            # Discard the cached steps from the first resampled one
+            for lm in [self.lm, draft_lm]:
+                lm.backbone.update_generation_cache(min(lm.backbone.cache_offset - lm.backbone.cache_prepend_length, next_offset - 1))
+
+            progress.update(next_offset - offset)
+            offset = next_offset
+
+            if callback is not None:
+                callback(offset - start_offset_sequence, gen_sequence_len - start_offset_sequence)
+
+        progress.close()
 
     @torch.no_grad()
     def generate(
@@ -350,6 +543,8 @@ class AudioLanguageModelWrapper(nn.Module):
         callback: tp.Optional[tp.Callable[[int, int], None]] = None,
         use_cache: bool = True,
         cfg_scale: float = 1.0,
+        draft_lm: tp.Optional[AudioLanguageModel] = None,
+        num_draft_steps: int = 4,
         **kwargs
     ):
         device = next(self.parameters()).device
@@ -404,41 +599,67 @@ class AudioLanguageModelWrapper(nn.Module):
 
         # Reset generation cache
         if use_cache and self.lm.backbone.use_generation_cache:
-            self.lm.backbone.reset_generation_cache(max_gen_len, batch_size if cfg_scale == 1.0 else batch_size * 2)
+            self.lm.backbone.reset_generation_cache(gen_sequence_len, batch_size if cfg_scale == 1.0 else batch_size * 2)
 
-        for offset in trange(start_offset_sequence, gen_sequence_len):
+        decode_step = self._compiled_decode_step if self._compiled_decode_step is not None else self._decode_step
+        sampling_kwargs = {key: kwargs[key] for key in ["top_k", "top_p", "temp"] if key in kwargs}
 
-            # Get the full sequence up to the current offset
-            curr_sequence = gen_sequence[..., prev_offset:offset]
+        if draft_lm is not None:
+            assert use_cache and self.lm.backbone.use_generation_cache, "Speculative decoding requires the generation cache"
 
-            next_token = self._sample_next_token(
-                curr_sequence,
+            self._generate_speculative(
+                gen_sequence,
+                start_offset_sequence,
+                draft_lm,
+                num_draft_steps,
                 conditioning_tensors=conditioning_tensors,
-                use_cache=use_cache,
                 cfg_scale=cfg_scale,
+                callback=callback,
                 **kwargs
             )
 
-            valid_mask = mask[..., offset:offset+1].expand(batch_size, -1, -1)
-            next_token[~valid_mask] = self.lm.masked_token_id
-
-            # Update the generated sequence with the next token
-            gen_sequence[..., offset:offset+1] = torch.where(
-                gen_sequence[..., offset:offset+1] == unknown_token,
-                next_token, 
-                gen_sequence[..., offset:offset+1]
-            )
-
-            if use_cache and self.lm.backbone.use_generation_cache:
-                # Only update the offset if caching is being used
-                prev_offset = offset
-
-                self.lm.backbone.update_generation_cache(offset)
-
-            if callback is not None:
-                # Callback to report progress
-                # Pass in the offset relative to the start of the sequence, and the length of the current sequence
-                callback(1 + offset - start_offset_sequence, gen_sequence_len - start_offset_sequence)
+        else:
+            for offset in trange(start_offset_sequence, gen_sequence_len):
+
+                # Get the full sequence up to the current offset
+                curr_sequence = gen_sequence[..., prev_offset:offset]
+
+                if use_cache and self.lm.backbone.use_generation_cache and offset > start_offset_sequence:
+                    # The conditioning and the previous steps are cached, only compute the latest step
+                    cache_offset = torch.tensor(self.lm.backbone.cache_offset, device=device)
+
+                    logits = decode_step(curr_sequence, cache_offset, cfg_scale=cfg_scale)
+
+                    next_token = self._sample_from_logits(logits, **sampling_kwargs)
+                else:
+                    next_token = self._sample_next_token(
+                        curr_sequence,
+                        conditioning_tensors=conditioning_tensors,
+                        use_cache=use_cache,
+                        cfg_scale=cfg_scale,
+                        **kwargs
+                    )
+
+                valid_mask = mask[..., offset:offset+1].expand(batch_size, -1, -1)
+                next_token[~valid_mask] = self.lm.masked_token_id
+
+                # Update the generated sequence with the next token
+                gen_sequence[..., offset:offset+1] = torch.where(
+                    gen_sequence[..., offset:offset+1] == unknown_token,
+                    next_token, 
+                    gen_sequence[..., offset:offset+1]
+                )
+
+                if use_cache and self.lm.backbone.use_generation_cache:
+                    # Only update the offset if caching is being used
+                    prev_offset = offset
+
+                    self.lm.backbone.update_generation_cache(offset)
+
+                if callback is not None:
+                    # Callback to report progress
+                    # Pass in the offset relative to the start of the sequence, and the length of the current sequence
+                    callback(1 + offset - start_offset_sequence, gen_sequence_len - start_offset_sequence)
 
         assert not (gen_sequence == unknown_token).any(), "Unknown tokens in generated sequence"
 
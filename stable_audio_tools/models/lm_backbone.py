@@ -39,6 +39,14 @@ class AudioLMBackbone(nn.Module):
     ):
         pass
 
+    def decode_step(
+        self,
+        x,
+        cache_offset
+    ):
+        # Backbones with a generation cache compute the new tokens x from the cache, see ContinuousTransformerAudioLMBackbone
+        raise NotImplementedError
+
 class XTransformersAudioLMBackbone(AudioLMBackbone):
     def __init__(self,
                  embed_dim: int,
@@ -105,8 +113,9 @@ class ContinuousTransformerAudioLMBackbone(AudioLMBackbone):
                  cross_attn_cond_dim: int = 0,
                  prepend_cond_dim: int = 0,
                  project_cross_attn_cond: bool = False,
+                 use_generation_cache: bool = True,
                  **kwargs):
-        super().__init__(embed_dim=embed_dim)
+        super().__init__(embed_dim=embed_dim, use_generation_cache=use_generation_cache)
 
         # Embeddings are done in the AudioLanguageModel, so we use the continuous-input transformer
         self.model = ContinuousTransformer(
@@ -137,8 +146,54 @@ class ContinuousTransformerAudioLMBackbone(AudioLMBackbone):
         else:
             self.to_cross_attn_embed = nn.Identity()
 
+        self.reset_generation_cache(None, None)
+
+    def reset_generation_cache(
+        self,
+        max_seq_len,
+        batch_size,
+        dtype=None
+    ):
+        # The KV caches are allocated on the first forward pass, once the number of prepended tokens is known
+        self.cache_max_seq_len = max_seq_len
+        self.cache_dtype = dtype
+        self.kv_caches = None
+        self.cache_context_kv = None
+        self.cache_prepend_length = 0
+        self.cache_offset = 0
+
+    def update_generation_cache(
+        self,
+        seqlen_offset
+    ):
+        # The sequence before seqlen_offset is cached, the next forward pass computes the tokens from seqlen_offset on.
+        # Moving the offset back discards the cached tokens after it.
+        self.cache_offset = self.cache_prepend_length + seqlen_offset
+
+    def decode_step(
+        self,
+        x,
+        cache_offset
+    ):
+        """
+        Computes the new tokens x (batch, seq, embed_dim) with the generation cache filled by a first forward pass with use_cache.
+        cache_offset is the position of the first new token in the cache, including the prepended tokens. Given as a tensor,
+        the step has static shapes and no Python state changes, so it can be compiled or captured in a CUDA graph.
+        """
+        return self.model(x, context_kv=self.cache_context_kv, kv_caches=self.kv_caches, cache_offset=cache_offset)
+
     def forward(self, x, mask=None, prepend_cond=None, prepend_cond_mask=None, cross_attn_cond=None, global_cond=None, use_cache=False):
 
+        use_cache = use_cache and self.use_generation_cache
+
+        if use_cache and self.kv_caches is not None:
+            # The prepended tokens and the cross-attention keys and values are already cached
+            output = self.decode_step(x, self.cache_offset)
+
+            self.cache_offset += x.shape[1]
+
+            return output
+
         prepend_length = 0
         if prepend_cond is not None:
             # Project the prepend conditioning to the embedding dimension
@@ -156,4 +211,25 @@ class ContinuousTransformerAudioLMBackbone(AudioLMBackbone):
             # Project the cross-attention conditioning to the embedding dimension
             cross_attn_cond = self.to_cross_attn_embed(cross_attn_cond)
 
+        if use_cache:
+            assert self.cache_max_seq_len is not None, "reset_generation_cache must be called before generating with the cache"
+
+            self.kv_caches = self.model.create_kv_caches(
+                x.shape[0],
+                prepend_length + self.cache_max_seq_len,
+                device=x.device,
+                dtype=self.cache_dtype if self.cache_dtype is not None else x.dtype
+            )
+
+            if cross_attn_cond is not None:
+                # The conditioning doesn't change during generation, project it once
+                self.cache_context_kv = self.model.project_context(cross_attn_cond)
+
+            output = self.model(x, mask=mask, prepend_embeds=prepend_cond, prepend_mask=prepend_cond_mask, context_kv=self.cache_context_kv, kv_caches=self.kv_caches)
+
+            self.cache_prepend_length = prepend_length
+            self.cache_offset = prepend_length + x.shape[1]
+
+            return output[:, prepend_length:, :]
+
         return self.model(x, mask=mask, context=cross_attn_cond, prepend_embeds=prepend_cond, prepend_mask=prepend_cond_mask)[:, prepend_length:, :]
\ No newline at end of file
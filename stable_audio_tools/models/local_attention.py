@@ -73,7 +73,7 @@ class ContinuousLocalTransformer(nn.Module):
         if prepend_cond is not None:
             x = torch.cat([prepend_cond, x], dim=1)
 
-        pos_emb = self.rotary_pos_emb.forward_from_seq_len(x.shape[1])
+        pos_emb = self.rotary_pos_emb.get_cos_sin(x.shape[1], dtype=torch.promote_types(x.dtype, torch.float32))
 
         for attn_norm, attn, xattn, ff_norm, ff in self.layers:
 
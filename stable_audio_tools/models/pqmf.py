@@ -3,6 +3,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 from einops import rearrange
+from functools import lru_cache
 from scipy.optimize import fmin
 from scipy.signal import firwin, kaiser, kaiser_beta, kaiserord
 
@@ -48,6 +49,182 @@ class PQMF(nn.Module):
         bands = apply_alias_cancellation(bands)
         return polyphase_synthesis(bands, self.filter_bank)
 
+    def get_streaming_analysis(self, flatten_bands=False):
+        """Returns a StreamingPQMFAnalysis that decomposes a signal block by block."""
+        return StreamingPQMFAnalysis(self, flatten_bands=flatten_bands)
+
+    def get_streaming_synthesis(self, flatten_bands=False):
+        """Returns a StreamingPQMFSynthesis that reconstructs a signal block by block."""
+        return StreamingPQMFSynthesis(self, flatten_bands=flatten_bands)
+
+
+class StreamingPQMFAnalysis:
+    """
+    Decomposes a signal into frequency bands block by block, with blocks of any length.
+
+    The polyphase frames that the next band frames still need are kept in a buffer per channel, which starts with the left zero padding of the offline analysis,
+    and the samples that don't fill a whole frame yet are kept until the next block. Band frames lag behind the input by half the polyphase filter length,
+    the rest is returned by flush at the end of the stream. The concatenated outputs of step and flush match PQMF.forward on the whole signal.
+
+    Parameters:
+    - pqmf (PQMF): The filter bank to stream.
+    - flatten_bands (bool): Return Batch x (Channels Bands) x Length as PQMFPretransform.encode does, instead of Batch x Channels x Bands x Length.
+    """
+
+    def __init__(self, pqmf, flatten_bands=False):
+        self.pqmf = pqmf
+        self.num_bands = pqmf.num_bands
+        self.flatten_bands = flatten_bands
+
+        self.num_taps = pqmf.filter_bank.shape[-1] // self.num_bands
+        assert self.num_taps >= 2, "Streaming is only supported for filter banks longer than the number of bands"
+
+        self.left_padding = self.num_taps // 2
+        self.right_padding = self.num_taps // 2 - 1
+
+        self.reset()
+
+    def reset(self):
+        """Starts a new stream."""
+        self.buffer = None
+        self.remainder = None
+        self.num_channels = None
+        self.num_frames = 0
+
+    def step(self, signal):
+        """Decomposes the next block of shape (Batch x Channels x Length), returning the band frames that are complete so far."""
+        assert signal.dim() == 3, "Streaming analysis expects blocks of shape (Batch x Channels x Length)"
+
+        if self.remainder is not None:
+            signal = torch.cat([self.remainder, signal], dim=-1)
+
+        num_samples = signal.shape[-1] // self.num_bands * self.num_bands
+        self.remainder = signal[..., num_samples:]
+
+        return self.process(signal[..., :num_samples])
+
+    def flush(self):
+        """Returns the rest of the band frames at the end of the stream, and resets the analysis for the next stream."""
+        assert self.remainder is not None, "Nothing to flush"
+
+        # The offline analysis pads the signal with zeros to a multiple of num_bands, and with zero frames on the right
+        signal = pad_signal(self.remainder, self.num_bands)
+        signal = nn.functional.pad(signal, (0, self.right_padding * self.num_bands))
+
+        bands = self.process(signal)
+
+        self.reset()
+
+        return bands
+
+    def process(self, signal):
+        batch_size, self.num_channels = signal.shape[:2]
+
+        frames = rearrange(signal, "b c (t n) -> (b c) n t", n=self.num_bands)
+
+        if self.buffer is None:
+            self.buffer = frames.new_zeros(frames.shape[0], self.num_bands, self.left_padding)
+
+        frames = torch.cat([self.buffer, frames], dim=-1)
+
+        num_outputs = frames.shape[-1] - self.num_taps + 1
+
+        if num_outputs <= 0:
+            self.buffer = frames
+            bands = frames.new_zeros(batch_size, self.num_channels, self.num_bands, 0)
+            return rearrange(bands, "b c n t -> b (c n) t") if self.flatten_bands else bands
+
+        self.buffer = frames[..., num_outputs:]
+
+        filter_bank = rearrange(self.pqmf.filter_bank, "c (t n) -> c n t", n=self.num_bands)
+        bands = nn.functional.conv1d(frames, filter_bank)
+        bands = rearrange(bands, "(b c) n t -> b c n t", c=self.num_channels)
+
+        bands = apply_alias_cancellation(bands, offset=self.num_frames)
+        self.num_frames += num_outputs
+
+        if self.flatten_bands:
+            bands = rearrange(bands, "b c n t -> b (c n) t")
+
+        return bands
+
+
+class StreamingPQMFSynthesis:
+    """
+    Reconstructs a signal from its frequency bands block by block, with blocks of any number of band frames.
+
+    The band frames that the next output frames still need are kept in a buffer per channel. Output samples lag behind the input by half the polyphase filter length,
+    the rest is returned by flush at the end of the stream. The concatenated outputs of step and flush match PQMF.inverse on all band frames.
+
+    Parameters:
+    - pqmf (PQMF): The filter bank to stream.
+    - flatten_bands (bool): Take Batch x (Channels Bands) x Length as PQMFPretransform.decode does, instead of Batch x Channels x Bands x Length.
+    """
+
+    def __init__(self, pqmf, flatten_bands=False):
+        self.pqmf = pqmf
+        self.num_bands = pqmf.num_bands
+        self.flatten_bands = flatten_bands
+
+        self.num_taps = pqmf.filter_bank.shape[-1] // self.num_bands
+        assert self.num_taps >= 2, "Streaming is only supported for filter banks longer than the number of bands"
+
+        # The offline synthesis pads by num_taps // 2 + 1 frames on both sides, then drops the first two and the last output frames
+        self.left_padding = self.num_taps // 2 - 1
+        self.right_padding = self.num_taps // 2
+
+        self.reset()
+
+    def reset(self):
+        """Starts a new stream."""
+        self.buffer = None
+        self.num_channels = None
+        self.num_frames = 0
+
+    def step(self, bands):
+        """Reconstructs the next band frames, returning the samples that are complete so far as (Batch x Channels x Length)."""
+        if self.flatten_bands:
+            bands = rearrange(bands, "b (c n) t -> b c n t", n=self.num_bands)
+
+        assert bands.dim() == 4, "Streaming synthesis expects blocks of shape (Batch x Channels x Bands x Length)"
+
+        bands = apply_alias_cancellation(bands, offset=self.num_frames)
+        self.num_frames += bands.shape[-1]
+
+        self.num_channels = bands.shape[1]
+
+        return self.process(rearrange(bands, "b c n t -> (b c) n t"))
+
+    def flush(self):
+        """Returns the rest of the signal at the end of the stream, and resets the synthesis for the next stream."""
+        assert self.buffer is not None, "Nothing to flush"
+
+        signal = self.process(self.buffer.new_zeros(self.buffer.shape[0], self.num_bands, self.right_padding))
+
+        self.reset()
+
+        return signal
+
+    def process(self, frames):
+        if self.buffer is None:
+            self.buffer = frames.new_zeros(frames.shape[0], self.num_bands, self.left_padding)
+
+        frames = torch.cat([self.buffer, frames], dim=-1)
+
+        num_outputs = frames.shape[-1] - self.num_taps + 1
+
+        if num_outputs <= 0:
+            self.buffer = frames
+            return frames.new_zeros(frames.shape[0] // self.num_channels, self.num_channels, 0)
+
+        self.buffer = frames[..., num_outputs:]
+
+        filter_bank = rearrange(self.pqmf.filter_bank.flip(-1), "c (t n) -> n c t", n=self.num_bands)
+        signal = nn.functional.conv1d(frames, filter_bank) * self.num_bands
+
+        signal = signal.flip(1)
+        return rearrange(signal, "(b c) n t -> b c (t n)", c=self.num_channels)
+
 
 def prepare_signal_dimensions(signal):
     """
@@ -205,6 +382,30 @@ def evaluate_filter_objective(angular_cutoff, attenuation, num_bands, filter_len
     return np.max(np.abs(convolved_filter[convolved_filter.shape[-1] // 2::2 * num_bands][1:]))
 
 
+@lru_cache(maxsize=None)
+def find_optimal_cutoff(attenuation, num_bands, filter_length=None):
+    """
+    Find the angular cutoff of the Kaiser lowpass prototype that minimizes the filter objective.
+    The optimization is cached, as every PQMF with the same specs designs the same filter.
+
+    Parameters
+    ----------
+    attenuation : float
+        The desired stopband attenuation in dB.
+    num_bands : int
+        Number of bands for the multiband filter system.
+    filter_length : int, optional
+        Desired length of the filter. If not provided, it's computed based on the given specs.
+
+    Returns
+    -------
+    float
+        The optimal angular cutoff.
+    """
+
+    return fmin(lambda angular_cutoff: evaluate_filter_objective(angular_cutoff, attenuation, num_bands, filter_length),
+                1 / num_bands, disp=0)[0]
+
 def design_prototype_filter(attenuation, num_bands, filter_length=None):
     """
     Design the optimal prototype filter for a multiband system given the desired specs.
@@ -224,8 +425,7 @@ def design_prototype_filter(attenuation, num_bands, filter_length=None):
         The optimal prototype filter coefficients.
     """
     
-    optimal_angular_cutoff = fmin(lambda angular_cutoff: evaluate_filter_objective(angular_cutoff, attenuation, num_bands, filter_length), 
-                                  1 / num_bands, disp=0)[0]
+    optimal_angular_cutoff = find_optimal_cutoff(attenuation, num_bands, filter_length)
     
     prototype_filter = design_kaiser_lowpass(optimal_angular_cutoff, attenuation, filter_length)
     return torch.tensor(prototype_filter, dtype=torch.float32)
@@ -254,7 +454,7 @@ def pad_to_nearest_power_of_two(x):
     
     return nn.functional.pad(x, (left_padding, right_padding))
 
-def apply_alias_cancellation(x):
+def apply_alias_cancellation(x, offset=0):
     """
     Applies alias cancellation by inverting the sign of every 
     second element of every second row, starting from the second 
@@ -268,6 +468,10 @@ def apply_alias_cancellation(x):
     -----------
     x : torch.Tensor
         The input tensor.
+
+    offset : int, optional
+        Index of the first element of the last dimension in the whole signal,
+        when 'x' is a block of a longer signal. Default is 0.
         
     Returns:
     --------
@@ -279,7 +483,7 @@ def apply_alias_cancellation(x):
     mask = torch.ones_like(x)
     
     # Update specific elements in the mask to -1 to perform inversion
-    mask[..., 1::2, ::2] = -1
+    mask[..., 1::2, offset % 2::2] = -1
     
     # Apply the mask to the input tensor 'x'
     return x * mask
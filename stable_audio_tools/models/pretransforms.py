@@ -2,6 +2,8 @@ import torch
 from einops import rearrange
 from torch import nn
 
+from .utils import has_folded_weight_norm, remove_weight_norm_from_model
+
 class Pretransform(nn.Module):
     def __init__(self, enable_grad, io_channels, is_discrete):
         super().__init__()
@@ -25,8 +27,10 @@ class Pretransform(nn.Module):
     def decode_tokens(self, tokens):
         raise NotImplementedError
 
+PRECISION_DTYPES = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+
 class AutoencoderPretransform(Pretransform):
-    def __init__(self, model, scale=1.0, model_half=False, iterate_batch=False, chunked=False):
+    def __init__(self, model, scale=1.0, model_half=False, precision=None, iterate_batch=False, encode_microbatch=None, decode_microbatch=None, chunked=False, chunk_batch_size=1):
         super().__init__(enable_grad=False, io_channels=model.io_channels, is_discrete=model.bottleneck is not None and model.bottleneck.is_discrete)
         self.model = model
         self.model.requires_grad_(False).eval()
@@ -35,44 +39,71 @@ class AutoencoderPretransform(Pretransform):
         self.io_channels = model.io_channels
         self.sample_rate = model.sample_rate
         
-        self.model_half = model_half
-        self.iterate_batch = iterate_batch
+        # model_half is the older spelling of precision="fp16"
+        if precision is None and model_half:
+            precision = "fp16"
+
+        # iterate_batch is the older spelling of a microbatch size of 1
+        self.encode_microbatch = 1 if iterate_batch and encode_microbatch is None else encode_microbatch
+        self.decode_microbatch = 1 if iterate_batch and decode_microbatch is None else decode_microbatch
 
         self.encoded_channels = model.latent_dim
 
         self.chunked = chunked
+        self.chunk_batch_size = chunk_batch_size
         self.num_quantizers = model.bottleneck.num_quantizers if model.bottleneck is not None and model.bottleneck.is_discrete else None
         self.codebook_size = model.bottleneck.codebook_size if model.bottleneck is not None and model.bottleneck.is_discrete else None
 
-        if self.model_half:
-            self.model.half()
-    
-    def encode(self, x, **kwargs):
-        
-        if self.model_half:
-            x = x.half()
-            self.model.to(torch.float16)
+        self.set_precision(precision)
 
-        encoded = self.model.encode_audio(x, chunked=self.chunked, iterate_batch=self.iterate_batch, **kwargs)
+    def set_precision(self, precision=None):
+        '''
+        Casts the autoencoder to the given precision ("fp32", "fp16" or "bf16") once, and keeps it there when the model that owns the pretransform is cast to another dtype.
+        With None, the autoencoder follows the dtype of the owning model.
+        '''
+        assert precision is None or precision in PRECISION_DTYPES, f"Unknown pretransform precision {precision}"
 
-        if self.model_half:
-            encoded = encoded.float()
+        self.precision = precision
+        self.pinned_dtype = PRECISION_DTYPES[precision] if precision is not None else None
 
-        return encoded / self.scale
+        if self.pinned_dtype is not None:
+            self.model.to(self.pinned_dtype)
 
-    def decode(self, z, **kwargs):
-        z = z * self.scale
+        self.model_dtype = next(self.model.parameters()).dtype
+
+    def _apply(self, fn, *args, **kwargs):
+        if self.pinned_dtype is not None:
+            convert = fn
+
+            # Device moves still apply, dtype casts of the owning model don't
+            def fn(tensor):
+                output = convert(tensor)
+                if tensor.is_floating_point() and output.dtype != tensor.dtype:
+                    return tensor.to(output.device)
+                return output
+
+        super()._apply(fn, *args, **kwargs)
 
-        if self.model_half:
-            z = z.half()
-            self.model.to(torch.float16)
+        # The dtype is only looked up when the module is moved or cast, not on every encode and decode
+        self.model_dtype = next(self.model.parameters()).dtype
 
-        decoded = self.model.decode_audio(z, chunked=self.chunked, iterate_batch=self.iterate_batch, **kwargs)
+        return self
 
-        if self.model_half:
-            decoded = decoded.float()
+    def encode(self, x, **kwargs):
+        dtype = x.dtype
+
+        encoded = self.model.encode_audio(x.to(self.model_dtype), chunked=self.chunked, chunk_batch_size=self.chunk_batch_size, microbatch_size=self.encode_microbatch, **kwargs)
+
+        return encoded.to(dtype) / self.scale
 
-        return decoded
+    def decode(self, z, **kwargs):
+        dtype = z.dtype
+
+        z = z * self.scale
+
+        decoded = self.model.decode_audio(z.to(self.model_dtype), chunked=self.chunked, chunk_batch_size=self.chunk_batch_size, microbatch_size=self.decode_microbatch, **kwargs)
+
+        return decoded.to(dtype)
     
     def tokenize(self, x, **kwargs):
         assert self.model.is_discrete, "Cannot tokenize with a continuous model"
@@ -87,6 +118,10 @@ class AutoencoderPretransform(Pretransform):
         return self.model.decode_tokens(tokens, **kwargs)
     
     def load_state_dict(self, state_dict, strict=True):
+        # Checkpoints exported for inference (see scripts/export_autoencoder.py) have their weight norm folded already
+        if has_folded_weight_norm(self.model, state_dict):
+            remove_weight_norm_from_model(self.model)
+
         self.model.load_state_dict(state_dict, strict=strict)
 
 class WaveletPretransform(Pretransform):
@@ -129,6 +164,13 @@ class PQMFPretransform(Pretransform):
         x = rearrange(x, "b (c n) t -> b c n t", n=self.pqmf.num_bands)
         # returns (Batch x Channels x Time) 
         return self.pqmf.inverse(x)
+
+    def get_streaming_encoder(self):
+        # Streams encode block by block, with the same (Batch x (Channels Bands) x Time) layout
+        return self.pqmf.get_streaming_analysis(flatten_bands=True)
+
+    def get_streaming_decoder(self):
+        return self.pqmf.get_streaming_synthesis(flatten_bands=True)
         
 class PretrainedDACPretransform(Pretransform):
     def __init__(self, model_type="44khz", model_bitrate="8kbps", scale=1.0, quantize_on_decode: bool = True, chunked=True):
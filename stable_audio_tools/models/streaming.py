@@ -0,0 +1,274 @@
+import math
+import torch
+
+from torch import nn
+
+from .autoencoders import DecoderBlock, OobleckDecoder, ResidualUnit
+from .blocks import SnakeBeta
+
+class StreamingConv1d:
+    """
+    Runs a stride 1 convolution on a stream of frames.
+    The frames that the next outputs still need are kept in a buffer, which starts with the left zero padding of the convolution.
+    """
+    def __init__(self, conv: nn.Conv1d):
+        assert conv.stride[0] == 1, "Streaming is only supported for stride 1 convolutions"
+
+        self.conv = conv
+        self.context = conv.dilation[0] * (conv.kernel_size[0] - 1)
+
+        if conv.padding == "same":
+            self.left_padding = self.context // 2
+        else:
+            self.left_padding = conv.padding[0]
+            assert 2 * self.left_padding == self.context, "Streaming is only supported for convolutions that preserve the sequence length"
+
+        self.right_padding = self.context - self.left_padding
+
+        self.reset()
+
+    def reset(self):
+        self.buffer = None
+
+    def step(self, x):
+        if self.buffer is None:
+            self.buffer = x.new_zeros(x.shape[0], x.shape[1], self.left_padding)
+
+        x = torch.cat([self.buffer, x], dim=-1)
+
+        num_outputs = x.shape[-1] - self.context
+
+        if num_outputs <= 0:
+            self.buffer = x
+            return x.new_zeros(x.shape[0], self.conv.out_channels, 0)
+
+        self.buffer = x[:, :, num_outputs:]
+
+        # Only keep the outputs that don't see the padding added by the convolution itself
+        return self.conv(x)[:, :, self.left_padding:self.left_padding + num_outputs]
+
+    def flush(self):
+        assert self.buffer is not None, "Nothing to flush"
+
+        return self.step(self.buffer.new_zeros(self.buffer.shape[0], self.buffer.shape[1], self.right_padding))
+
+class StreamingConvTranspose1d:
+    """
+    Runs a transposed convolution on a stream of frames.
+    Every output sample depends on the last floor((kernel_size - 1) / stride) input frames, which are kept in a buffer.
+    """
+    def __init__(self, conv: nn.ConvTranspose1d):
+        self.conv = conv
+        self.stride = conv.stride[0]
+        self.kernel_size = conv.kernel_size[0]
+        self.padding = conv.padding[0]
+
+        assert conv.dilation[0] == 1 and conv.output_padding[0] == 0, "Streaming is only supported for transposed convolutions without dilation and output padding"
+
+        self.buffer_length = (self.kernel_size - 1) // self.stride
+
+        assert self.padding <= self.buffer_length * self.stride and self.padding <= self.kernel_size - self.stride, "Padding is too large for streaming"
+
+        # Zero frames that flush the outputs of the last input frame
+        self.flush_length = math.ceil((self.kernel_size - self.stride) / self.stride)
+
+        self.reset()
+
+    def reset(self):
+        self.buffer = None
+        # The padding crops the start of the output
+        self.num_to_drop = self.padding
+
+    def step(self, x):
+        if self.buffer is None:
+            self.buffer = x.new_zeros(x.shape[0], x.shape[1], self.buffer_length)
+
+        x = torch.cat([self.buffer, x], dim=-1)
+
+        num_frames = x.shape[-1] - self.buffer_length
+
+        if num_frames == 0:
+            return x.new_zeros(x.shape[0], self.conv.out_channels, 0)
+
+        self.buffer = x[:, :, num_frames:]
+
+        # The outputs of the new frames that don't depend on future frames, offset by the padding the convolution crops itself
+        start = self.buffer_length * self.stride - self.padding
+        output = self.conv(x)[:, :, start:start + num_frames * self.stride]
+
+        num_to_drop = min(self.num_to_drop, output.shape[-1])
+        self.num_to_drop -= num_to_drop
+
+        return output[:, :, num_to_drop:]
+
+    def flush(self):
+        assert self.buffer is not None, "Nothing to flush"
+
+        output = self.step(self.buffer.new_zeros(self.buffer.shape[0], self.buffer.shape[1], self.flush_length))
+
+        # The padding crops the end of the output as well
+        num_to_drop = (self.flush_length + 1) * self.stride - self.kernel_size + self.padding
+
+        return output[:, :, :output.shape[-1] - num_to_drop]
+
+class StreamingPointwise:
+    """
+    Runs a layer where every output frame only depends on the input frame at the same position
+    """
+    def __init__(self, module: nn.Module):
+        self.module = module
+
+    def reset(self):
+        pass
+
+    def step(self, x):
+        if x.shape[-1] == 0:
+            return x
+
+        return self.module(x)
+
+    def flush(self):
+        return None
+
+class StreamingSnakeBeta(StreamingPointwise):
+    """
+    Runs a SnakeBeta activation on a stream of frames with the eager ops. The fused kernels are compiled per input shape,
+    and the few frames of every step would recompile them for each new length.
+    """
+    def step(self, x):
+        if x.shape[-1] == 0:
+            return x
+
+        return self.module(x, fused=False)
+
+class StreamingResidual:
+    """
+    Adds the input of a residual unit to the output of its branch, delaying the input to line up with the branch outputs
+    """
+    def __init__(self, branch):
+        self.branch = branch
+        self.reset()
+
+    def reset(self):
+        self.branch.reset()
+        self.skip = None
+
+    def step(self, x):
+        skip = x if self.skip is None else torch.cat([self.skip, x], dim=-1)
+
+        output = self.branch.step(x)
+        num_outputs = output.shape[-1]
+
+        self.skip = skip[:, :, num_outputs:]
+
+        return skip[:, :, :num_outputs] + output
+
+    def flush(self):
+        output = self.branch.flush()
+
+        if output is None:
+            return None
+
+        return self.skip[:, :, :output.shape[-1]] + output
+
+class StreamingSequential:
+    def __init__(self, layers):
+        self.layers = layers
+
+    def reset(self):
+        for layer in self.layers:
+            layer.reset()
+
+    def step(self, x):
+        for layer in self.layers:
+            x = layer.step(x)
+
+        return x
+
+    def flush(self):
+        # Every layer flushes its remaining outputs, after processing the outputs flushed by the layers before it
+        x = None
+
+        for layer in self.layers:
+            if x is not None:
+                x = layer.step(x)
+
+            tail = layer.flush()
+
+            if tail is not None:
+                x = tail if x is None else torch.cat([x, tail], dim=-1)
+
+        return x
+
+def create_streaming_layer(module: nn.Module):
+    """
+    Wraps the layers of an Oobleck decoder in their streaming counterparts
+    """
+    if isinstance(module, (OobleckDecoder, DecoderBlock)):
+        return create_streaming_layer(module.layers)
+    elif isinstance(module, ResidualUnit):
+        return StreamingResidual(create_streaming_layer(module.layers))
+    elif isinstance(module, nn.Sequential):
+        return StreamingSequential([create_streaming_layer(layer) for layer in module])
+    elif isinstance(module, nn.Conv1d):
+        return StreamingConv1d(module)
+    elif isinstance(module, nn.ConvTranspose1d):
+        return StreamingConvTranspose1d(module)
+    elif isinstance(module, SnakeBeta):
+        return StreamingSnakeBeta(module)
+    elif isinstance(module, (nn.ELU, nn.Tanh, nn.Identity)):
+        return StreamingPointwise(module)
+    elif isinstance(module, nn.Upsample) and module.mode == "nearest":
+        return StreamingPointwise(module)
+    else:
+        raise ValueError(f"Streaming is not supported for {type(module).__name__} layers")
+
+class StreamingDecoder:
+    """
+    Decodes latents of an autoencoder with an Oobleck decoder as they arrive, keeping the left context of every convolution between calls.
+
+    Outputs lag behind the inputs by the lookahead of the decoder, the audio that still depends on future latents is emitted by later calls to decode, or by flush at the end of the stream.
+    The concatenated outputs of decode and flush match offline decoding of the whole sequence.
+
+    Usage:
+        streaming_decoder = autoencoder.get_streaming_decoder()
+        for latents in latent_stream:
+            play(streaming_decoder.decode(latents))
+        play(streaming_decoder.flush())
+    """
+    def __init__(self, autoencoder):
+        assert autoencoder.pretransform is None, "Streaming decode is not supported for autoencoders with a pretransform"
+
+        self.autoencoder = autoencoder
+        self.decoder = create_streaming_layer(autoencoder.decoder)
+
+    def reset(self):
+        """
+        Starts a new stream
+        """
+        self.decoder.reset()
+
+    def postprocess(self, audio):
+        if self.autoencoder.soft_clip:
+            audio = torch.tanh(audio)
+
+        return audio
+
+    def decode(self, latents):
+        """
+        Decodes the next latent frames of shape (batch, latent_dim, frames), returning the audio that is complete so far
+        """
+        if self.autoencoder.bottleneck is not None:
+            latents = self.autoencoder.bottleneck.decode(latents)
+
+        return self.postprocess(self.decoder.step(latents))
+
+    def flush(self):
+        """
+        Returns the rest of the audio at the end of the stream, and resets the decoder for the next stream
+        """
+        audio = self.postprocess(self.decoder.flush())
+
+        self.reset()
+
+        return audio
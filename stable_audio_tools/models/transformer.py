@@ -1,3 +1,4 @@
+from contextlib import nullcontext
 from functools import reduce, partial
 from packaging import version
 
@@ -7,25 +8,49 @@ import torch
 import torch.nn.functional as F
 from torch import nn, einsum
 from torch.cuda.amp import autocast
-from typing import Callable, Literal
+from typing import Callable, Literal, NamedTuple
+
+from .blocks import compile
 
 try:
-    from flash_attn import flash_attn_func, flash_attn_kvpacked_func
+    from flash_attn import flash_attn_func, flash_attn_kvpacked_func, flash_attn_varlen_func
 except ImportError as e:
     print(e)
     print('flash_attn not installed, disabling Flash Attention')
     flash_attn_kvpacked_func = None
     flash_attn_func = None
+    flash_attn_varlen_func = None
 
 try:
     import natten
 except ImportError:
     natten = None
 
+# scaled_dot_product_attention broadcasts key/value heads over query heads from torch 2.5 on
+sdpa_supports_gqa = version.parse(torch.__version__) >= version.parse('2.5.0')
+
 def checkpoint(function, *args, **kwargs):
     kwargs.setdefault("use_reentrant", False)
     return torch.utils.checkpoint.checkpoint(function, *args, **kwargs)
 
+def saved_activation_bytes(function, *args, **kwargs):
+    """
+    Runs function, returning its output and the size in bytes of the activations it saves for the backward pass.
+    Parameters saved by the backward pass don't count, and tensors sharing a storage are counted once.
+    """
+    storages = {}
+
+    def pack(tensor):
+        if not isinstance(tensor, nn.Parameter):
+            storage = tensor.untyped_storage()
+            storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        output = function(*args, **kwargs)
+
+    return output, sum(storages.values())
+
 
 # Copied and modified from https://github.com/lucidrains/x-transformers/blob/main/x_transformers/attend.py under MIT License
 # License can be found in LICENSES/LICENSE_XTRANSFORMERS.txt
@@ -108,6 +133,9 @@ class RotaryEmbedding(nn.Module):
         assert interpolation_factor >= 1.
         self.interpolation_factor = interpolation_factor
 
+        # cos/sin tables per (device, dtype), see get_cos_sin
+        self._cos_sin_cache = {}
+
         if not use_xpos:
             self.register_buffer('scale', None)
             return
@@ -123,6 +151,26 @@ class RotaryEmbedding(nn.Module):
         t = torch.arange(seq_len, device = device)
         return self.forward(t)
 
+    def get_cos_sin(self, seq_len, dtype = torch.float32):
+        """
+        Returns the cos and sin tables of the first seq_len positions as RotaryTables, for apply_rotary_tables.
+        The tables are cached per device and dtype and grown to the longest sequence seen, so all layers and sampling steps share them.
+        """
+        assert self.scale is None, "Cached rotary tables are not supported with xpos"
+
+        key = (self.inv_freq.device, dtype)
+        tables = self._cos_sin_cache.get(key, None)
+
+        if tables is None or tables.cos.shape[0] < seq_len:
+            freqs, _ = self.forward_from_seq_len(seq_len)
+            tables = RotaryTables(freqs.cos().to(dtype), freqs.sin().to(dtype))
+
+            # Compiled graphs compute the tables inline instead of mutating the cache
+            if not is_compiling():
+                self._cos_sin_cache[key] = tables
+
+        return RotaryTables(tables.cos[:seq_len], tables.sin[:seq_len])
+
     @autocast(enabled = False)
     def forward(self, t):
         device = self.inv_freq.device
@@ -143,6 +191,17 @@ class RotaryEmbedding(nn.Module):
 
         return freqs, scale
 
+class RotaryTables(NamedTuple):
+    cos: torch.Tensor
+    sin: torch.Tensor
+
+def is_compiling():
+    # torch.compiler.is_compiling was added in torch 2.3
+    if hasattr(torch, "compiler") and hasattr(torch.compiler, "is_compiling"):
+        return torch.compiler.is_compiling()
+
+    return torch._dynamo.is_compiling()
+
 def rotate_half(x):
     x = rearrange(x, '... (j d) -> ... j d', j = 2)
     x1, x2 = x.unbind(dim = -2)
@@ -169,6 +228,25 @@ def apply_rotary_pos_emb(t, freqs, scale = 1):
 
     return torch.cat((t, t_unrotated), dim = -1)
 
+def apply_rotary_tables(t, cos, sin):
+    """
+    Applies rotary embeddings from cached cos/sin tables to t of shape (..., seq_len, dim_heads), rotating the last seq_len positions.
+    The rotation is computed in the dtype of the tables (at least float32). In the fused version, the cast of t is fused into the kernel instead of being materialized.
+    """
+    out_dtype = t.dtype
+    rot_dim, seq_len = cos.shape[-1], t.shape[-2]
+    cos, sin = cos[-seq_len:], sin[-seq_len:]
+
+    # partial rotary embeddings, Wang et al. GPT-J
+    t, t_unrotated = t[..., :rot_dim], t[..., rot_dim:]
+    t = t.to(cos.dtype)
+    t = t * cos + rotate_half(t) * sin
+
+    return torch.cat((t.to(out_dtype), t_unrotated), dim = -1)
+
+# Single-kernel version of the above, used on CUDA. Other devices run the eager ops
+fused_apply_rotary_tables = compile(apply_rotary_tables)
+
 # norms
 class LayerNorm(nn.Module):
     def __init__(self, dim, bias=False, fix_scale=False):
@@ -191,6 +269,27 @@ class LayerNorm(nn.Module):
     def forward(self, x):
         return F.layer_norm(x, x.shape[-1:], weight=self.gamma, bias=self.beta)
 
+# adaLN
+
+def layer_norm_modulate(x, weight, bias, scale, shift):
+    """
+    Layer norm (skipped when weight is None) followed by the adaLN scale and shift
+    """
+    if weight is not None:
+        x = F.layer_norm(x, x.shape[-1:], weight=weight, bias=bias)
+
+    return x * (1 + scale) + shift
+
+def gate_residual(x, gate, residual):
+    """
+    Applies the adaLN gate to a branch output and adds the residual
+    """
+    return x * torch.sigmoid(1 - gate) + residual
+
+# Single-kernel versions of the above, used on CUDA. Other devices run the eager ops
+fused_layer_norm_modulate = compile(layer_norm_modulate)
+fused_gate_residual = compile(gate_residual)
+
 # feedforward
 
 class GLU(nn.Module):
@@ -268,6 +367,45 @@ class FeedForward(nn.Module):
     def forward(self, x):
         return self.ff(x)
 
+class KVCache:
+    """
+    Preallocated keys and values of a self-attention layer for autoregressive generation.
+
+    The buffers have a static shape of (batch, kv_heads, max_seq_len, dim_heads). The keys and values of new tokens are written
+    at their positions, and attention reads the whole buffer with a mask of the positions written so far, so the shapes don't change between steps.
+    """
+    def __init__(self, batch_size, kv_heads, max_seq_len, dim_heads, device = None, dtype = None):
+        # Keep the key length aligned to 8, the memory-efficient kernel would pad the buffers on every step otherwise
+        max_seq_len = (max_seq_len + 7) // 8 * 8
+
+        self.k = torch.zeros((batch_size, kv_heads, max_seq_len, dim_heads), device = device, dtype = dtype)
+        self.v = torch.zeros_like(self.k)
+
+        # The buffers are updated in place by compiled decode steps, keeping their address fixed lets CUDA graphs capture the update
+        if hasattr(torch._dynamo, "mark_static_address"):
+            torch._dynamo.mark_static_address(self.k)
+            torch._dynamo.mark_static_address(self.v)
+
+    @property
+    def max_seq_len(self):
+        return self.k.shape[2]
+
+    def update(self, k, v, positions):
+        """
+        Writes the keys and values of shape (b, h, n, d) at the given positions, and returns the full buffers
+        """
+        self.k.index_copy_(2, positions, k.to(self.k.dtype))
+        self.v.index_copy_(2, positions, v.to(self.v.dtype))
+
+        return self.k, self.v
+
+    def get_mask(self, positions):
+        """
+        Returns the (1, 1, n, max_seq_len) attention mask of queries at the given positions, which see the keys up to their own position
+        """
+        key_positions = torch.arange(self.max_seq_len, device = positions.device)
+        return (key_positions <= positions[:, None]).view(1, 1, positions.shape[0], self.max_seq_len)
+
 class Attention(nn.Module):
     def __init__(
         self,
@@ -277,7 +415,9 @@ class Attention(nn.Module):
         causal = False,
         zero_init_output=True,
         qk_norm = False,
-        natten_kernel_size = None
+        natten_kernel_size = None,
+        kv_heads = None,
+        window_size = None
     ):
         super().__init__()
         self.dim = dim
@@ -287,13 +427,19 @@ class Attention(nn.Module):
         dim_kv = dim_context if dim_context is not None else dim
         
         self.num_heads = dim // dim_heads
-        self.kv_heads = dim_kv // dim_heads
+
+        # Fewer key/value heads than query heads gives grouped-query attention, a single one multi-query attention
+        self.kv_heads = kv_heads if kv_heads is not None else dim_kv // dim_heads
+
+        assert self.num_heads % self.kv_heads == 0, "The number of heads must be a multiple of the number of key/value heads"
+
+        dim_kv_out = self.kv_heads * dim_heads
 
         if dim_context is not None:
             self.to_q = nn.Linear(dim, dim, bias=False)
-            self.to_kv = nn.Linear(dim_kv, dim_kv * 2, bias=False)
+            self.to_kv = nn.Linear(dim_kv, dim_kv_out * 2, bias=False)
         else:
-            self.to_qkv = nn.Linear(dim, dim * 3, bias=False)
+            self.to_qkv = nn.Linear(dim, dim + dim_kv_out * 2, bias=False)
 
         self.to_out = nn.Linear(dim, dim, bias=False)
 
@@ -302,6 +448,10 @@ class Attention(nn.Module):
 
         self.qk_norm = qk_norm
 
+        # Sliding window self-attention, see windowed_attn
+        assert window_size is None or window_size >= 2, "window_size must be at least 2"
+        self.window_size = window_size
+
         # Using 1d neighborhood attention
         self.natten_kernel_size = natten_kernel_size
         if natten_kernel_size is not None:
@@ -326,15 +476,9 @@ class Attention(nn.Module):
             causal = None
     ):
         batch, heads, q_len, _, k_len, device = *q.shape, k.shape[-2], q.device
-        kv_heads = k.shape[1]
         # Recommended for multi-query single-key-value attention by Tri Dao
         # kv shape torch.Size([1, 512, 64]) -> torch.Size([1, 8, 512, 64])
 
-        if heads != kv_heads:
-            # Repeat interleave kv_heads to match q_heads
-            heads_per_kv_head = heads // kv_heads
-            k, v = map(lambda t: t.repeat_interleave(heads_per_kv_head, dim = 1), (k, v))
-
         if k.ndim == 3:
             k = rearrange(k, 'b ... -> b 1 ...').expand_as(q)
 
@@ -345,15 +489,21 @@ class Attention(nn.Module):
 
         if q_len == 1 and causal:
             causal = False
+
+        if mask is not None and not causal and k_len % 8 != 0:
+            # The memory-efficient kernel needs the mask rows aligned to 8 elements, pad with masked-out keys
+            pad_length = 8 - k_len % 8
+            k, v = map(lambda t: F.pad(t, (0, 0, 0, pad_length)), (k, v))
+            mask = torch.cat([mask, mask.new_zeros(*mask.shape[:-1], pad_length)], dim = -1)
+            k_len += pad_length
         
         if mask is not None:
             assert mask.ndim == 4
-            mask = mask.expand(batch, heads, q_len, k_len)
 
         # handle kv cache - this should be bypassable in updated flash attention 2
 
         if k_len > q_len and causal:
-            causal_mask = self.create_causal_mask(q_len, k_len, device = device)
+            causal_mask = create_causal_mask(q_len, k_len, device = device)
             if mask is None:
                 mask = ~causal_mask
             else:
@@ -365,7 +515,7 @@ class Attention(nn.Module):
         row_is_entirely_masked = None
 
         if mask is not None and causal:
-            causal_mask = self.create_causal_mask(q_len, k_len, device = device)
+            causal_mask = create_causal_mask(q_len, k_len, device = device)
             mask = mask & ~causal_mask
 
             # protect against an entire row being masked out
@@ -374,14 +524,42 @@ class Attention(nn.Module):
             mask[..., 0] = mask[..., 0] | row_is_entirely_masked
 
             causal = False
+
+        kv_heads = k.shape[1]
+        heads_per_kv_head = heads // kv_heads
+        sdpa_kwargs = {}
+        fold_groups = False
+
+        if heads != kv_heads:
+            if not causal and (mask is None or mask.shape[-2] == 1):
+                # The query heads sharing a key/value head attend to the same keys, fold them into the query sequence
+                fold_groups = True
+                q = rearrange(q, 'b (h g) n d -> b h (g n) d', g = heads_per_kv_head)
+                q_len, heads = q_len * heads_per_kv_head, kv_heads
+            elif sdpa_supports_gqa and mask is None:
+                # The kernel broadcasts the key/value heads
+                sdpa_kwargs["enable_gqa"] = True
+            else:
+                # Repeat interleave kv_heads to match q_heads
+                k, v = map(lambda t: t.repeat_interleave(heads_per_kv_head, dim = 1), (k, v))
+
+        if mask is not None:
+            mask = mask.expand(batch, heads, q_len, k_len)
         
-        with torch.backends.cuda.sdp_kernel(**self.sdp_kwargs):
+        # The backend selection context breaks compiled graphs, it is only entered in eager mode
+        sdp_context = torch.backends.cuda.sdp_kernel(**self.sdp_kwargs) if not is_compiling() else nullcontext()
+
+        with sdp_context:
             out = F.scaled_dot_product_attention(
                 q, k, v,
                 attn_mask = mask,
-                is_causal = causal
+                is_causal = causal,
+                **sdpa_kwargs
             )
 
+        if fold_groups:
+            out = rearrange(out, 'b h (g n) d -> b (h g) n d', g = heads_per_kv_head)
+
         # for a row that is entirely masked out, should zero out the output of that row token
 
         if row_is_entirely_masked is not None:
@@ -389,6 +567,130 @@ class Attention(nn.Module):
 
         return out
 
+    def flash_attn_varlen(
+            self,
+            q,
+            k,
+            v,
+            key_padding_mask
+    ):
+        """
+        Flash Attention 2 with a key padding mask. The masked keys and values are dropped, and every query attends to the valid keys of its batch item.
+        q, k and v are (b, n, h, d), key_padding_mask is (b, j) and True for valid keys.
+        """
+        batch, q_len = q.shape[:2]
+
+        k_lens = key_padding_mask.sum(dim=-1, dtype=torch.int32)
+        cu_seqlens_q = torch.arange(0, (batch + 1) * q_len, q_len, device=q.device, dtype=torch.int32)
+        cu_seqlens_k = F.pad(k_lens.cumsum(dim=0, dtype=torch.int32), (1, 0))
+
+        out = flash_attn_varlen_func(
+            rearrange(q, 'b n h d -> (b n) h d'),
+            k[key_padding_mask],
+            v[key_padding_mask],
+            cu_seqlens_q,
+            cu_seqlens_k,
+            q_len,
+            int(k_lens.max())
+        )
+
+        return rearrange(out, '(b n) h d -> b n h d', b = batch)
+
+    def windowed_attn(
+            self,
+            q,
+            k,
+            v,
+            num_global_tokens = 0,
+            key_padding_mask = None,
+            causal = False
+    ):
+        """
+        Sliding window attention. Every query attends to the keys at most window_size // 2 positions away, and to the first num_global_tokens tokens,
+        which attend to and are attended by the whole sequence. q, k and v are (b, h, n, d), key_padding_mask is (b, n) and True for valid keys.
+
+        The local tokens are split into blocks of window_size // 2 queries, which attend to their own and the two neighbouring blocks of keys (plus the global tokens) with a block mask,
+        so time and memory grow linearly with the sequence length.
+        """
+        batch, heads, n, dim_heads = q.shape
+        kv_heads, radius, num_global = k.shape[1], self.window_size // 2, num_global_tokens
+        local_len = n - num_global
+        device = q.device
+
+        num_blocks = (local_len + radius - 1) // radius
+        pad_length = num_blocks * radius - local_len
+
+        # Keys and values of the block before, the block itself and the block after for every block of queries, following the global tokens
+        def to_blocks(t):
+            t_global, t_local = t[:, :, :num_global], t[:, :, num_global:]
+            t_local = F.pad(t_local, (0, 0, radius, pad_length + radius))
+            t_local = rearrange(t_local.unfold(2, 3 * radius, radius), 'b h nb d w -> (b nb) h w d')
+            t_global = repeat(t_global, 'b h g d -> (b nb) h g d', nb = num_blocks)
+            return torch.cat([t_global, t_local], dim = 2)
+
+        k_blocks, v_blocks = map(to_blocks, (k, v))
+
+        q_global, q_local = q[:, :, :num_global], q[:, :, num_global:]
+        q_local = rearrange(F.pad(q_local, (0, 0, 0, pad_length)), 'b h (nb r) d -> (b nb) h r d', r = radius)
+
+        # Block mask of shape (num_blocks, radius, num_global + 3 * radius)
+        q_pos = torch.arange(num_blocks * radius, device = device).view(num_blocks, radius, 1)
+        k_pos = (torch.arange(num_blocks, device = device) * radius - radius).view(num_blocks, 1, 1) + torch.arange(3 * radius, device = device)
+
+        local_mask = ((k_pos - q_pos).abs() <= radius) & (k_pos >= 0) & (k_pos < local_len)
+
+        if causal:
+            local_mask = local_mask & (k_pos <= q_pos)
+
+        mask = torch.cat([local_mask.new_ones(num_blocks, radius, num_global), local_mask], dim = -1)
+        mask = repeat(mask, 'nb r j -> b nb r j', b = batch).contiguous()
+
+        if key_padding_mask is not None:
+            key_padding_mask = key_padding_mask.bool()
+            padding_global = repeat(key_padding_mask[:, :num_global], 'b g -> b nb g', nb = num_blocks)
+            padding_local = F.pad(key_padding_mask[:, num_global:], (radius, pad_length + radius)).unfold(1, 3 * radius, radius)
+            mask = mask & rearrange(torch.cat([padding_global, padding_local], dim = -1), 'b nb j -> b nb 1 j')
+
+            # protect against an entire row being masked out
+            mask[..., 0] = mask[..., 0] | ~mask.any(dim = -1)
+
+        mask = rearrange(mask, 'b nb r j -> (b nb) 1 r j')
+
+        heads_per_kv_head = heads // kv_heads
+
+        if heads_per_kv_head > 1:
+            # The query heads sharing a key/value head attend to the same keys, fold them into the queries of the block
+            q_local = rearrange(q_local, 'x (h g) r d -> x h (g r) d', g = heads_per_kv_head)
+            mask = mask.repeat(1, 1, heads_per_kv_head, 1)
+
+        out = F.scaled_dot_product_attention(q_local, k_blocks, v_blocks, attn_mask = mask)
+
+        out = rearrange(out, 'x h (g r) d -> x (h g) r d', g = heads_per_kv_head)
+        out = rearrange(out, '(b nb) h r d -> b h (nb r) d', b = batch)[:, :, :local_len]
+
+        if num_global > 0:
+            # The global tokens attend to the whole sequence
+            global_mask = rearrange(key_padding_mask, 'b j -> b 1 1 j') if key_padding_mask is not None else None
+
+            if causal:
+                # The global tokens come first, so they see the keys up to their own position
+                causal_mask = torch.ones((num_global, n), device = device, dtype = torch.bool).tril().view(1, 1, num_global, n)
+                global_mask = causal_mask if global_mask is None else global_mask & causal_mask
+
+            out_global = self.flash_attn(q_global, k, v, mask = global_mask, causal = False)
+            out = torch.cat([out_global, out], dim = 2)
+
+        return out
+
+    def project_context(self, context):
+        """
+        Projects the cross-attention context to keys and values of shape (b, h, n, d).
+        The result can be passed to forward as context_kv, so a context that doesn't change between calls is only projected once.
+        """
+        k, v = self.to_kv(context).chunk(2, dim=-1)
+
+        return tuple(rearrange(t, 'b n (h d) -> b h n d', h = self.kv_heads) for t in (k, v))
+
     def forward(
         self,
         x,
@@ -396,9 +698,13 @@ class Attention(nn.Module):
         mask = None,
         context_mask = None,
         rotary_pos_emb = None,
-        causal = None
+        causal = None,
+        context_kv = None,
+        num_global_tokens = 0,
+        kv_cache = None,
+        cache_positions = None
     ):
-        h, kv_h, has_context = self.num_heads, self.kv_heads, context is not None
+        h, kv_h, has_context = self.num_heads, self.kv_heads, context is not None or context_kv is not None
 
         kv_input = context if has_context else x
 
@@ -407,20 +713,27 @@ class Attention(nn.Module):
             q = self.to_q(x)
             q = rearrange(q, 'b n (h d) -> b h n d', h = h)
 
-            k, v = self.to_kv(kv_input).chunk(2, dim=-1)
+            if context_kv is None:
+                context_kv = self.project_context(kv_input)
 
-            k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h = kv_h), (k, v))
+            k, v = context_kv
         else:
             # Use fused linear projection
-            q, k, v = self.to_qkv(x).chunk(3, dim=-1)
-            q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h = h), (q, k, v))
+            q, k, v = self.to_qkv(x).split([h * self.dim_heads, kv_h * self.dim_heads, kv_h * self.dim_heads], dim=-1)
+            q = rearrange(q, 'b n (h d) -> b h n d', h = h)
+            k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h = kv_h), (k, v))
         
         # Normalize q and k for cosine sim attention
         if self.qk_norm:
             q = F.normalize(q, dim=-1)
             k = F.normalize(k, dim=-1)
 
-        if rotary_pos_emb is not None and not has_context:
+        if isinstance(rotary_pos_emb, RotaryTables) and not has_context:
+            apply_rotary_tables_fn = fused_apply_rotary_tables if q.is_cuda else apply_rotary_tables
+
+            q = apply_rotary_tables_fn(q, *rotary_pos_emb)
+            k = apply_rotary_tables_fn(k, *rotary_pos_emb)
+        elif rotary_pos_emb is not None and not has_context:
             freqs, _ = rotary_pos_emb
 
             q_dtype = q.dtype
@@ -445,6 +758,9 @@ class Attention(nn.Module):
         masks = []
         final_attn_mask = None # The mask that will be applied to the attention matrix, taking all masks into account
 
+        # The (b, j) key padding mask, used directly by the Flash Attention 2 path
+        key_padding_mask = input_mask
+
         if input_mask is not None:
             input_mask = rearrange(input_mask, 'b j -> b 1 1 j')
             masks.append(~input_mask)
@@ -461,13 +777,28 @@ class Attention(nn.Module):
         if n == 1 and causal:
             causal = False
 
-        if self.natten_kernel_size is not None:
+        if kv_cache is not None:
+            assert not has_context and self.natten_kernel_size is None and self.window_size is None, "The KV cache only supports full self-attention"
+
+            # Attend to the cached keys of the previous tokens and the keys written for these ones
+            k, v = kv_cache.update(k, v, cache_positions)
+            out = self.flash_attn(q, k, v, mask = kv_cache.get_mask(cache_positions), causal = False)
+
+        elif self.window_size is not None and not has_context and n - num_global_tokens > self.window_size // 2 + 1:
+            # Sequences shorter than the window fall through to full attention
+            out = self.windowed_attn(q, k, v, num_global_tokens = num_global_tokens, key_padding_mask = key_padding_mask, causal = causal)
+
+        elif self.natten_kernel_size is not None:
             if natten is None:
                 raise ImportError('natten not installed, please install natten to use neighborhood attention')
             
             dtype_in = q.dtype
             q, k, v = map(lambda t: t.to(torch.float32), (q, k, v))
 
+            if h != kv_h:
+                # Neighborhood attention needs a key/value head per query head
+                k, v = map(lambda t: t.repeat_interleave(h // kv_h, dim = 1), (k, v))
+
             attn = natten.functional.natten1dqk(q, k, kernel_size = self.natten_kernel_size, dilation=1)
 
             if final_attn_mask is not None:
@@ -478,13 +809,16 @@ class Attention(nn.Module):
             out = natten.functional.natten1dav(attn, v, kernel_size = self.natten_kernel_size, dilation=1).to(dtype_in)
 
         # Prioritize Flash Attention 2
-        elif self.use_fa_flash:
-            assert final_attn_mask is None, 'masking not yet supported for Flash Attention 2'
+        # Masked causal attention isn't expressible with the variable-length kernel, it falls back to PyTorch below
+        elif self.use_fa_flash and (final_attn_mask is None or not causal):
             # Flash Attention 2 requires FP16 inputs
             fa_dtype_in = q.dtype
             q, k, v = map(lambda t: rearrange(t, 'b h n d -> b n h d').to(torch.float16), (q, k, v))
             
-            out = flash_attn_func(q, k, v, causal = causal)
+            if final_attn_mask is None:
+                out = flash_attn_func(q, k, v, causal = causal)
+            else:
+                out = self.flash_attn_varlen(q, k, v, key_padding_mask.bool())
             
             out = rearrange(out.to(fa_dtype_in), 'b n h d -> b h n d')
 
@@ -495,32 +829,32 @@ class Attention(nn.Module):
         else:
             # Fall back to custom implementation
 
-            if h != kv_h:
-                # Repeat interleave kv_heads to match q_heads
-                heads_per_kv_head = h // kv_h
-                k, v = map(lambda t: t.repeat_interleave(heads_per_kv_head, dim = 1), (k, v))
-
             scale = 1. / (q.shape[-1] ** 0.5)
 
             kv_einsum_eq = 'b j d' if k.ndim == 3 else 'b h j d'
 
-            dots = einsum(f'b h i d, {kv_einsum_eq} -> b h i j', q, k) * scale
+            # Group the query heads by the key/value head they share, so k and v broadcast over the group
+            heads_per_kv_head = h // k.shape[1] if k.ndim == 4 else h
+            q = rearrange(q, 'b (h g) i d -> b h g i d', g = heads_per_kv_head) if k.ndim == 4 else rearrange(q, 'b h i d -> b 1 h i d')
+
+            dots = einsum(f'b h g i d, {kv_einsum_eq} -> b h g i j', q, k) * scale
             
             i, j, dtype = *dots.shape[-2:], dots.dtype
 
             mask_value = -torch.finfo(dots.dtype).max
 
             if final_attn_mask is not None:
-                dots = dots.masked_fill(~final_attn_mask, mask_value)
+                dots = dots.masked_fill(~final_attn_mask.unsqueeze(2), mask_value)
 
             if causal:
-                causal_mask = self.create_causal_mask(i, j, device = device)
+                causal_mask = create_causal_mask(i, j, device = device)
                 dots = dots.masked_fill(causal_mask, mask_value)
 
             attn = F.softmax(dots, dim=-1, dtype=torch.float32)
             attn = attn.type(dtype)
 
-            out = einsum(f'b h i j, {kv_einsum_eq} -> b h i d', attn, v)
+            out = einsum(f'b h g i j, {kv_einsum_eq} -> b h g i d', attn, v)
+            out = rearrange(out, 'b h g i d -> b (h g) i d')
 
         # merge heads
         out = rearrange(out, ' b h n d -> b n (h d)')
@@ -588,6 +922,8 @@ class TransformerBlock(nn.Module):
             conformer = False,
             layer_ix = -1,
             remove_norms = False,
+            kv_heads = None,
+            window_size = None,
             attn_kwargs = {},
             ff_kwargs = {},
             norm_kwargs = {}
@@ -607,6 +943,8 @@ class TransformerBlock(nn.Module):
             dim_heads = dim_heads,
             causal = causal,
             zero_init_output=zero_init_branch_outputs,
+            kv_heads = kv_heads,
+            window_size = window_size,
             **attn_kwargs
         )
 
@@ -616,7 +954,8 @@ class TransformerBlock(nn.Module):
                 dim,
                 dim_heads = dim_heads,
                 dim_context=dim_context,
-                causal = causal,
+                # Every token sees the whole conditioning, a causal mask over the context would depend on the sequence length
+                causal = False,
                 zero_init_output=zero_init_branch_outputs,
                 **attn_kwargs
             )
@@ -626,6 +965,9 @@ class TransformerBlock(nn.Module):
 
         self.layer_ix = layer_ix
 
+        # Set by the "attention" checkpointing policy of ContinuousTransformer
+        self.checkpoint_attention = False
+
         self.conformer = ConformerModule(dim, norm_kwargs=norm_kwargs) if conformer else None
 
         self.global_cond_dim = global_cond_dim
@@ -639,6 +981,27 @@ class TransformerBlock(nn.Module):
             nn.init.zeros_(self.to_scale_shift_gate[1].weight)
             #nn.init.zeros_(self.to_scale_shift_gate_self[1].bias)
 
+    def modulate_norm(self, norm, x, scale, shift):
+        layer_norm_modulate_fn = fused_layer_norm_modulate if x.is_cuda else layer_norm_modulate
+
+        if isinstance(norm, LayerNorm):
+            return layer_norm_modulate_fn(x, norm.gamma, norm.beta, scale, shift)
+
+        # Blocks built with remove_norms
+        return layer_norm_modulate_fn(x, None, None, scale, shift)
+
+    def gate_residual(self, x, gate, residual):
+        gate_residual_fn = fused_gate_residual if x.is_cuda else gate_residual
+
+        return gate_residual_fn(x, gate, residual)
+
+    def attend(self, attn, x, **kwargs):
+        # Recomputes the attention in the backward pass instead of storing its activations
+        if self.checkpoint_attention and self.training and torch.is_grad_enabled():
+            return checkpoint(attn, x, **kwargs)
+
+        return attn(x, **kwargs)
+
     def forward(
         self,
         x,
@@ -646,7 +1009,11 @@ class TransformerBlock(nn.Module):
         global_cond=None,
         mask = None,
         context_mask = None,
-        rotary_pos_emb = None
+        rotary_pos_emb = None,
+        context_kv = None,
+        num_global_tokens = 0,
+        kv_cache = None,
+        cache_positions = None
     ):
         if self.global_cond_dim is not None and self.global_cond_dim > 0 and global_cond is not None:
             
@@ -654,31 +1021,27 @@ class TransformerBlock(nn.Module):
 
             # self-attention with adaLN
             residual = x
-            x = self.pre_norm(x)
-            x = x * (1 + scale_self) + shift_self
-            x = self.self_attn(x, mask = mask, rotary_pos_emb = rotary_pos_emb)
-            x = x * torch.sigmoid(1 - gate_self)
-            x = x + residual
+            x = self.modulate_norm(self.pre_norm, x, scale_self, shift_self)
+            x = self.attend(self.self_attn, x, mask = mask, rotary_pos_emb = rotary_pos_emb, num_global_tokens = num_global_tokens, kv_cache = kv_cache, cache_positions = cache_positions)
+            x = self.gate_residual(x, gate_self, residual)
 
-            if context is not None:
-                x = x + self.cross_attn(self.cross_attend_norm(x), context = context, context_mask = context_mask)
+            if context is not None or context_kv is not None:
+                x = x + self.attend(self.cross_attn, self.cross_attend_norm(x), context = context, context_mask = context_mask, context_kv = context_kv)
 
             if self.conformer is not None:
                 x = x + self.conformer(x)
 
             # feedforward with adaLN
             residual = x
-            x = self.ff_norm(x)
-            x = x * (1 + scale_ff) + shift_ff
+            x = self.modulate_norm(self.ff_norm, x, scale_ff, shift_ff)
             x = self.ff(x)
-            x = x * torch.sigmoid(1 - gate_ff)
-            x = x + residual
+            x = self.gate_residual(x, gate_ff, residual)
 
         else:
-            x = x + self.self_attn(self.pre_norm(x), mask = mask, rotary_pos_emb = rotary_pos_emb)
+            x = x + self.attend(self.self_attn, self.pre_norm(x), mask = mask, rotary_pos_emb = rotary_pos_emb, num_global_tokens = num_global_tokens, kv_cache = kv_cache, cache_positions = cache_positions)
 
-            if context is not None:
-                x = x + self.cross_attn(self.cross_attend_norm(x), context = context, context_mask = context_mask)
+            if context is not None or context_kv is not None:
+                x = x + self.attend(self.cross_attn, self.cross_attend_norm(x), context = context, context_mask = context_mask, context_kv = context_kv)
 
             if self.conformer is not None:
                 x = x + self.conformer(x)
@@ -687,6 +1050,63 @@ class TransformerBlock(nn.Module):
 
         return x
         
+class FeatureCache:
+    """
+    DeepCache-style feature cache for inference with a ContinuousTransformer.
+
+    Neighbouring denoising steps produce very similar activations in the deeper layers, so on "cached" model
+    evaluations the layers in [start_layer, end_layer) are skipped and the residual they added on the last
+    "full" evaluation is reused. The shallow layers before start_layer and the layers after end_layer are always recomputed.
+
+    Args:
+        start_layer: Index of the first transformer layer whose output is cached
+        end_layer: Index one past the last cached transformer layer
+        interval: Run a full evaluation every `interval` model evaluations (ignored if `schedule` is given)
+        schedule: Optional list of booleans, one per model evaluation. True means full computation, False means reuse the cache.
+            Evaluations past the end of the schedule are fully computed.
+    """
+    def __init__(self, start_layer, end_layer, interval=2, schedule=None):
+        assert 0 <= start_layer < end_layer, "start_layer must be smaller than end_layer"
+        assert interval >= 1, "interval must be at least 1"
+
+        self.start_layer = start_layer
+        self.end_layer = end_layer
+        self.interval = interval
+        self.schedule = schedule
+
+        self.reset()
+
+    def reset(self):
+        self.residual = None
+        self.step_ix = 0
+        self.num_full = 0
+        self.num_cached = 0
+
+    def is_full_step(self, step_ix):
+        if self.schedule is not None:
+            return step_ix >= len(self.schedule) or bool(self.schedule[step_ix])
+
+        return step_ix % self.interval == 0
+
+    def should_reuse(self, x):
+        """
+        Decides whether the current model evaluation can reuse the cached residual, and advances the step counter
+        """
+        reuse = (
+            self.residual is not None
+            and self.residual.shape == x.shape
+            and not self.is_full_step(self.step_ix)
+        )
+
+        self.step_ix += 1
+
+        if reuse:
+            self.num_cached += 1
+        else:
+            self.num_full += 1
+
+        return reuse
+
 class ContinuousTransformer(nn.Module):
     def __init__(
         self,
@@ -706,6 +1126,11 @@ class ContinuousTransformer(nn.Module):
         use_sinusoidal_emb=False,
         use_abs_pos_emb=False,
         abs_pos_emb_max_length=10000,
+        checkpointing: Literal["all", "none", "every_n", "attention", "auto"] = "all",
+        checkpoint_every: int = 2,
+        checkpoint_memory_budget: float = None,
+        window_size = None,
+        window_layers = None,
         **kwargs
         ):
 
@@ -744,10 +1169,94 @@ class ContinuousTransformer(nn.Module):
                     zero_init_branch_outputs = zero_init_branch_outputs,
                     conformer=conformer,
                     layer_ix=i,
+                    window_size = window_size if window_layers is None or i in window_layers else None,
                     **kwargs
                 )
             )
-        
+
+        self.set_checkpointing(checkpointing, checkpoint_every=checkpoint_every, checkpoint_memory_budget=checkpoint_memory_budget)
+
+    def set_checkpointing(
+        self,
+        checkpointing: Literal["all", "none", "every_n", "attention", "auto"] = "all",
+        checkpoint_every: int = 2,
+        checkpoint_memory_budget: float = None
+    ):
+        """
+        Sets which activations are recomputed in the backward pass instead of being stored. Checkpointing only applies in training mode with gradients enabled.
+
+        Policies:
+            "all": Every layer is checkpointed
+            "none": Nothing is checkpointed
+            "every_n": Every checkpoint_every-th layer is checkpointed, starting with the first
+            "attention": Only the self- and cross-attention of every layer is checkpointed
+            "auto": The first layer measures the activations a layer stores, and the layers that don't fit into
+                checkpoint_memory_budget (in GB) are checkpointed. Without a budget, 80% of the free CUDA memory is used,
+                and nothing is checkpointed on other devices
+        """
+        if checkpointing not in ["all", "none", "every_n", "attention", "auto"]:
+            raise ValueError(f"Unknown checkpointing policy: {checkpointing}")
+
+        assert checkpoint_every >= 1, "checkpoint_every must be at least 1"
+
+        self.checkpointing = checkpointing
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_memory_budget = checkpoint_memory_budget
+
+        for layer in self.layers:
+            layer.checkpoint_attention = checkpointing == "attention"
+
+        # Index of the first layer checkpointed by the "auto" policy, per input shape
+        self._auto_checkpoint_start = {}
+
+    def get_auto_checkpoint_start(self, x, layer_bytes):
+        """
+        Returns the index of the first checkpointed layer, so that the layers before it can store their activations within the memory budget,
+        given the bytes stored by one layer. The checkpointed layers only store their input.
+        """
+        if self.checkpoint_memory_budget is not None:
+            budget = self.checkpoint_memory_budget * 1024 ** 3
+        elif x.device.type == "cuda":
+            # Memory cached by the allocator but not in use is available as well
+            budget = (torch.cuda.mem_get_info(x.device)[0] + torch.cuda.memory_reserved(x.device) - torch.cuda.memory_allocated(x.device)) * 0.8
+        else:
+            return len(self.layers)
+
+        input_bytes = x.numel() * x.element_size()
+
+        # Every layer stores at least its input, the first layer already stored its activations
+        free_bytes = budget - layer_bytes - (len(self.layers) - 1) * input_bytes
+        num_stored = int(free_bytes // max(layer_bytes - input_bytes, 1))
+
+        return 1 + min(max(num_stored, 0), len(self.layers) - 1)
+
+    def should_checkpoint_layer(self, layer_ix, auto_checkpoint_start=None):
+        if self.checkpointing == "all":
+            return True
+        elif self.checkpointing == "every_n":
+            return layer_ix % self.checkpoint_every == 0
+        elif self.checkpointing == "auto":
+            return layer_ix >= auto_checkpoint_start
+
+        # "none", and "attention" which checkpoints inside the layers
+        return False
+
+    def create_kv_caches(self, batch_size, max_seq_len, device = None, dtype = None):
+        """
+        Creates the KV caches of every layer for autoregressive generation of up to max_seq_len tokens (including prepended tokens), to be passed to forward as kv_caches
+        """
+        return [
+            KVCache(batch_size, layer.self_attn.kv_heads, max_seq_len, layer.self_attn.dim_heads, device = device, dtype = dtype)
+            for layer in self.layers
+        ]
+
+    def project_context(self, context):
+        """
+        Projects the cross-attention context to the keys and values of every layer, to be passed to forward as context_kv.
+        Layers without cross-attention get None.
+        """
+        return [layer.cross_attn.project_context(context) if layer.cross_attend else None for layer in self.layers]
+
     def forward(
         self,
         x,
@@ -756,8 +1265,16 @@ class ContinuousTransformer(nn.Module):
         prepend_mask = None,
         global_cond = None,
         return_info = False,
+        feature_cache: FeatureCache = None,
+        context_kv = None,
+        kv_caches = None,
+        cache_offset = 0,
         **kwargs
     ):
+        """
+        With kv_caches, x holds the tokens following the cache_offset tokens already written to the caches,
+        and only the new tokens are computed.
+        """
         batch, seq, device = *x.shape[:2], x.device
 
         info = {
@@ -779,20 +1296,69 @@ class ContinuousTransformer(nn.Module):
 
                 mask = torch.cat((prepend_mask, mask), dim = -1)
 
+            # The prepended tokens attend to and are attended by the whole sequence in sliding window layers
+            kwargs["num_global_tokens"] = prepend_length
+
         # Attention layers 
 
-        if self.rotary_pos_emb is not None:
-            rotary_pos_emb = self.rotary_pos_emb.forward_from_seq_len(x.shape[1])
+        positions = None
+
+        if kv_caches is not None:
+            # Positions of the new tokens in the caches, cache_offset can also be a tensor so the step keeps static shapes
+            positions = torch.arange(x.shape[1], device = device) + cache_offset
+
+        if self.rotary_pos_emb is not None and kv_caches is not None:
+            tables = self.rotary_pos_emb.get_cos_sin(kv_caches[0].max_seq_len, dtype=torch.promote_types(x.dtype, torch.float32))
+            rotary_pos_emb = RotaryTables(tables.cos[positions], tables.sin[positions])
+        elif self.rotary_pos_emb is not None:
+            rotary_pos_emb = self.rotary_pos_emb.get_cos_sin(x.shape[1], dtype=torch.promote_types(x.dtype, torch.float32))
         else:
             rotary_pos_emb = None
 
         if self.use_sinusoidal_emb or self.use_abs_pos_emb:
-            x = x + self.pos_emb(x)
+            x = x + self.pos_emb(x, pos = positions)
+
+        # Checkpointing only saves memory when the activations would be stored for a backward pass
+        use_checkpointing = self.checkpointing != "none" and self.training and torch.is_grad_enabled()
+        auto_checkpoint_start = self._auto_checkpoint_start.get(x.shape, None)
+
+        reuse_features = False
+
+        if feature_cache is not None:
+            assert feature_cache.end_layer <= len(self.layers), "feature cache end_layer must not exceed the transformer depth"
+            reuse_features = feature_cache.should_reuse(x)
 
         # Iterate over the transformer layers
-        for layer in self.layers:
-            #x = layer(x, rotary_pos_emb = rotary_pos_emb, global_cond=global_cond, **kwargs)
-            x = checkpoint(layer, x, rotary_pos_emb = rotary_pos_emb, global_cond=global_cond, **kwargs)
+        for layer_ix, layer in enumerate(self.layers):
+            in_cached_span = feature_cache is not None and feature_cache.start_layer <= layer_ix < feature_cache.end_layer
+
+            if in_cached_span and reuse_features:
+                # Skip the cached layers, adding the residual they contributed on the last full evaluation
+                if layer_ix == feature_cache.start_layer:
+                    x = x + feature_cache.residual
+            else:
+                if in_cached_span and layer_ix == feature_cache.start_layer:
+                    cache_input = x
+
+                if context_kv is not None:
+                    kwargs["context_kv"] = context_kv[layer_ix]
+
+                if kv_caches is not None:
+                    kwargs["kv_cache"] = kv_caches[layer_ix]
+                    kwargs["cache_positions"] = positions
+
+                if use_checkpointing and self.checkpointing == "auto" and auto_checkpoint_start is None:
+                    # Measure the activations of the first layer computed, then checkpoint the layers that don't fit into the budget
+                    x, layer_bytes = saved_activation_bytes(layer, x, rotary_pos_emb = rotary_pos_emb, global_cond=global_cond, **kwargs)
+                    auto_checkpoint_start = self.get_auto_checkpoint_start(x, layer_bytes)
+                    self._auto_checkpoint_start[x.shape] = auto_checkpoint_start
+                elif use_checkpointing and self.should_checkpoint_layer(layer_ix, auto_checkpoint_start):
+                    x = checkpoint(layer, x, rotary_pos_emb = rotary_pos_emb, global_cond=global_cond, **kwargs)
+                else:
+                    x = layer(x, rotary_pos_emb = rotary_pos_emb, global_cond=global_cond, **kwargs)
+
+                if in_cached_span and layer_ix == feature_cache.end_layer - 1:
+                    feature_cache.residual = x - cache_input
 
             if return_info:
                 info["hidden_states"].append(x)
@@ -1,7 +1,8 @@
 import torch
-from safetensors.torch import load_file
+from safetensors.torch import load_file, save_file
 
-from torch.nn.utils import remove_weight_norm
+from torch.nn.utils import parametrize, remove_weight_norm
+from torch.nn.utils.weight_norm import WeightNorm
 
 def load_ckpt_state_dict(ckpt_path):
     if ckpt_path.endswith(".safetensors"):
@@ -11,14 +12,60 @@ def load_ckpt_state_dict(ckpt_path):
     
     return state_dict
 
+def has_weight_norm(module):
+    """
+    Whether the weight of the module is weight normalized, either with the torch.nn.utils.weight_norm hook or the weight_norm parametrization
+    """
+    if any(isinstance(hook, WeightNorm) and hook.name == "weight" for hook in module._forward_pre_hooks.values()):
+        return True
+
+    return parametrize.is_parametrized(module, "weight")
+
 def remove_weight_norm_from_model(model):
+    """
+    Folds the weight norm of every weight normalized module into a plain weight, so the normalization isn't recomputed on every forward pass.
+    Modules without weight norm are left untouched.
+    """
     for module in model.modules():
-        if hasattr(module, "weight"):
-            print(f"Removing weight norm from {module}")
+        if not has_weight_norm(module):
+            continue
+
+        if parametrize.is_parametrized(module, "weight"):
+            parametrize.remove_parametrizations(module, "weight", leave_parametrized=True)
+        else:
             remove_weight_norm(module)
 
     return model
 
+def has_folded_weight_norm(model, state_dict):
+    """
+    Whether the state dict was saved after folding weight norm (see remove_weight_norm_from_model), while the model still has it
+    """
+    for name, module in model.named_modules():
+        prefix = f"{name}." if name else ""
+        if has_weight_norm(module) and f"{prefix}weight" in state_dict:
+            return True
+
+    return False
+
+def save_inference_state_dict(model, path, dtype=None, exclude_prefixes=[]):
+    """
+    Saves the weights of a model prepared for inference to a safetensors file, optionally cast to a lower precision dtype.
+    Parameters whose names start with one of exclude_prefixes are left out.
+    """
+    state_dict = {}
+
+    for name, tensor in model.state_dict().items():
+        if any(name.startswith(prefix) for prefix in exclude_prefixes):
+            continue
+
+        if dtype is not None and tensor.is_floating_point():
+            tensor = tensor.to(dtype)
+
+        state_dict[name] = tensor.contiguous()
+
+    save_file(state_dict, path)
+
 # Sampling functions copied from https://github.com/facebookresearch/audiocraft/blob/main/audiocraft/utils/utils.py under MIT license
 # License can be found in LICENSES/LICENSE_META.txt
 
@@ -82,6 +129,119 @@ def sample_top_p(probs: torch.Tensor, p: float) -> torch.Tensor:
     next_token = torch.gather(probs_idx, -1, next_token)
     return next_token
 
+
+def _per_row_sampling_params(temperature, top_k, top_p, shape, device):
+    # Broadcast numbers or per batch item tensors over the remaining dimensions, then flatten like the logits
+    def per_row(value, dtype):
+        value = torch.as_tensor(value, dtype=dtype, device=device)
+        value = value.view(-1, *[1] * (len(shape) - 1)) if value.ndim == 1 else value
+        return value.expand(shape).reshape(-1)
+
+    return per_row(temperature, torch.float32), per_row(top_k, torch.long), per_row(top_p, torch.float32)
+
+
+def sample_logits(logits: torch.Tensor, temperature=1.0, top_k=0, top_p=0.0, num_candidates: int = 256, *, generator=None) -> torch.Tensor:
+    """Sample next tokens from logits, with a temperature, top-k and top-p per batch item.
+
+    Every row follows the same rules as a single setting: a temperature of 0 or less is greedy, top_p > 0 takes precedence
+    over top_k > 0, and neither samples from the full distribution. Top-k and top-p only look at the largest logits,
+    found with a partial top-k instead of a full sort. When the top_p mass of a row isn't within the num_candidates
+    largest logits, all the candidates are considered.
+
+    Args:
+        logits (torch.Tensor): Logits of shape [B, ..., card].
+        temperature (float or torch.Tensor): Temperature, a number or a tensor of shape [B].
+        top_k (int or torch.Tensor): The k in "top-k", a number or a tensor of shape [B].
+        top_p (float or torch.Tensor): The p in "top-p", a number or a tensor of shape [B].
+        num_candidates (int): Number of largest logits considered for top-p.
+    Keywords args:
+        generator (torch.Generator): A pseudorandom number generator for sampling.
+    Returns:
+        torch.Tensor: Sampled tokens of shape [B, ..., 1].
+    """
+    *shape, card = logits.shape
+    device = logits.device
+
+    temperature, top_k, top_p = _per_row_sampling_params(temperature, top_k, top_p, shape, device)
+    logits = logits.reshape(-1, card)
+
+    next_token = torch.argmax(logits, dim=-1)
+
+    use_sampling = temperature > 0
+    use_top_p = use_sampling & (top_p > 0)
+    use_top_k = use_sampling & ~use_top_p & (top_k > 0)
+    use_full = use_sampling & ~use_top_p & ~use_top_k
+
+    if not use_sampling.any():
+        return next_token.view(*shape, 1)
+
+    log_probs = torch.log_softmax(logits.float() / temperature.clamp(min=1e-6)[:, None], dim=-1)
+
+    if use_full.any():
+        next_token = torch.where(use_full, multinomial(log_probs.exp(), num_samples=1, generator=generator)[:, 0], next_token)
+
+    if use_top_p.any() or use_top_k.any():
+        num_top = int(top_k[use_top_k].max()) if use_top_k.any() else 0
+        if use_top_p.any():
+            num_top = max(num_top, num_candidates)
+        num_top = min(num_top, card)
+
+        while True:
+            candidate_log_probs, candidate_ids = torch.topk(log_probs, num_top, dim=-1)
+            candidate_probs = candidate_log_probs.exp()
+            positions = torch.arange(num_top, device=device)
+
+            # top-p keeps the candidates whose preceding mass is within p, top-k the first k
+            keep_top_p = torch.cumsum(candidate_probs, dim=-1) - candidate_probs <= top_p[:, None]
+            keep = torch.where(use_top_p[:, None], keep_top_p, positions < top_k[:, None])
+
+            # A row that keeps all its candidates may have more of its top-p mass past them
+            overflow = use_top_p & keep[:, -1]
+            if num_top == card or not overflow.any():
+                break
+            num_top = card
+
+        sampled = multinomial(candidate_probs * keep, num_samples=1, generator=generator)
+        sampled = torch.gather(candidate_ids, -1, sampled)[:, 0]
+        next_token = torch.where(use_top_p | use_top_k, sampled, next_token)
+
+    return next_token.view(*shape, 1)
+
+
+def sampling_probs(logits: torch.Tensor, temperature=1.0, top_k=0, top_p=0.0) -> torch.Tensor:
+    """Probabilities of the tokens sampled by sample_logits with the same settings, e.g. for speculative sampling.
+
+    Greedy rows put all the probability on the largest logit, top-k and top-p rows are renormalized over the kept tokens.
+
+    Args:
+        logits (torch.Tensor): Logits of shape [B, ..., card].
+        temperature (float or torch.Tensor): Temperature, a number or a tensor of shape [B].
+        top_k (int or torch.Tensor): The k in "top-k", a number or a tensor of shape [B].
+        top_p (float or torch.Tensor): The p in "top-p", a number or a tensor of shape [B].
+    Returns:
+        torch.Tensor: Probabilities of shape [B, ..., card].
+    """
+    *shape, card = logits.shape
+
+    temperature, top_k, top_p = _per_row_sampling_params(temperature, top_k, top_p, shape, logits.device)
+    logits = logits.reshape(-1, card).float()
+
+    greedy_probs = torch.nn.functional.one_hot(torch.argmax(logits, dim=-1), card).float()
+
+    probs_sort, probs_idx = torch.sort(torch.softmax(logits / temperature.clamp(min=1e-6)[:, None], dim=-1), dim=-1, descending=True)
+    positions = torch.arange(card, device=logits.device)
+
+    keep_top_p = torch.cumsum(probs_sort, dim=-1) - probs_sort <= top_p[:, None]
+    keep_top_k = (positions < top_k[:, None]) | (top_k[:, None] <= 0)
+    keep = torch.where((top_p > 0)[:, None], keep_top_p, keep_top_k)
+
+    probs_sort = probs_sort * keep
+    probs = torch.zeros_like(probs_sort).scatter_(-1, probs_idx, probs_sort / probs_sort.sum(dim=-1, keepdim=True))
+
+    probs = torch.where((temperature > 0)[:, None], probs, greedy_probs)
+
+    return probs.view(*shape, card)
+
 def next_power_of_two(n):
     return 2 ** (n - 1).bit_length()
 
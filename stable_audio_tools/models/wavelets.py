@@ -1,6 +1,7 @@
 """The 1D discrete wavelet transform for PyTorch."""
 
 from einops import rearrange
+import math
 import pywt
 import torch
 from torch import nn
@@ -14,11 +15,106 @@ def get_filter_bank(wavelet):
         filt = filt[:, 1:]
     return filt
 
+def wavelet_encode_levels(x, kernel, channels, levels):
+    """
+    Runs the wavelet decomposition level by level, filtering the low band of every level with reflect padding
+    """
+    for i in range(levels):
+        low, rest = x[:, : channels], x[:, channels :]
+        pad = kernel.shape[-1] // 2
+        low = F.pad(low, (pad, pad), "reflect")
+        low = F.conv1d(low, kernel, stride=2)
+        rest = rearrange(
+            rest, "n (c c2) (l l2) -> n (c l2 c2) l", l2=2, c2=channels
+        )
+        x = torch.cat([low, rest], dim=1)
+    return x
+
+def wavelet_decode_levels(x, kernel, channels, levels):
+    """
+    Inverts wavelet_encode_levels level by level
+    """
+    for i in range(levels):
+        low, rest = x[:, : channels * 2], x[:, channels * 2 :]
+        pad = kernel.shape[-1] // 2 + 2
+        low = rearrange(low, "n (l2 c) l -> n c (l l2)", l2=2)
+        low = F.pad(low, (pad, pad), "reflect")
+        low = rearrange(low, "n c (l l2) -> n (l2 c) l", l2=2)
+        low = F.conv_transpose1d(
+            low, kernel, stride=2, padding=kernel.shape[-1] // 2
+        )
+        low = low[..., pad - 1 : -pad]
+        rest = rearrange(
+            rest, "n (c l2 c2) l -> n (c c2) (l l2)", l2=2, c2=channels
+        )
+        x = torch.cat([low, rest], dim=1)
+    return x
+
+def get_band_kernel(responses, offsets, length):
+    """
+    Collects the impulse responses of every band into one filter per band.
+    responses[i, band, k] is the response at offset offsets[i, k] from the impulse, the filters cover all offsets with a non-zero response and offset 0.
+    Returns the filters of shape (bands, kernel size), and the padding that lines up the kernel with offset 0.
+    """
+    bands = responses.shape[1]
+
+    kernel = torch.zeros(bands, 2 * length + 1, dtype=responses.dtype)
+    kernel[:, offsets.flatten() + length] = rearrange(responses, "i b k -> b (i k)")
+
+    support = torch.nonzero(kernel.abs().sum(0)).flatten() - length
+    start = min(support.min().item(), 0)
+    end = max(support.max().item(), 0)
+
+    return kernel[:, start + length : end + length + 1], -start
+
+def get_boundary_widths(output, reference, tolerance=1e-8):
+    """
+    The number of frames at the start and end of output that differ from reference, which have to be computed level by level
+    """
+    differs = ((output - reference).abs().amax(dim=(0, 1)) > tolerance).tolist()
+    length = len(differs)
+
+    left = max([i + 1 for i in range(length // 2) if differs[i]], default=0)
+    right = max([length - i for i in range(length // 2, length) if differs[i]], default=0)
+
+    return left, right
+
+def get_polyphase_kernel(band_kernel, padding, stride):
+    """
+    Rearranges the per-band synthesis filters of shape (bands, kernel size) into a stride 1 convolution from bands to output phases,
+    so synthesis doesn't need a transposed convolution. Returns the kernel of shape (phases, bands, taps) and the left and right padding in frames.
+    """
+    bands, kernel_size = band_kernel.shape
+
+    # Output sample stride * m + r gets tap stride * u + r + padding of the band filters from frame m - u
+    max_u = (kernel_size - 1 - padding) // stride
+    min_u = -((stride - 1 + padding) // stride)
+    taps = max_u - min_u + 1
+
+    kernel = torch.zeros(stride, bands, taps, dtype=band_kernel.dtype)
+    for k in range(taps):
+        u = max_u - k
+        for r in range(stride):
+            j = stride * u + r + padding
+            if 0 <= j < kernel_size:
+                kernel[r, :, k] = band_kernel[:, j]
+
+    return kernel, max_u, -min_u
+
 class WaveletEncode1d(nn.Module):
+    """
+    Multi-level wavelet decomposition, from (batch, channels, length) to (batch, channels * 2 ** levels, length / 2 ** levels).
+
+    Away from the ends of the signal, all levels together are a single strided convolution with 2 ** levels filters, which is precomputed from impulse responses.
+    With fused=True the bulk of the signal is encoded with that convolution, and only the frames near the ends, where every level reflects
+    the signal, are encoded level by level. Both give the same output up to floating point rounding.
+    The fused filters get longer with every level, so by default they are only used for 2 to 6 levels (a single level is already one convolution), see scripts/benchmark_wavelets.py.
+    """
     def __init__(self, 
                  channels, 
                  levels,
-                 wavelet: Literal["bior2.2", "bior2.4", "bior2.6", "bior2.8", "bior4.4", "bior6.8"] = "bior4.4"):
+                 wavelet: Literal["bior2.2", "bior2.4", "bior2.6", "bior2.8", "bior4.4", "bior6.8"] = "bior4.4",
+                 fused: bool = None):
         super().__init__()
         self.wavelet = wavelet
         self.channels = channels
@@ -33,24 +129,80 @@ class WaveletEncode1d(nn.Module):
         kernel_final[index_i * channels + index_j, index_j] = kernel[index_i, 0]
         self.register_buffer("kernel", kernel_final)
 
+        self.fused = fused if fused is not None else 1 < levels <= 6
+
+        if self.fused:
+            self.init_fused_kernel()
+
+    @torch.no_grad()
+    def init_fused_kernel(self):
+        stride = 2 ** self.levels
+        kernel = self.kernel.double()
+
+        # Long enough for the interior frames to be unaffected by the ends
+        length = 4 * stride * (kernel.shape[-1] + 1)
+
+        # One impulse per phase in the middle of the signal, in the first audio channel
+        phases = torch.arange(stride)
+        impulses = torch.zeros(stride, self.channels, length, dtype=torch.float64)
+        impulses[phases, 0, length // 2 + phases] = 1
+
+        responses = wavelet_encode_levels(impulses, kernel, self.channels, self.levels)[:, ::self.channels]
+
+        # Frame t of the response to an impulse at n holds the filter tap at offset n - stride * t
+        frames = torch.arange(responses.shape[-1])
+        offsets = (length // 2 + phases)[:, None] - stride * frames[None, :]
+
+        band_kernel, self.padding = get_band_kernel(responses, offsets, length)
+        self.register_buffer("fused_kernel", band_kernel[:, None].float(), persistent=False)
+
+        # The frames near the ends that see the reflect padding of some level
+        signal = torch.randn(1, self.channels, length, dtype=torch.float64, generator=torch.Generator().manual_seed(0))
+        reference = wavelet_encode_levels(signal, kernel, self.channels, self.levels)
+        output = self.fused_encode(F.pad(signal, (self.padding, band_kernel.shape[-1] - 1 - self.padding)), band_kernel[:, None])
+        left, right = get_boundary_widths(output, reference)
+
+        # Frames whose filter would reach past the ends are always computed level by level
+        self.left_frames = max(left, math.ceil(self.padding / stride))
+        self.right_frames = max(right, math.ceil((band_kernel.shape[-1] - self.padding) / stride) - 1)
+
+        # The ends are encoded from crops that are long enough for their boundary frames not to see the crop boundary
+        self.edge_length = stride * max(self.left_frames + self.right_frames, kernel.shape[-1])
+
+    def fused_encode(self, x, kernel):
+        # Audio channels are filtered separately, so they are folded into the batch
+        output = F.conv1d(rearrange(x, "n c l -> (n c) 1 l"), kernel, stride=2 ** self.levels)
+        return rearrange(output, "(n c) b l -> n (b c) l", c=self.channels)
+
     def forward(self, x):
-        for i in range(self.levels):
-            low, rest = x[:, : self.channels], x[:, self.channels :]
-            pad = self.kernel.shape[-1] // 2
-            low = F.pad(low, (pad, pad), "reflect")
-            low = F.conv1d(low, self.kernel, stride=2)
-            rest = rearrange(
-                rest, "n (c c2) (l l2) -> n (c l2 c2) l", l2=2, c2=self.channels
-            )
-            x = torch.cat([low, rest], dim=1)
-        return x
+        if not self.fused or x.shape[-1] < 2 * self.edge_length:
+            return wavelet_encode_levels(x, self.kernel, self.channels, self.levels)
+
+        stride = 2 ** self.levels
+        length = x.shape[-1]
+        num_frames = length // stride
+
+        left = wavelet_encode_levels(x[..., :self.edge_length], self.kernel, self.channels, self.levels)[..., :self.left_frames]
+        right = wavelet_encode_levels(x[..., length - self.edge_length:], self.kernel, self.channels, self.levels)[..., self.edge_length // stride - self.right_frames:]
+
+        start = stride * self.left_frames - self.padding
+        end = stride * (num_frames - self.right_frames - 1) - self.padding + self.fused_kernel.shape[-1]
+        interior = self.fused_encode(x[..., start:end], self.fused_kernel)
+
+        return torch.cat([left, interior, right], dim=-1)
 
 
 class WaveletDecode1d(nn.Module):
+    """
+    Inverse of WaveletEncode1d.
+
+    Away from the ends of the signal, all levels together are a single convolution from the bands to the 2 ** levels phases of the output, see WaveletEncode1d.
+    """
     def __init__(self, 
                  channels, 
                  levels,
-                 wavelet: Literal["bior2.2", "bior2.4", "bior2.6", "bior2.8", "bior4.4", "bior6.8"] = "bior4.4"):
+                 wavelet: Literal["bior2.2", "bior2.4", "bior2.6", "bior2.8", "bior4.4", "bior6.8"] = "bior4.4",
+                 fused: bool = None):
         super().__init__()
         self.wavelet = wavelet
         self.channels = channels
@@ -64,19 +216,58 @@ class WaveletDecode1d(nn.Module):
         kernel_final[index_i * channels + index_j, index_j] = kernel[index_i, 0]
         self.register_buffer("kernel", kernel_final)
 
+        self.fused = fused if fused is not None else 1 < levels <= 6
+
+        if self.fused:
+            self.init_fused_kernel()
+
+    @torch.no_grad()
+    def init_fused_kernel(self):
+        stride = 2 ** self.levels
+        kernel = self.kernel.double()
+
+        num_frames = 4 * (kernel.shape[-1] + 1)
+        length = num_frames * stride
+
+        # One impulse per band in the middle frame, in the first audio channel
+        bands = torch.arange(stride)
+        impulses = torch.zeros(stride, stride * self.channels, num_frames, dtype=torch.float64)
+        impulses[bands, bands * self.channels, num_frames // 2] = 1
+
+        responses = wavelet_decode_levels(impulses, kernel, self.channels, self.levels)[:, 0]
+
+        # Sample n of the response to an impulse at frame t holds the filter tap at offset n - stride * t
+        offsets = torch.arange(length) - stride * (num_frames // 2)
+
+        band_kernel, padding = get_band_kernel(responses[None], offsets[None], length)
+        polyphase_kernel, self.left_padding, self.right_padding = get_polyphase_kernel(band_kernel, padding, stride)
+        self.register_buffer("fused_kernel", polyphase_kernel.float(), persistent=False)
+
+        # The samples near the ends that see the reflect padding of some level
+        signal = torch.randn(1, stride * self.channels, num_frames, dtype=torch.float64, generator=torch.Generator().manual_seed(0))
+        reference = wavelet_decode_levels(signal, kernel, self.channels, self.levels)
+        output = self.fused_decode(signal, polyphase_kernel)
+        self.left_samples, self.right_samples = get_boundary_widths(output, reference)
+
+        # The ends are decoded from crops that are long enough for their boundary samples not to see the crop boundary
+        self.edge_frames = max(math.ceil((self.left_samples + self.right_samples) / stride), kernel.shape[-1])
+
+    def fused_decode(self, x, kernel):
+        x = rearrange(x, "n (b c) l -> (n c) b l", c=self.channels)
+        output = F.conv1d(F.pad(x, (self.left_padding, self.right_padding)), kernel)
+        return rearrange(output, "(n c) r m -> n c (m r)", c=self.channels)
+
     def forward(self, x):
-        for i in range(self.levels):
-            low, rest = x[:, : self.channels * 2], x[:, self.channels * 2 :]
-            pad = self.kernel.shape[-1] // 2 + 2
-            low = rearrange(low, "n (l2 c) l -> n c (l l2)", l2=2)
-            low = F.pad(low, (pad, pad), "reflect")
-            low = rearrange(low, "n c (l l2) -> n (l2 c) l", l2=2)
-            low = F.conv_transpose1d(
-                low, self.kernel, stride=2, padding=self.kernel.shape[-1] // 2
-            )
-            low = low[..., pad - 1 : -pad]
-            rest = rearrange(
-                rest, "n (c l2 c2) l -> n (c c2) (l l2)", l2=2, c2=self.channels
-            )
-            x = torch.cat([low, rest], dim=1)
-        return x
\ No newline at end of file
+        if not self.fused or x.shape[-1] < 2 * self.edge_frames:
+            return wavelet_decode_levels(x, self.kernel, self.channels, self.levels)
+
+        stride = 2 ** self.levels
+        num_frames = x.shape[-1]
+        length = num_frames * stride
+
+        left = wavelet_decode_levels(x[..., :self.edge_frames], self.kernel, self.channels, self.levels)[..., :self.left_samples]
+        right = wavelet_decode_levels(x[..., num_frames - self.edge_frames:], self.kernel, self.channels, self.levels)[..., stride * self.edge_frames - self.right_samples:]
+
+        interior = self.fused_decode(x, self.fused_kernel)[..., self.left_samples:length - self.right_samples]
+
+        return torch.cat([left, interior, right], dim=-1)
@@ -338,8 +338,6 @@ class DiffusionCondTrainingWrapper(pl.LightningModule):
         p.tick("conditioning")
 
         if self.diffusion.pretransform is not None:
-            self.diffusion.pretransform.to(self.device)
-
             if not self.pre_encoded:
                 with torch.cuda.amp.autocast() and torch.set_grad_enabled(self.diffusion.pretransform.enable_grad):
                     diffusion_input = self.diffusion.pretransform.encode(diffusion_input)
@@ -716,8 +714,6 @@ class DiffusionCondInpaintTrainingWrapper(pl.LightningModule):
         p.tick("conditioning")
 
         if self.diffusion.pretransform is not None:
-            self.diffusion.pretransform.to(self.device)
-
             if not self.pre_encoded:
                 with torch.cuda.amp.autocast() and torch.set_grad_enabled(self.diffusion.pretransform.enable_grad):
                     diffusion_input = self.diffusion.pretransform.encode(diffusion_input)
@@ -871,7 +867,6 @@ class DiffusionCondInpaintDemoCallback(pl.Callback):
                 # log_dict[f'demo_reals'] = wandb.Audio(rearrange(demo_reals, "b d n -> d (b n)").mul(32767).to(torch.int16).cpu(), sample_rate=self.sample_rate, caption="demo reals")
 
                 if module.diffusion.pretransform is not None:
-                    module.diffusion.pretransform.to(module.device)
                     with torch.cuda.amp.autocast():
                         demo_reals = module.diffusion.pretransform.encode(demo_reals)
 